@@ -0,0 +1,721 @@
+from ConnectionPool import PooledConnection
+from Link import Link
+import Messages
+from Messages import Packet
+from PeerNode import PeerNode
+from Transfer import FileSink
+
+import asyncio
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from collections import deque
+from dataclasses import dataclass, field
+import hmac
+from os import urandom
+from struct import unpack
+from typing import Deque, Dict, Iterable, Iterator, List, Tuple, Union
+
+
+# Handshake parameters
+HANDSHAKE_SIZE = 32        # Size of a raw X25519 public key
+KEY_SIZE       = 32        # AES-256 keys for each direction plus the confirmation value
+KDF_INFO       = b"ArbitraryNetwork circuit keys"
+LAYER_SLACK    = 15        # Room `update_into` needs past the data, one AES block less a byte
+IN_PLACE_MIN   = 16 * 1024 # Smallest cell body layered with `update_into`, whose fixed cost outweighs a copy below it
+# Flow control, counted in packets carried end to end between the client and the last hop
+CIRCUIT_WINDOW    = 1000 # Packets that may be in flight on a circuit before a `MSG_SENDME` is needed
+CIRCUIT_INCREMENT = 100  # Packets acknowledged by each circuit-level `MSG_SENDME`
+STREAM_WINDOW     = 500  # Packets that may be in flight on a single stream
+STREAM_INCREMENT  = 50   # Packets acknowledged by each stream-level `MSG_SENDME`
+# Control packets that bypass the windows
+UNCOUNTED         = frozenset((Messages.Preambles.MSG_SENDME.value,
+                               Messages.Preambles.MSG_EXTEND.value,
+                               Messages.Preambles.MSG_EXTENDED.value,
+                               Messages.Preambles.MSG_DENY.value))
+
+
+def derive_keys(shared: bytes, client_pub: bytes, relay_pub: bytes) -> Tuple[bytes, bytes, bytes]:
+    '''Expand an X25519 shared secret into the key material of a single hop.
+
+    Parameters:
+        shared (bytes): Shared secret produced by the key exchange.
+        client_pub (bytes): Ephemeral public key of the client.
+        relay_pub (bytes): Ephemeral public key of the relay.
+
+    Returns:
+        The forward key, backward key and key confirmation value, in that order.
+
+    '''
+    material = HKDF(algorithm=hashes.SHA256(),
+                    length=(3 * KEY_SIZE),
+                    salt=(client_pub + relay_pub),
+                    info=KDF_INFO).derive(shared)
+    return material[:KEY_SIZE], material[KEY_SIZE:(2 * KEY_SIZE)], material[(2 * KEY_SIZE):]
+
+
+def new_circ_id() -> int:
+    '''Pick a random, non-zero circuit identifier.
+
+    Returns:
+        A 32-bit circuit ID.
+
+    '''
+    circ_id = 0
+    while circ_id == 0:
+        circ_id = unpack("!I", urandom(4))[0]
+    return circ_id
+
+
+# ======================================================================================================================
+class CircuitHop(object):
+    '''Symmetric cipher state shared between a client and one relay of a circuit.
+
+    Attributes:
+        forward (CipherContext): AES-CTR keystream applied to cells travelling away from the client.
+        backward (CipherContext): AES-CTR keystream applied to cells travelling towards the client.
+
+    Note:
+        The keystreams are continuous for the life of the circuit, so both ends must process every cell in the same
+        order. TCP guarantees this along each link.
+
+    '''
+    def __init__(self, forward_key: bytes, backward_key: bytes) -> None:
+        self.forward  = Cipher(algorithms.AES(forward_key), modes.CTR(bytes(16))).encryptor()
+        self.backward = Cipher(algorithms.AES(backward_key), modes.CTR(bytes(16))).encryptor()
+
+
+    def forward_layer(self, data: bytes) -> bytes:
+        '''Add or remove this hop's layer on a cell moving away from the client.
+
+        Parameters:
+            data (bytes): Cell body.
+
+        Returns:
+            The cell body with the layer toggled.
+
+        '''
+        return self.forward.update(data)
+
+
+    def backward_layer(self, data: bytes) -> bytes:
+        '''Add or remove this hop's layer on a cell moving towards the client.
+
+        Parameters:
+            data (bytes): Cell body.
+
+        Returns:
+            The cell body with the layer toggled.
+
+        '''
+        return self.backward.update(data)
+
+
+    def forward_into(self, data: bytes, buffer: bytearray, offset: int) -> None:
+        '''Toggle this hop's forward layer while writing the result directly into an outgoing buffer.
+
+        Parameters:
+            data (bytes): Cell body.
+            buffer (bytearray): Destination with `len(data) + LAYER_SLACK` bytes of room at `offset`.
+            offset (int): Position in `buffer` the body is written to.
+
+        '''
+        with memoryview(buffer) as view:
+            self.forward.update_into(data, view[offset:])
+
+
+    def backward_into(self, data: bytes, buffer: bytearray, offset: int) -> None:
+        '''Toggle this hop's backward layer while writing the result directly into an outgoing buffer.
+
+        Parameters:
+            data (bytes): Cell body.
+            buffer (bytearray): Destination with `len(data) + LAYER_SLACK` bytes of room at `offset`.
+            offset (int): Position in `buffer` the body is written to.
+
+        '''
+        with memoryview(buffer) as view:
+            self.backward.update_into(data, view[offset:])
+
+
+
+# ======================================================================================================================
+class Handshake(object):
+    '''Client half of the per-hop X25519 handshake.
+
+    Attributes:
+        private (X25519PrivateKey): Ephemeral private key used for this hop only.
+        public (bytes): Raw public key sent to the relay inside an RSA-encrypted `MSG_CREATE` layer.
+
+    '''
+    def __init__(self) -> None:
+        self.private: X25519PrivateKey = X25519PrivateKey.generate()
+        self.public:  bytes            = self.private.public_key().public_bytes(encoding=serialization.Encoding.Raw,
+                                                                                format=serialization.PublicFormat.Raw)
+
+
+    def complete(self, reply: bytes) -> CircuitHop:
+        '''Finish the handshake using the body of a `MSG_CREATED` reply.
+
+        Parameters:
+            reply (bytes): Relay's ephemeral public key followed by its key confirmation value.
+
+        Returns:
+            The cipher state for the new hop.
+
+        Raises:
+            ValueError: The relay could not prove it derived the same keys.
+
+        '''
+        relay_pub = bytes(reply[:HANDSHAKE_SIZE])
+        shared = self.private.exchange(X25519PublicKey.from_public_bytes(relay_pub))
+        forward_key, backward_key, confirm = derive_keys(shared, self.public, relay_pub)
+        if(not hmac.compare_digest(confirm, bytes(reply[HANDSHAKE_SIZE:(HANDSHAKE_SIZE + KEY_SIZE)]))):
+            raise(ValueError("Relay failed circuit key confirmation"))
+        return CircuitHop(forward_key, backward_key)
+
+
+def respond(client_pub: bytes) -> Tuple[bytes, CircuitHop]:
+    '''Relay half of the per-hop X25519 handshake.
+
+    Parameters:
+        client_pub (bytes): Raw ephemeral public key recovered from the client's `MSG_CREATE` layer.
+
+    Returns:
+        The body of the `MSG_CREATED` reply and the cipher state for the new hop.
+
+    '''
+    reply, forward_key, backward_key = respond_keys(client_pub)
+    return reply, CircuitHop(forward_key, backward_key)
+
+
+def respond_keys(client_pub: bytes) -> Tuple[bytes, bytes, bytes]:
+    '''Relay half of the per-hop X25519 handshake, giving the keys rather than the cipher state so the handshake can
+       be completed in another process.
+
+    Parameters:
+        client_pub (bytes): Raw ephemeral public key recovered from the client's `MSG_CREATE` layer.
+
+    Returns:
+        The body of the `MSG_CREATED` reply, and the forward and backward keys of the new hop.
+
+    '''
+    private = X25519PrivateKey.generate()
+    relay_pub = private.public_key().public_bytes(encoding=serialization.Encoding.Raw,
+                                                  format=serialization.PublicFormat.Raw)
+    shared = private.exchange(X25519PublicKey.from_public_bytes(bytes(client_pub)))
+    forward_key, backward_key, confirm = derive_keys(shared, bytes(client_pub), relay_pub)
+    return relay_pub + confirm, forward_key, backward_key
+
+
+
+# ======================================================================================================================
+class FlowControl(object):
+    '''Sliding windows kept by either end of a circuit, in the style of Tor's SENDME cells.
+
+    Each end may only send while both the circuit's window and the stream's window are open. The receiving end
+    answers every increment of packets it delivers with a `MSG_SENDME`, which reopens the sender's window by the same
+    amount, so at most one window of packets per circuit is ever buffered along the route.
+
+    Attributes:
+        package (int): Packets this end may still send on the circuit.
+        deliver (int): Packets this end will receive on the circuit before it owes a `MSG_SENDME`.
+        stream_package (Dict[int, int]): Packets this end may still send on each stream it has used.
+        stream_deliver (Dict[int, int]): Packets this end will receive on each stream before it owes a `MSG_SENDME`.
+
+    '''
+    def __init__(self) -> None:
+        self.package:        int            = CIRCUIT_WINDOW
+        self.deliver:        int            = CIRCUIT_WINDOW
+        self.stream_package: Dict[int, int] = dict()
+        self.stream_deliver: Dict[int, int] = dict()
+
+
+    def can_package(self, packet: Packet) -> bool:
+        '''Check whether a packet may be sent now.
+
+        Parameters:
+            packet (Messages.Packet): Packet about to be sent.
+
+        Returns:
+            `True` if the packet bypasses flow control or both of its windows are open.
+
+        '''
+        if(packet.preamble in UNCOUNTED):
+            return True
+        if(self.package <= 0):
+            return False
+        return (packet.stream_id == 0) or (self.stream_package.get(packet.stream_id, STREAM_WINDOW) > 0)
+
+
+    def packaged(self, packet: Packet) -> None:
+        '''Record that a packet was sent.
+
+        Parameters:
+            packet (Messages.Packet): Packet that was sent.
+
+        '''
+        if(packet.preamble in UNCOUNTED):
+            return
+        self.package -= 1
+        if(packet.stream_id != 0):
+            self.stream_package[packet.stream_id] = self.stream_package.get(packet.stream_id, STREAM_WINDOW) - 1
+
+
+    def delivered(self, packet: Packet) -> List[int]:
+        '''Record that a packet was received.
+
+        Parameters:
+            packet (Messages.Packet): Packet that was received.
+
+        Returns:
+            The stream IDs a `MSG_SENDME` is now owed for, with 0 standing for the circuit itself.
+
+        '''
+        owed = list()
+        if(packet.preamble in UNCOUNTED):
+            return owed
+        self.deliver -= 1
+        if(self.deliver <= CIRCUIT_WINDOW - CIRCUIT_INCREMENT):
+            self.deliver += CIRCUIT_INCREMENT
+            owed.append(0)
+        if(packet.stream_id != 0):
+            window = self.stream_deliver.get(packet.stream_id, STREAM_WINDOW) - 1
+            if(window <= STREAM_WINDOW - STREAM_INCREMENT):
+                window += STREAM_INCREMENT
+                owed.append(packet.stream_id)
+            self.stream_deliver[packet.stream_id] = window
+        return owed
+
+
+    def sendme(self, packet: Packet) -> None:
+        '''Reopen a window after the other end acknowledged an increment of packets.
+
+        Parameters:
+            packet (Messages.Packet): Received `MSG_SENDME`, whose stream ID is 0 for the circuit window.
+
+        '''
+        if(packet.stream_id == 0):
+            self.package += CIRCUIT_INCREMENT
+        else:
+            self.stream_package[packet.stream_id] = (self.stream_package.get(packet.stream_id, STREAM_WINDOW)
+                                                     + STREAM_INCREMENT)
+
+
+    def end_stream(self, stream_id: int) -> None:
+        '''Forget the windows of a stream that will not be used again.
+
+        Parameters:
+            stream_id (int): Stream that has finished.
+
+        '''
+        self.stream_package.pop(stream_id, None)
+        self.stream_deliver.pop(stream_id, None)
+
+
+
+# ======================================================================================================================
+@dataclass
+class RelayCircuit:
+    '''Relay-side state for one circuit passing through this node.
+
+    Attributes:
+        hop (CircuitHop): Keys negotiated with the client that built the circuit.
+        prev_conn (Link): Link facing the client.
+        prev_id (int): Circuit ID used on `prev_conn`.
+        next_conn (Link): Link facing the next hop, or `None` if this node is the last hop.
+        next_id (int): Circuit ID used on `next_conn`.
+        inbound (bytearray): Fragments of a cell body received so far when running with fixed-size cells.
+        flow (FlowControl): Windows kept with the client while this node is the last hop.
+        outbox (Deque[Packet]): Replies held back until the client reopens a window, at most one window long.
+        writable (asyncio.Event): Set whenever the client reopens a window or the circuit is torn down, waking any
+                                  file being sent along the circuit.
+        sinks (Dict[int, FileSink]): Files being received from the client, keyed by stream ID.
+
+    '''
+    hop:       CircuitHop          = None
+    prev_conn: Link                = None
+    prev_id:   int                 = 0
+    next_conn: Link                = None
+    next_id:   int                 = 0
+    inbound:   bytearray           = None
+    flow:      FlowControl         = field(default_factory=FlowControl)
+    outbox:    Deque[Packet]       = field(default_factory=deque)
+    writable:  asyncio.Event       = field(default_factory=asyncio.Event)
+    sinks:     Dict[int, FileSink] = field(default_factory=dict)
+
+
+    def collect(self, fragment: bytes, total: int) -> Union[bytes, None]:
+        '''Gather the decrypted fragments of a cell body that was split across fixed-size cells.
+
+        Parameters:
+            fragment (bytes): Next decrypted piece of the body.
+            total (int): Size of the whole body, or 0 if it was not fragmented.
+
+        Returns:
+            The whole body once every fragment has arrived, otherwise `None`.
+
+        '''
+        if((self.inbound is None) and (len(fragment) >= total)):
+            return fragment
+        if(self.inbound is None):
+            self.inbound = bytearray()
+        self.inbound += fragment
+        if(len(self.inbound) < total):
+            return None
+        body, self.inbound = self.inbound, None
+        return body
+
+
+    def close_transfers(self) -> None:
+        '''Abandon every file transfer on the circuit once it has been torn down.
+
+        '''
+        for sink in self.sinks.values():
+            sink.abort()
+        self.sinks.clear()
+        self.writable.set()
+
+
+
+class CircuitTable(object):
+    '''Table of every circuit passing through the relay, keyed by the link and circuit ID they arrive on.
+
+    Attributes:
+        circuits (Dict[Tuple[Link, int], RelayCircuit]): Circuits indexed by either of their two ends.
+
+    '''
+    def __init__(self) -> None:
+        self.circuits: Dict[Tuple[Link, int], RelayCircuit] = dict()
+
+
+    def add(self, circuit: RelayCircuit) -> None:
+        '''Register a circuit under its client-facing end.
+
+        Parameters:
+            circuit (RelayCircuit): Newly created circuit.
+
+        '''
+        self.circuits[(circuit.prev_conn, circuit.prev_id)] = circuit
+
+
+    def new_circ_id(self, conn: Link) -> int:
+        '''Pick a circuit ID that is not yet in use on a link, as many circuits now share each one.
+
+        Parameters:
+            conn (Link): Link the new circuit will use.
+
+        Returns:
+            An unused 32-bit circuit ID.
+
+        '''
+        circ_id = new_circ_id()
+        while ((conn, circ_id) in self.circuits) or (circ_id in conn.pending):
+            circ_id = new_circ_id()
+        return circ_id
+
+
+    def extend(self, circuit: RelayCircuit, conn: Link, circ_id: int) -> None:
+        '''Attach the next hop to a circuit and register it under that end as well.
+
+        Parameters:
+            circuit (RelayCircuit): Circuit being extended.
+            conn (Link): Link to the next hop.
+            circ_id (int): Circuit ID used on `conn`.
+
+        '''
+        circuit.next_conn = conn
+        circuit.next_id = circ_id
+        self.circuits[(conn, circ_id)] = circuit
+
+
+    def get(self, conn: Link, circ_id: int) -> Union[RelayCircuit, None]:
+        '''Find the circuit a packet belongs to.
+
+        Parameters:
+            conn (Link): Link the packet arrived on.
+            circ_id (int): Circuit ID carried in the packet header.
+
+        Returns:
+            The matching circuit, or `None` if it is unknown.
+
+        '''
+        return self.circuits.get((conn, circ_id))
+
+
+    def remove(self, circuit: RelayCircuit) -> None:
+        '''Forget both ends of a circuit.
+
+        Parameters:
+            circuit (RelayCircuit): Circuit being torn down.
+
+        '''
+        self.circuits.pop((circuit.prev_conn, circuit.prev_id), None)
+        if(circuit.next_conn is not None):
+            self.circuits.pop((circuit.next_conn, circuit.next_id), None)
+        circuit.close_transfers()
+
+
+    def drop_link(self, conn: Link) -> List[RelayCircuit]:
+        '''Remove every circuit that uses a link which has closed.
+
+        Parameters:
+            conn (Link): Link that is no longer usable.
+
+        Returns:
+            The circuits that were removed.
+
+        '''
+        dropped = [circuit for (link, _), circuit in self.circuits.items() if link is conn]
+        for circuit in dropped:
+            self.remove(circuit)
+        return dropped
+
+
+    def __iter__(self) -> Iterator[RelayCircuit]:
+        # Each circuit is listed once under its client-facing end
+        for (conn, circ_id), circuit in self.circuits.items():
+            if((conn is circuit.prev_conn) and (circ_id == circuit.prev_id)):
+                yield circuit
+
+
+
+# ======================================================================================================================
+class Circuit(object):
+    '''Client-side view of a circuit built through one or more relays.
+
+    Attributes:
+        circ_id (int): Circuit ID used on the connection to the first hop.
+        conn (PooledConnection): Connection to the first hop, checked out for the life of the circuit.
+        route (List[PeerNode]): Relays the circuit passes through, in order.
+        hops (List[CircuitHop]): Cipher state for each established hop, in the same order as `route`.
+        last_stream (int): Most recently allocated stream ID.
+        flow (FlowControl): Windows kept with the last hop.
+        inbox (Deque[Packet]): Packets that arrived while `send` was waiting for a window to reopen.
+        cell (Union[Packet, None]): Header shared by every `MSG_RELAY` cell sent to the first hop, once there is one.
+
+    '''
+    def __init__(self, circ_id: int, conn: PooledConnection) -> None:
+        self.circ_id:     int                 = circ_id
+        self.conn:        PooledConnection    = conn
+        self.route:       List[PeerNode]      = list()
+        self.hops:        List[CircuitHop]    = list()
+        self.last_stream: int                 = 0
+        self.flow:        FlowControl         = FlowControl()
+        self.inbox:       Deque[Packet]       = deque()
+        self.cell:        Union[Packet, None] = None
+
+
+    def add_hop(self, peer: PeerNode, hop: CircuitHop) -> None:
+        '''Record a newly established hop at the end of the circuit.
+
+        Parameters:
+            peer (PeerNode): Relay that was added.
+            hop (CircuitHop): Keys negotiated with the relay.
+
+        '''
+        self.route.append(peer)
+        self.hops.append(hop)
+        if(self.cell is None):
+            self.cell = Packet(Messages.Preambles.MSG_RELAY.value, peer.ip, peer.port, 0, b'', self.circ_id)
+
+
+    def open_stream(self) -> int:
+        '''Allocate a stream ID so several independent exchanges can share the circuit.
+
+        Returns:
+            A stream ID between 1 and 65535, reused only after every other one has been handed out.
+
+        '''
+        self.last_stream = (self.last_stream % 0xFFFF) + 1
+        return self.last_stream
+
+
+    def close_stream(self, stream_id: int) -> None:
+        '''Release the flow control state of a stream that is finished with.
+
+        Parameters:
+            stream_id (int): Stream allocated by `open_stream`.
+
+        '''
+        self.flow.end_stream(stream_id)
+
+
+    def wrap(self, packet: Packet) -> bytearray:
+        '''Onion-encrypt a packet for the last hop of the circuit.
+
+        Parameters:
+            packet (Messages.Packet): Packet to be delivered to the last hop.
+
+        Returns:
+            Cell body with one layer per hop.
+
+        '''
+        data = bytearray(Messages.HEADER.size + len(packet.raw_body) + LAYER_SLACK)
+        self.wrap_into(packet, data, 0)
+        del data[-LAYER_SLACK:]
+        return data
+
+
+    def wrap_into(self, packet: Packet, buffer: bytearray, offset: int) -> None:
+        '''Onion-encrypt a packet directly into an outgoing buffer, applying every layer in place so the packet is
+           written once however many hops the circuit has.
+
+        Parameters:
+            packet (Messages.Packet): Packet to be delivered to the last hop.
+            buffer (bytearray): Destination with room for the packed packet plus `LAYER_SLACK` bytes at `offset`.
+            offset (int): Position in `buffer` the cell body starts at.
+
+        '''
+        size = packet.pack_into(buffer, offset)
+        with memoryview(buffer) as view:
+            data = view[offset:(offset + size)]
+            if(size < IN_PLACE_MIN):
+                for hop in reversed(self.hops):
+                    data[:] = hop.forward.update(data)
+            else:
+                out = view[offset:]
+                for hop in reversed(self.hops):
+                    hop.forward.update_into(data, out)
+
+
+    def unwrap(self, data: bytes) -> Packet:
+        '''Remove every layer from a cell sent back along the circuit.
+
+        Parameters:
+            data (bytes): Cell body received from the first hop.
+
+        Returns:
+            The packet sent by the last hop.
+
+        '''
+        for hop in self.hops:
+            data = hop.backward_layer(data)
+        packet = Packet()
+        packet.unpack(data)
+        return packet
+
+
+    def send(self, packet: Packet) -> None:
+        '''Send a packet to the last hop of the circuit, first waiting for the circuit's and stream's windows to allow
+           it.
+
+        Parameters:
+            packet (Messages.Packet): Packet to be delivered.
+
+        Raises:
+            ConnectionError: The circuit was torn down while waiting.
+
+        '''
+        self.send_many((packet,))
+
+
+    def send_many(self, packets: Iterable[Packet]) -> None:
+        '''Send several packets to the last hop of the circuit, layering each one into its own preallocated cell and
+           writing them to the first hop together.
+
+        Parameters:
+            packets (Iterable[Messages.Packet]): Packets to be delivered, in order.
+
+        Raises:
+            ConnectionError: The circuit was torn down while waiting for a window to reopen.
+
+        '''
+        batch = list()
+        for packet in packets:
+            if(not self.flow.can_package(packet)):
+                # The last hop cannot reopen the window for packets it has not been sent yet
+                self._write(batch)
+                while not self.flow.can_package(packet):
+                    reply = self._receive()
+                    if(reply is not None):
+                        self.inbox.append(reply)
+            self.flow.packaged(packet)
+            batch.append(self._encode(packet))
+        self._write(batch)
+
+
+    def _encode(self, packet: Packet) -> bytearray:
+        '''Layer a packet and encode it for the first hop, writing the layers straight into the outgoing frame when
+           the wire format allows it.
+
+        '''
+        codec = self.conn.pool.codec
+        if(codec.fixed):
+            return codec.encode(Packet(Messages.Preambles.MSG_RELAY.value, self.route[0].ip, self.route[0].port, 0,
+                                       self.wrap(packet), self.circ_id))
+        frame, offset = codec.reserve(self.cell, Messages.HEADER.size + len(packet.raw_body), LAYER_SLACK)
+        self.wrap_into(packet, frame, offset)
+        del frame[-LAYER_SLACK:]
+        return frame
+
+
+    def _write(self, batch: List[bytearray]) -> None:
+        '''Write a batch of encoded cells to the first hop in a single call and empty it.
+
+        '''
+        if(len(batch) == 1):
+            self.conn.write(batch[0])
+        elif(batch):
+            self.conn.write(b''.join(batch))
+        batch.clear()
+
+
+    def _transmit(self, packet: Packet) -> None:
+        '''Layer a packet and write it to the first hop, regardless of flow control.
+
+        '''
+        self.conn.write(self._encode(packet))
+
+
+    def recv(self) -> Packet:
+        '''Wait for the next packet sent back by the last hop of the circuit.
+
+        Returns:
+            The decrypted packet.
+
+        Raises:
+            ConnectionError: The circuit was torn down by one of its relays.
+
+        '''
+        while len(self.inbox) == 0:
+            reply = self._receive()
+            if(reply is not None):
+                return reply
+        return self.inbox.popleft()
+
+
+    def _receive(self) -> Union[Packet, None]:
+        '''Read and decrypt the next cell on the circuit, handling flow control on the way.
+
+        Returns:
+            The packet carried, or `None` if it was a `MSG_SENDME` meant for this end.
+
+        Raises:
+            ConnectionError: The circuit was torn down by one of its relays.
+
+        '''
+        cell = self.conn.recv(self.circ_id)
+        if(cell.preamble == Messages.Preambles.MSG_DESTROY.value):
+            raise(ConnectionError("Circuit was destroyed"))
+        packet = self.unwrap(cell.raw_body)
+        if(packet.preamble == Messages.Preambles.MSG_SENDME.value):
+            self.flow.sendme(packet)
+            return None
+        for stream_id in self.flow.delivered(packet):
+            self._transmit(Packet(Messages.Preambles.MSG_SENDME.value, '', 0, 0, b'', _stream_id=stream_id))
+        return packet
+
+
+    def close(self) -> None:
+        '''Tear down the circuit and return the connection to the first hop to its pool.
+
+        '''
+        try:
+            cell = Packet(Messages.Preambles.MSG_DESTROY.value, self.route[0].ip, self.route[0].port, 0, b'',
+                          self.circ_id)
+            self.conn.send(cell)
+        except OSError:
+            self.conn.release(False)
+            return
+        self.conn.release()
@@ -0,0 +1,163 @@
+from Circuit import Circuit
+import Log
+
+from bisect import insort
+from collections import deque
+from operator import itemgetter
+import random
+import threading
+from time import monotonic
+from typing import Callable, Deque, List, Tuple, Union
+
+
+# Builder parameters
+RETRY_DELAY     = 1.0  # Seconds the builder waits after a failed build, doubling after each further failure
+MAX_RETRY_DELAY = 30.0 # Longest the builder waits between attempts
+
+
+# ======================================================================================================================
+class CircuitPool(object):
+    '''Keeps a number of circuits built ahead of time so a session starts without waiting on route setup.
+
+    A background thread tops the pool up and retires circuits once they reach an age picked at random between the
+    minimum and maximum, so a client does not keep using the same routes for long.
+
+    Attributes:
+        build (Callable[[], Circuit]): Selects a route and builds a circuit along it.
+        size (int): Number of circuits kept ready.
+        min_age (float): Shortest time, in seconds, a circuit is kept before being replaced.
+        max_age (float): Longest time, in seconds, a circuit is kept before being replaced.
+        ready (Deque[Tuple[float, Circuit]]): Built circuits and the monotonic time each one expires, in order of
+                                              expiry.
+        cond (threading.Condition): Guards `ready` and wakes the builder when a circuit is taken. Circuits are only
+                                    ever closed with it released, as closing one talks to every hop.
+        thread (Union[threading.Thread, None]): Background builder, if started.
+        running (bool): Whether the builder should keep going.
+
+    '''
+    def __init__(self, build: Callable[[], Circuit], size: int, min_age: float, max_age: float) -> None:
+        self.build:   Callable[[], Circuit]         = build
+        self.size:    int                           = size
+        self.min_age: float                         = min_age
+        self.max_age: float                         = max(min_age, max_age)
+        self.ready:   Deque[Tuple[float, Circuit]]  = deque()
+        self.cond:    threading.Condition           = threading.Condition()
+        self.thread:  Union[threading.Thread, None] = None
+        self.running: bool                          = False
+
+
+    def start(self) -> None:
+        '''Start building circuits in the background.
+
+        '''
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+
+    def stop(self) -> None:
+        '''Stop the builder and tear down every circuit that was never handed out.
+
+        '''
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if(self.thread is not None):
+            self.thread.join()
+        with self.cond:
+            unused = [circuit for _, circuit in self.ready]
+            self.ready.clear()
+        for circuit in unused:
+            circuit.close()
+
+
+    def get(self, timeout: Union[float, None] = None) -> Circuit:
+        '''Take a ready circuit, waiting for the builder if none is available.
+
+        Parameters:
+            timeout (Union[float, None]): Seconds to wait for a circuit, or `None` to wait indefinitely.
+
+        Returns:
+            A circuit that now belongs to the caller.
+
+        Raises:
+            TimeoutError: No circuit became ready in time.
+
+        '''
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            with self.cond:
+                expired = self._retire(monotonic())
+                if(len(expired) == 0):
+                    if(self.ready):
+                        # The circuit with the longest life left suits a session best
+                        circuit = self.ready.pop()[1]
+                        self.cond.notify_all()
+                        return circuit
+                    remaining = None if deadline is None else deadline - monotonic()
+                    if((remaining is not None) and (remaining <= 0)):
+                        raise(TimeoutError("No circuit became ready in time"))
+                    self.cond.wait(remaining)
+                    continue
+            for circuit in expired:
+                circuit.close()
+
+
+    def run(self) -> None:
+        '''Keep the pool full until stopped. Runs on the builder thread.
+
+        '''
+        delay = RETRY_DELAY
+        while True:
+            with self.cond:
+                expired = self._retire(monotonic())
+                while self.running and (len(self.ready) >= self.size):
+                    # Sleep until a circuit is taken or the oldest one is due to be replaced
+                    self.cond.wait(max(0.0, self.ready[0][0] - monotonic()))
+                    expired.extend(self._retire(monotonic()))
+                running = self.running
+            for circuit in expired:
+                circuit.close()
+            if(not running):
+                return
+            # Build outside the lock so callers can take circuits in the meantime
+            try:
+                circuit = self.build()
+            except Exception as e:
+                Log.client.warning("Unable to prebuild circuit: %s", e)
+                with self.cond:
+                    self.cond.wait(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+                continue
+            delay = RETRY_DELAY
+            with self.cond:
+                running = self.running
+                if(running):
+                    # Ages are spread out so the circuits are not all replaced at once
+                    insort(self.ready, (monotonic() + random.uniform(self.min_age, self.max_age), circuit),
+                           key=itemgetter(0))
+                    self.cond.notify_all()
+            if(not running):
+                circuit.close()
+                return
+
+
+    def _retire(self, now: float) -> List[Circuit]:
+        '''Take circuits that have reached their age out of the pool. The caller must hold `cond`, and close them
+           once it has released it.
+
+        Parameters:
+            now (float): Current monotonic time.
+
+        Returns:
+            The circuits to be torn down.
+
+        '''
+        expired = list()
+        while self.ready and (self.ready[0][0] <= now):
+            expired.append(self.ready.popleft()[1])
+        return expired
+
+
+    def __len__(self) -> int:
+        return len(self.ready)
@@ -0,0 +1,315 @@
+import Messages
+from PeerNode import PeerNode
+
+from contextlib import contextmanager
+import socket
+import threading
+from time import monotonic, sleep
+from typing import Dict, Iterator, List, Union
+
+
+# Pool defaults
+MAX_PER_PEER    = 4    # Connections open to a single peer at once, idle or checked out
+IDLE_TIMEOUT    = 60.0 # Seconds an unused connection is kept before it is closed
+KEEPALIVE       = 15.0 # Seconds of silence before TCP keepalive probes are sent on an idle connection
+CONNECT_TIMEOUT = 5.0  # Seconds allowed for a single connection attempt
+RETRIES         = 3    # Connection attempts made before giving up on a peer
+BACKOFF         = 0.25 # Seconds waited after the first failed attempt, doubling after each one
+
+
+# ======================================================================================================================
+class PooledConnection(object):
+    '''Outgoing connection to a peer, checked out from a `ConnectionPool` by one user at a time.
+
+    Attributes:
+        pool (ConnectionPool): Pool the connection belongs to.
+        peer (PeerNode): Peer at the other end.
+        sock (socket.socket): The connected socket.
+        decoder (Union[Messages.PacketDecoder, Messages.CellDecoder]): Decoder for packets arriving on the socket,
+                                                                       kept with it so no buffered bytes are lost
+                                                                       between users.
+        last_used (float): Monotonic time the connection was last returned to the pool.
+
+    '''
+    def __init__(self, pool: "ConnectionPool", peer: PeerNode, sock: socket.socket) -> None:
+        self.pool:      ConnectionPool                                      = pool
+        self.peer:      PeerNode                                            = peer
+        self.sock:      socket.socket                                       = sock
+        self.decoder:   Union[Messages.PacketDecoder, Messages.CellDecoder] = pool.codec.decoder()
+        self.last_used: float                                               = monotonic()
+
+
+    def send(self, packet: Messages.Packet) -> None:
+        '''Encode and send a packet.
+
+        Parameters:
+            packet (Messages.Packet): Packet to be sent.
+
+        '''
+        self.sock.sendall(self.pool.codec.encode(packet))
+
+
+    def write(self, data: Union[bytes, bytearray]) -> None:
+        '''Send bytes that are already encoded in the pool's wire format.
+
+        Parameters:
+            data (Union[bytes, bytearray]): Encoded frames or cells.
+
+        '''
+        self.sock.sendall(data)
+
+
+    def recv(self, circ_id: int = 0) -> Messages.Packet:
+        '''Wait for the next packet on the connection that belongs to a given circuit, or to none.
+
+        Cells of circuits that used the connection before it was returned to the pool may still arrive after they
+        were torn down, so every packet for another circuit is dropped on the way.
+
+        Parameters:
+            circ_id (int): Circuit the packet is expected on, or 0 for a reply outside of any circuit.
+
+        Returns:
+            The received packet.
+
+        Raises:
+            ConnectionError: The peer closed the connection.
+
+        '''
+        packet = Messages.recv_packet(self.sock, self.decoder)
+        while packet.circ_id != circ_id:
+            packet = Messages.recv_packet(self.sock, self.decoder)
+        return packet
+
+
+    def alive(self) -> bool:
+        '''Check, without blocking, that the peer has not closed the connection while it sat idle.
+
+        Returns:
+            `True` if the connection still looks usable.
+
+        '''
+        try:
+            self.sock.setblocking(False)
+            try:
+                return self.sock.recv(1, socket.MSG_PEEK) != b''
+            finally:
+                self.sock.setblocking(True)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+
+
+    def release(self, reuse: bool = True) -> None:
+        '''Hand the connection back to its pool.
+
+        Parameters:
+            reuse (bool): Whether the connection is still in a known state and may be given to another user.
+
+        '''
+        self.pool.release(self, reuse)
+
+
+    def close(self) -> None:
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+
+# ======================================================================================================================
+class ConnectionPool(object):
+    '''Thread-safe pool of warm outgoing connections, keyed by peer.
+
+    Attributes:
+        codec (Messages.Codec): Wire format used on every connection.
+        max_per_peer (int): Connections open to a single peer at once.
+        idle_timeout (float): Seconds an unused connection is kept.
+        keepalive (float): Seconds of silence before TCP keepalive probes start.
+        retries (int): Connection attempts made before giving up.
+        backoff (float): Delay after the first failed attempt, doubled after each further one.
+        idle (Dict[PeerNode, List[PooledConnection]]): Connections ready to be checked out, most recent last.
+        open (Dict[PeerNode, int]): Connections counted against each peer's limit, idle or checked out.
+        cond (threading.Condition): Guards the tables above and wakes callers waiting for a free slot to any peer.
+
+    '''
+    def __init__(self, codec: Messages.Codec, max_per_peer: int = MAX_PER_PEER, idle_timeout: float = IDLE_TIMEOUT,
+                 keepalive: float = KEEPALIVE, retries: int = RETRIES, backoff: float = BACKOFF) -> None:
+        self.codec:        Messages.Codec                         = codec
+        self.max_per_peer: int                                    = max_per_peer
+        self.idle_timeout: float                                  = idle_timeout
+        self.keepalive:    float                                  = keepalive
+        self.retries:      int                                    = retries
+        self.backoff:      float                                  = backoff
+        self.idle:         Dict[PeerNode, List[PooledConnection]] = dict()
+        self.open:         Dict[PeerNode, int]                    = dict()
+        self.cond:         threading.Condition                    = threading.Condition()
+
+
+    def acquire(self, peer: PeerNode, timeout: Union[float, None] = None,
+                retries: Union[int, None] = None) -> PooledConnection:
+        '''Check out a connection to a peer, reusing an idle one when possible.
+
+        Parameters:
+            peer (PeerNode): Peer to be reached.
+            timeout (Union[float, None]): Seconds to wait for a free slot when the peer's limit is reached, or
+                                          `None` to wait indefinitely.
+            retries (Union[int, None]): Connection attempts made if a new connection is needed, or `None` for the
+                                        pool's own setting.
+
+        Returns:
+            A connection owned by the caller until it is released.
+
+        Raises:
+            TimeoutError: No slot became free in time.
+            OSError: Every connection attempt failed.
+
+        '''
+        deadline = None if timeout is None else monotonic() + timeout
+        with self.cond:
+            self._evict(monotonic())
+            while True:
+                idle = self.idle.get(peer)
+                while idle:
+                    conn = idle.pop()
+                    if(conn.alive()):
+                        return conn
+                    self._discard(conn)
+                if(self.open.get(peer, 0) < self.max_per_peer):
+                    self.open[peer] = self.open.get(peer, 0) + 1
+                    break
+                remaining = None if deadline is None else deadline - monotonic()
+                if((remaining is not None) and (remaining <= 0)):
+                    raise(TimeoutError(f"No connection to {peer} became free"))
+                self.cond.wait(remaining)
+        # Connect outside the lock so a slow peer does not hold up every other one
+        try:
+            return PooledConnection(self, peer, self._connect(peer, self.retries if retries is None else retries))
+        except OSError:
+            with self.cond:
+                self.open[peer] -= 1
+                self.cond.notify_all()
+            raise
+
+
+    def release(self, conn: PooledConnection, reuse: bool = True) -> None:
+        '''Return a checked out connection, keeping it warm for the next user.
+
+        Parameters:
+            conn (PooledConnection): Connection being returned.
+            reuse (bool): Whether the connection may be given to another user, otherwise it is closed.
+
+        '''
+        with self.cond:
+            if(reuse and (conn.sock.fileno() != -1)):
+                conn.last_used = monotonic()
+                self.idle.setdefault(conn.peer, list()).append(conn)
+            else:
+                self._discard(conn)
+            # Every peer shares the condition, so waking a single caller could wake one waiting on another peer
+            self.cond.notify_all()
+
+
+    @contextmanager
+    def connection(self, peer: PeerNode, timeout: Union[float, None] = None,
+                   retries: Union[int, None] = None) -> Iterator[PooledConnection]:
+        '''Check out a connection for the duration of a `with` block, closing it instead if the block fails.
+
+        Parameters:
+            peer (PeerNode): Peer to be reached.
+            timeout (Union[float, None]): Seconds to wait for a free slot.
+            retries (Union[int, None]): Connection attempts made if a new connection is needed.
+
+        '''
+        conn = self.acquire(peer, timeout, retries)
+        try:
+            yield conn
+        except BaseException:
+            conn.release(False)
+            raise
+        conn.release()
+
+
+    def saturated(self, peer: PeerNode) -> bool:
+        '''Check whether every connection a peer is allowed is checked out, such as by circuits running through it.
+
+        Parameters:
+            peer (PeerNode): Peer to be checked.
+
+        Returns:
+            `True` if acquiring a connection to the peer would have to wait for one to be released.
+
+        '''
+        with self.cond:
+            return (self.open.get(peer, 0) >= self.max_per_peer) and (not self.idle.get(peer))
+
+
+    def close(self) -> None:
+        '''Close every idle connection. Connections still checked out are closed when released.
+
+        '''
+        with self.cond:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+                    self.open[conn.peer] -= 1
+            self.idle.clear()
+            self.cond.notify_all()
+
+
+    def _connect(self, peer: PeerNode, retries: int) -> socket.socket:
+        '''Open a new connection, retrying with exponential backoff.
+
+        Parameters:
+            peer (PeerNode): Peer to be reached.
+            retries (int): Connection attempts made before giving up.
+
+        Returns:
+            The connected socket, with TCP keepalive enabled.
+
+        Raises:
+            OSError: The last connection attempt failed.
+
+        '''
+        delay = self.backoff
+        for attempt in range(0, max(1, retries)):
+            try:
+                sock = socket.create_connection((peer.ip, peer.port), timeout=CONNECT_TIMEOUT)
+                break
+            except OSError:
+                if(attempt >= retries - 1):
+                    raise
+                sleep(delay)
+                delay *= 2
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if(hasattr(socket, "TCP_KEEPIDLE")): # Probe timings are not configurable on every platform
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(self.keepalive)))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, int(self.keepalive / 3)))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+        return sock
+
+
+    def _evict(self, now: float) -> None:
+        '''Close idle connections that have gone unused for too long. The caller must hold `cond`.
+
+        Parameters:
+            now (float): Current monotonic time.
+
+        '''
+        for peer, conns in self.idle.items():
+            while conns and (now - conns[0].last_used > self.idle_timeout):
+                self._discard(conns.pop(0))
+
+
+    def _discard(self, conn: PooledConnection) -> None:
+        '''Close a connection and free its slot. The caller must hold `cond`.
+
+        Parameters:
+            conn (PooledConnection): Connection that will not be used again.
+
+        '''
+        conn.close()
+        self.open[conn.peer] -= 1
@@ -0,0 +1,288 @@
+import KeyCache
+from PeerNode import PeerNode, pack_addr
+
+from collections import deque
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+import os
+import socket
+from struct import Struct
+import threading
+from typing import Deque, Dict, List, Tuple, Union
+
+
+# Wire format of `MSG_PEERS` bodies
+REQUEST         = Struct("!8sQ")     # Directory ID and version the requester already holds
+ANNOUNCE        = Struct("!H32s")    # Port and key fingerprint of a relay announcing itself, after a request
+DELTA_HEADER    = Struct("!8sQQI")   # Directory ID, version the delta starts from and brings the reader to, entries
+ENTRY           = Struct("!B4sH32s") # Operation, IPv4 address, port and key fingerprint of one relay
+OP_REMOVE       = 0
+OP_ADD          = 1
+IDENT_SIZE      = 8
+# Directory parameters
+HISTORY_SIZE    = 4096 # Changes kept to answer delta requests, readers further behind receive the whole directory
+GOSSIP_INTERVAL = 30.0 # Seconds between a relay's pulls from a random neighbour
+GOSSIP_TIMEOUT  = 5.0  # Seconds a neighbour has to answer a pull
+GOSSIP_FAILURES = 3    # Pulls in a row a relay may fail before it is dropped from the directory
+SYNC_INTERVAL   = 60.0 # Seconds between a client's pulls from the core nodes
+
+
+def key_fingerprint(key: rsa.RSAPublicKey) -> bytes:
+    '''Compute the fingerprint a relay is listed under, the same one its key is stored with in the key cache.
+
+    Parameters:
+        key (rsa.RSAPublicKey): Public key of the relay.
+
+    Returns:
+        The SHA-256 digest of the key's DER encoding.
+
+    '''
+    return KeyCache.fingerprint(key.public_bytes(encoding=serialization.Encoding.DER,
+                                                 format=serialization.PublicFormat.SubjectPublicKeyInfo))
+
+
+def unpack_addr(addr: int) -> Tuple[str, int]:
+    '''Turn an address packed by `PeerNode.pack_addr` back into its IPv4 address and port.
+
+    '''
+    return socket.inet_ntoa((addr >> 16).to_bytes(4, "big")), addr & 0xFFFF
+
+
+# ======================================================================================================================
+class Directory(object):
+    '''Versioned list of the relays a node knows of, exchanged with `MSG_PEERS` as deltas so a reader only receives
+       what changed since the version it last read.
+
+    Every change bumps the version and is kept in a bounded history. A request names the directory it last read
+    from and the version it reached, and is answered with the latest change to every relay since then, or with the
+    whole directory if the request names another directory or a version that has left the history.
+
+    Attributes:
+        ident (bytes): Random identifier of this directory, telling readers when a node has restarted.
+        version (int): Number of changes made so far.
+        entries (Dict[int, bytes]): Key fingerprint of every listed relay, keyed by packed address.
+        history (Deque[Tuple[int, int, int, bytes]]): Version, operation, packed address and fingerprint of the most
+                                                      recent changes, oldest first.
+        sources (Dict[str, Tuple[bytes, int]]): Directory ID and version read from each node, keyed by its address.
+        lock (threading.Lock): Guards everything above, as the client and server components share the directory.
+
+    Note:
+        Relays are listed by IPv4 address and port, so an entry takes a fixed 39 bytes on the wire.
+
+    '''
+    def __init__(self, history_size: int = HISTORY_SIZE) -> None:
+        self.ident:   bytes                              = os.urandom(IDENT_SIZE)
+        self.version: int                                = 0
+        self.entries: Dict[int, bytes]                   = dict()
+        self.history: Deque[Tuple[int, int, int, bytes]] = deque(maxlen=history_size)
+        self.sources: Dict[str, Tuple[bytes, int]]       = dict()
+        self.lock:    threading.Lock                     = threading.Lock()
+
+
+    def reset(self) -> None:
+        '''Start over as a new, empty directory, such as in a freshly forked worker process.
+
+        '''
+        with self.lock:
+            self.ident = os.urandom(IDENT_SIZE)
+            self.version = 0
+            self.entries.clear()
+            self.history.clear()
+            self.sources.clear()
+
+
+    def add(self, ip: str, port: int, fingerprint: bytes) -> bool:
+        '''List a relay, or change the key it is listed with.
+
+        Parameters:
+            ip (str): IPv4 address of the relay.
+            port (int): Port of the relay's server component.
+            fingerprint (bytes): Fingerprint of the relay's public key.
+
+        Returns:
+            `True` if the directory changed.
+
+        Raises:
+            ValueError: The address is not IPv4.
+
+        '''
+        addr = pack_addr(ip, port)
+        if(not isinstance(addr, int)):
+            raise(ValueError(f"Only IPv4 relays can be listed, not {ip}"))
+        with self.lock:
+            return self._change(OP_ADD, addr, fingerprint)
+
+
+    def remove(self, peer: PeerNode, fingerprint: Union[bytes, None] = None) -> bool:
+        '''Stop listing a relay.
+
+        Parameters:
+            peer (PeerNode): Relay to be removed.
+            fingerprint (Union[bytes, None]): Only remove the relay while it is listed with this key, or `None` to
+                                              remove it whatever its key.
+
+        Returns:
+            `True` if the directory changed.
+
+        '''
+        with self.lock:
+            listed = self.entries.get(peer.key)
+            if((listed is None) or ((fingerprint is not None) and (listed != fingerprint))):
+                return False
+            return self._change(OP_REMOVE, peer.key, listed)
+
+
+    def fingerprint(self, peer: PeerNode) -> Union[bytes, None]:
+        '''Get the key fingerprint a relay is listed with.
+
+        Parameters:
+            peer (PeerNode): Relay to be looked up.
+
+        Returns:
+            The fingerprint, or `None` if the relay is not listed.
+
+        '''
+        return self.entries.get(peer.key)
+
+
+    def relays(self) -> List[PeerNode]:
+        '''List every relay in the directory.
+
+        '''
+        with self.lock:
+            addrs = list(self.entries)
+        return [PeerNode(*unpack_addr(addr)) for addr in addrs]
+
+
+    def listing(self) -> List[Tuple[PeerNode, bytes]]:
+        '''List every relay in the directory along with the key fingerprint it is listed with.
+
+        '''
+        with self.lock:
+            entries = list(self.entries.items())
+        return [(PeerNode(*unpack_addr(addr)), fingerprint) for addr, fingerprint in entries]
+
+
+    def request(self, source: str, port: int = 0, fingerprint: Union[bytes, None] = None) -> bytes:
+        '''Craft the body of a `MSG_PEERS` request for everything a node's directory gained since it was last read.
+
+        Parameters:
+            source (str): Address of the node to be asked.
+            port (int): Server port of the requesting relay, announced along with its key, or 0 for a client.
+            fingerprint (Union[bytes, None]): Fingerprint of the requesting relay's public key.
+
+        Returns:
+            The request body.
+
+        '''
+        with self.lock:
+            body = REQUEST.pack(*self.sources.get(source, (bytes(IDENT_SIZE), 0)))
+        if(port and (fingerprint is not None)):
+            body += ANNOUNCE.pack(port, fingerprint)
+        return body
+
+
+    def delta(self, request: Union[bytes, memoryview]) -> bytearray:
+        '''Answer a `MSG_PEERS` request with the changes the requester is missing.
+
+        Parameters:
+            request (Union[bytes, memoryview]): Body of the request.
+
+        Returns:
+            The body of the `MSG_PEERS` reply.
+
+        Raises:
+            struct.error: The request is too short.
+
+        '''
+        ident, since = REQUEST.unpack_from(request)
+        with self.lock:
+            version = self.version
+            oldest = self.history[0][0] if self.history else version + 1
+            if((ident == self.ident) and (since <= version) and (since >= oldest - 1)):
+                # Only the latest change to each relay is sent, however often it changed meanwhile
+                latest = dict()
+                for change in self.history:
+                    if(change[0] > since):
+                        latest[change[2]] = (change[1], change[3])
+                changes = [(op, addr, fingerprint) for addr, (op, fingerprint) in latest.items()]
+            else:
+                since = 0
+                changes = [(OP_ADD, addr, fingerprint) for addr, fingerprint in self.entries.items()]
+        body = bytearray(DELTA_HEADER.size + (len(changes) * ENTRY.size))
+        DELTA_HEADER.pack_into(body, 0, self.ident, since, version, len(changes))
+        offset = DELTA_HEADER.size
+        for op, addr, fingerprint in changes:
+            ENTRY.pack_into(body, offset, op, (addr >> 16).to_bytes(4, "big"), addr & 0xFFFF, fingerprint)
+            offset += ENTRY.size
+        return body
+
+
+    def apply(self, source: str, delta: Union[bytes, memoryview],
+              replace: bool = False) -> List[Tuple[int, PeerNode, bytes]]:
+        '''Merge a delta read from another node into this directory.
+
+        A relay is only removed while it is listed with the same key as in the delta, so a stale removal cannot undo
+        a newer entry learned from elsewhere.
+
+        Parameters:
+            source (str): Address of the node the delta was read from.
+            delta (Union[bytes, memoryview]): Body of the node's `MSG_PEERS` reply.
+            replace (bool): Whether this directory mirrors the node's alone, so that a whole directory sent in place
+                            of a delta also removes every relay missing from it.
+
+        Returns:
+            The operation, relay and key fingerprint of every change made to this directory.
+
+        Raises:
+            ValueError: The delta is malformed or does not follow on from what was last read from the node.
+
+        '''
+        if(len(delta) < DELTA_HEADER.size):
+            raise(ValueError("Directory delta is too short"))
+        ident, since, version, count = DELTA_HEADER.unpack_from(delta)
+        if(len(delta) != DELTA_HEADER.size + (count * ENTRY.size)):
+            raise(ValueError(f"Directory delta of {count} entries has {len(delta)} bytes"))
+        applied = list()
+        with self.lock:
+            if((since != 0) and (self.sources.get(source) != (ident, since))):
+                raise(ValueError(f"Directory delta from {source} starts at an unexpected version {since}"))
+            listed = set()
+            for op, ip, port, fingerprint in ENTRY.iter_unpack(memoryview(delta)[DELTA_HEADER.size:]):
+                addr = (int.from_bytes(ip, "big") << 16) | port
+                listed.add(addr)
+                if((op == OP_REMOVE) and (self.entries.get(addr) != fingerprint)):
+                    continue
+                if(self._change(op, addr, fingerprint)):
+                    applied.append((op, PeerNode(*unpack_addr(addr)), fingerprint))
+            if(replace and (since == 0)):
+                for addr in [addr for addr in self.entries if addr not in listed]:
+                    fingerprint = self.entries[addr]
+                    self._change(OP_REMOVE, addr, fingerprint)
+                    applied.append((OP_REMOVE, PeerNode(*unpack_addr(addr)), fingerprint))
+            self.sources[source] = (ident, version)
+        return applied
+
+
+    def _change(self, op: int, addr: int, fingerprint: bytes) -> bool:
+        '''Make and record a single change. The caller must hold `lock`.
+
+        '''
+        if(op == OP_ADD):
+            if(self.entries.get(addr) == fingerprint):
+                return False
+            self.entries[addr] = fingerprint
+        elif(self.entries.pop(addr, None) is None):
+            return False
+        self.version += 1
+        self.history.append((self.version, op, addr, fingerprint))
+        return True
+
+
+    def __contains__(self, peer: PeerNode) -> bool:
+        return peer.key in self.entries
+
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
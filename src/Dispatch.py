@@ -0,0 +1,177 @@
+from Link import Link
+import Messages
+
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from enum import Enum, auto
+import inspect
+import multiprocessing
+import os
+from typing import Any, Callable, Dict, Union
+
+
+# Handlers run by the worker processes, inherited from the server process when they are forked
+_process_work: Dict[int, Callable[[bytes], Any]] = dict()
+
+
+class Policy(Enum):
+    '''Where the work of a handler is carried out.
+
+    '''
+    INLINE  = auto() # On the event loop, before the next packet on the link is read
+    THREAD  = auto() # In a thread pool, for work spent mostly in OpenSSL with the GIL released
+    PROCESS = auto() # In a pool of forked processes, for CPU-bound work that would otherwise hold the GIL
+
+
+
+def _run_in_process(preamble: int, body: bytes) -> Any:
+    '''Carry out a handler's work in a worker process.
+
+    Parameters:
+        preamble (int): Preamble of the packet, naming the handler.
+        body (bytes): Body of the packet.
+
+    Returns:
+        Whatever the work returns, which must be picklable to be sent back.
+
+    '''
+    return _process_work[preamble](body)
+
+
+def _adopt_work(work: Dict[int, Callable[[bytes], Any]]) -> None:
+    '''Install the handlers' work in a newly forked worker process.
+
+    '''
+    _process_work.update(work)
+
+
+# ======================================================================================================================
+@dataclass
+class Handler:
+    '''Handler registered for one type of packet.
+
+    Attributes:
+        handle (Callable): Called on the event loop with the link and the packet, followed by the result of `work` if
+                           there is any. It may be a coroutine function, and returns `True` if it took the link over.
+        policy (Policy): Where `work` is carried out.
+        work (Union[Callable[[bytes], Any], None]): Expensive part of handling the packet, given its body and sharing
+                                                    no state with the event loop, or `None` if there is none.
+        is_async (bool): Whether `handle` is a coroutine function.
+
+    '''
+    handle:   Callable                            = None
+    policy:   Policy                              = Policy.INLINE
+    work:     Union[Callable[[bytes], Any], None] = None
+    is_async: bool                                = False
+
+
+
+class Dispatcher(object):
+    '''Registry of the handlers for each type of packet, looked up by the packet's integer preamble in a single step
+       however many types are registered.
+
+    Attributes:
+        handlers (Dict[int, Handler]): Handlers, keyed by preamble.
+        workers (int): Size of the thread and process pools.
+        executors (Dict[Policy, Executor]): Pools carrying out the work of handlers that are not inline, once started.
+
+    Note:
+        Work run in a process is looked up there by preamble, from the handlers registered when the pool was forked, so
+        only the packet body and the result cross between processes. Handlers using the process policy must therefore
+        be registered before `start`.
+
+    '''
+    def __init__(self, workers: Union[int, None] = None) -> None:
+        self.handlers:  Dict[int, Handler]     = dict()
+        self.workers:   int                    = workers or os.cpu_count() or 1
+        self.executors: Dict[Policy, Executor] = dict()
+
+
+    def register(self, preamble: Union[Enum, int], handle: Callable, policy: Policy = Policy.INLINE,
+                 work: Union[Callable[[bytes], Any], None] = None) -> None:
+        '''Handle every packet of a type with a handler, replacing any handler it had.
+
+        Parameters:
+            preamble (Union[Enum, int]): Type of packet, which need not be one of `Messages.Preambles`.
+            handle (Callable): Called on the event loop with the link, the packet and the result of `work` if given.
+            policy (Policy): Where `work` is carried out.
+            work (Union[Callable[[bytes], Any], None]): Expensive part of handling the packet, given its body.
+
+        Raises:
+            ValueError: The policy needs work to carry out but none was given.
+
+        '''
+        if((policy is not Policy.INLINE) and (work is None)):
+            raise(ValueError(f"Policy {policy.name} needs work to carry out"))
+        preamble = preamble.value if isinstance(preamble, Enum) else int(preamble)
+        self.handlers[preamble] = Handler(handle, policy, work, inspect.iscoroutinefunction(handle))
+
+
+    def unregister(self, preamble: Union[Enum, int]) -> None:
+        '''Stop handling a type of packet, so it is ignored from then on.
+
+        Parameters:
+            preamble (Union[Enum, int]): Type of packet.
+
+        '''
+        self.handlers.pop(preamble.value if isinstance(preamble, Enum) else int(preamble), None)
+
+
+    def start(self) -> None:
+        '''Start the pools needed by the registered policies. Processes are forked straight away, so this should be
+           called before the caller starts any thread of its own.
+
+        '''
+        policies = {handler.policy for handler in self.handlers.values()}
+        if((Policy.THREAD in policies) and (Policy.THREAD not in self.executors)):
+            self.executors[Policy.THREAD] = ThreadPoolExecutor(self.workers, thread_name_prefix="handler")
+        if((Policy.PROCESS in policies) and (Policy.PROCESS not in self.executors)):
+            work = {preamble: handler.work for preamble, handler in self.handlers.items()
+                    if handler.policy is Policy.PROCESS}
+            # Forking hands the work over without pickling it, and the pool forks every worker on first use
+            pool = ProcessPoolExecutor(self.workers, multiprocessing.get_context("fork"), _adopt_work, (work,))
+            pool.submit(int).result()
+            self.executors[Policy.PROCESS] = pool
+
+
+    def stop(self) -> None:
+        '''Shut down the pools, waiting for work already handed to them.
+
+        '''
+        for executor in self.executors.values():
+            executor.shutdown()
+        self.executors.clear()
+
+
+    async def dispatch(self, link: Link, packet: Messages.Packet) -> bool:
+        '''Hand a packet to the handler for its type, ignoring types without one.
+
+        Parameters:
+            link (Link): Link the packet arrived on.
+            packet (Messages.Packet): Received packet.
+
+        Returns:
+            `True` if the handler took the link over, such as by splicing it onto another connection.
+
+        '''
+        handler = self.handlers.get(packet.preamble)
+        if(handler is None):
+            return False
+        if(handler.work is None):
+            result = handler.handle(link, packet)
+        elif(handler.policy is Policy.INLINE):
+            result = handler.handle(link, packet, handler.work(packet.raw_body))
+        else:
+            # Handed over as bytes, which unlike a view of the read buffer can be pickled and safely outlive it
+            loop = asyncio.get_running_loop()
+            if(handler.policy is Policy.PROCESS):
+                outcome = await loop.run_in_executor(self.executors[Policy.PROCESS], _run_in_process, packet.preamble,
+                                                     bytes(packet.raw_body))
+            else:
+                outcome = await loop.run_in_executor(self.executors[Policy.THREAD], handler.work,
+                                                     bytes(packet.raw_body))
+            result = handler.handle(link, packet, outcome)
+        if(handler.is_async):
+            result = await result
+        return bool(result)
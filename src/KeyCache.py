@@ -0,0 +1,124 @@
+from PeerNode import PeerNode
+
+from hashlib import sha256
+import hmac
+import sqlite3
+import threading
+from time import time
+from typing import Dict, Iterable
+
+
+# Cache parameters
+KEY_TTL    = 24 * 60 * 60 # Seconds a cached key is trusted before the peer is asked for it again
+LOAD_CHUNK = 500          # Peers looked up per query, below SQLite's limit on bound parameters
+
+
+def fingerprint(der: bytes) -> bytes:
+    '''Compute the fingerprint of a DER-encoded public key.
+
+    Parameters:
+        der (bytes): SubjectPublicKeyInfo DER encoding of the key.
+
+    Returns:
+        The SHA-256 digest of the encoding.
+
+    '''
+    return sha256(der).digest()
+
+
+# ======================================================================================================================
+class KeyCache(object):
+    '''SQLite-backed store of peer public keys that survives restarts, so only peers with stale or missing keys need
+       to be contacted at startup.
+
+    Attributes:
+        path (str): Location of the database file.
+        ttl (float): Seconds a cached key stays fresh.
+        db (sqlite3.Connection): Open database connection.
+        lock (threading.Lock): Serializes access from the client's worker threads.
+
+    Note:
+        Keys are kept in DER form alongside their fingerprint. An entry whose fingerprint no longer matches its key
+        is treated as missing, so a damaged file costs a key request rather than a bad circuit.
+
+    '''
+    def __init__(self, path: str, ttl: float = KEY_TTL) -> None:
+        self.path: str                = path
+        self.ttl:  float              = ttl
+        self.db:   sqlite3.Connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock: threading.Lock     = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS peer_keys ("
+                            "socket_addr TEXT PRIMARY KEY, "
+                            "der BLOB NOT NULL, "
+                            "fingerprint BLOB NOT NULL, "
+                            "fetched REAL NOT NULL)")
+
+
+    def load(self, peers: Iterable[PeerNode]) -> Dict[PeerNode, bytes]:
+        '''Read the fresh keys of a set of peers without parsing them.
+
+        Parameters:
+            peers (Iterable[PeerNode]): Peers whose keys are wanted.
+
+        Returns:
+            The DER-encoded key of every peer with a fresh, intact entry.
+
+        '''
+        wanted = {peer.socket_addr: peer for peer in peers}
+        addrs = list(wanted)
+        since = time() - self.ttl
+        rows = list()
+        with self.lock:
+            # Chunked to stay within SQLite's limit on bound parameters
+            for i in range(0, len(addrs), LOAD_CHUNK):
+                chunk = addrs[i:(i + LOAD_CHUNK)]
+                rows.extend(self.db.execute("SELECT socket_addr, der, fingerprint FROM peer_keys "
+                                            f"WHERE fetched >= ? AND socket_addr IN ({', '.join('?' * len(chunk))})",
+                                            (since, *chunk)).fetchall())
+        keys = dict()
+        for socket_addr, der, digest in rows:
+            peer = wanted.get(socket_addr)
+            if((peer is not None) and hmac.compare_digest(fingerprint(der), digest)):
+                keys[peer] = der
+        return keys
+
+
+    def store(self, peer: PeerNode, der: bytes) -> None:
+        '''Remember a peer's key, replacing any older entry.
+
+        Parameters:
+            peer (PeerNode): Peer the key belongs to.
+            der (bytes): SubjectPublicKeyInfo DER encoding of the key.
+
+        '''
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO peer_keys VALUES (?, ?, ?, ?)",
+                            (peer.socket_addr, der, fingerprint(der), time()))
+
+
+    def forget(self, peer: PeerNode) -> None:
+        '''Drop a peer's key, such as after it failed to answer a handshake sent under it.
+
+        Parameters:
+            peer (PeerNode): Peer whose entry is removed.
+
+        '''
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM peer_keys WHERE socket_addr = ?", (peer.socket_addr,))
+
+
+    def prune(self) -> int:
+        '''Delete every expired entry.
+
+        Returns:
+            The number of entries removed.
+
+        '''
+        with self.lock, self.db:
+            return self.db.execute("DELETE FROM peer_keys WHERE fetched < ?", (time() - self.ttl,)).rowcount
+
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
@@ -1,3 +1,5 @@
+import KeyCache
+from KeyCache import KeyCache
 import Messages
 from Messages import Packet
 from PeerNode import PeerNode
@@ -5,9 +7,37 @@ from PeerNode import PeerNode
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from dataclasses import dataclass
+from functools import lru_cache
+from os import urandom
 from struct import pack, unpack
-from typing import Dict, Union
+from typing import Dict, Iterable, List, Set, Tuple, Union
+
+
+# Hybrid layer format: [RSA-OAEP wrapped session key][GCM nonce][AES-GCM ciphertext + tag]
+SESSION_KEY_BITS = 256
+NONCE_SIZE       = 12
+OAEP             = padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None)
+
+
+@lru_cache(maxsize=8)
+def load_key_pair(public_key: str, private_key: str) -> Tuple[rsa.RSAPublicKey, rsa.RSAPrivateKey]:
+    '''Read and parse a PEM key pair, once per pair of files however many components use it.
+
+    Parameters:
+        public_key (str): Path to the file containing the public key.
+        private_key (str): Path to the file containing the private key.
+
+    Returns:
+        The public and private keys.
+
+    '''
+    with open(public_key, "rb") as key_read:
+        public = serialization.load_pem_public_key(key_read.read(), backend=default_backend())
+    with open(private_key, "rb") as key_read:
+        private = serialization.load_pem_private_key(key_read.read(), password=None, backend=default_backend())
+    return public, private
 
 
 # ======================================================================================================================
@@ -33,19 +63,30 @@ class KeyStore(object):
         server_keypair (KeyPair): Key pair containing the public and private keys of the server component.
         client_keypair (KeyPair): Key pair containing the public and private keys of the client component.
         peer_public_keys (Dict[PeerNode, rsa.RSAPublicKey]): Peer nodes and their associated public key.
+        peers (Dict[Union[int, Tuple[str, int]], PeerNode]): Stored peers, indexed by their packed address.
+        core_peers (Set[PeerNode]): Stored peers flagged as core members.
+        peers_by_name (Dict[str, Set[PeerNode]]): Stored peers, indexed by name.
+        cached_keys (Dict[PeerNode, bytes]): DER-encoded keys read from the key cache, parsed on first use.
+        key_cache (Union[KeyCache, None]): Persistent cache every newly received key is written to, if any.
     
     Note:
         A dictionary is used for the Peer-Key pairings so a peer is not included twice. Specifying already existing
-        nodes when writing to the dictionary will overwrite stored information.
+        nodes when writing to the dictionary will overwrite stored information. The name and core flag of a stored
+        peer are indexed, so they should be changed by adding the peer again rather than in place.
     
     '''
     def __init__(self) -> None:
         '''Initializer for KeyStore class. Instantiates empty member data.
         
         '''
-        self.server_keypair:   KeyPair                          = KeyPair()
-        self.client_keypair:   KeyPair                          = KeyPair()
-        self.peer_public_keys: Dict[PeerNode, rsa.RSAPublicKey] = dict()
+        self.server_keypair:   KeyPair                                     = KeyPair()
+        self.client_keypair:   KeyPair                                     = KeyPair()
+        self.peer_public_keys: Dict[PeerNode, rsa.RSAPublicKey]            = dict()
+        self.peers:            Dict[Union[int, Tuple[str, int]], PeerNode] = dict()
+        self.core_peers:       Set[PeerNode]                               = set()
+        self.peers_by_name:    Dict[str, Set[PeerNode]]                    = dict()
+        self.cached_keys:      Dict[PeerNode, bytes]                       = dict()
+        self.key_cache:        Union[KeyCache, None]                       = None
 
     
     def load_server_keys(self, public_key: str, private_key: str) -> None:
@@ -56,13 +97,7 @@ class KeyStore(object):
             private_key (str): Path to the file containing the private key of the server.
         
         '''
-        with open(public_key, "rb") as key_read:
-            self.server_keypair.public = serialization.load_pem_public_key(key_read.read(),
-                                                                           backend=default_backend())
-        with open(private_key, "rb") as key_read:
-            self.server_keypair.private = serialization.load_pem_private_key(key_read.read(),
-                                                                             password=None,
-                                                                             backend=default_backend())
+        self.server_keypair.public, self.server_keypair.private = load_key_pair(public_key, private_key)
             
     
     def load_client_keys(self, public_key: str, private_key: str) -> None:
@@ -73,14 +108,8 @@ class KeyStore(object):
             private_key (str): Path to the file containing the private key for the client.
         
         '''
-        # Load pem keys from files
-        with open(public_key, "rb") as key_read:
-            self.client_keypair.public = serialization.load_pem_public_key(key_read.read(),
-                                                                           backend=default_backend())
-        with open(private_key, "rb") as key_read:
-            self.client_keypair.private = serialization.load_pem_private_key(key_read.read(),
-                                                                             password=None,
-                                                                             backend=default_backend())
+        # Load pem keys from files, shared with the server if both use the same pair
+        self.client_keypair.public, self.client_keypair.private = load_key_pair(public_key, private_key)
             
     
     def add_peer(self, peer: PeerNode, key: Union[rsa.RSAPublicKey, None]) -> None:
@@ -92,22 +121,130 @@ class KeyStore(object):
                                            the list or None when that information is not yet known.
         
         '''
+        if(peer in self.peer_public_keys):
+            # Replace the stored peer itself so its name and core flag are updated too
+            self.remove_peer(peer)
         self.peer_public_keys[peer] = key
+        self.peers[peer.key] = peer
+        if(peer.is_core):
+            self.core_peers.add(peer)
+        self.peers_by_name.setdefault(peer.name, set()).add(peer)
 
 
-    def set_peer_key(self, peer: PeerNode, key: Union[bytes, rsa.RSAPublicKey]) -> None:
+    def remove_peer(self, peer: PeerNode) -> None:
+        '''Forget a peer and its public key.
+
+        Parameters:
+            peer (PeerNode.PeerNode): Peer to be removed, or any peer with the same address.
+        
+        '''
+        stored = self.peers.pop(peer.key, None)
+        if(stored is None):
+            return
+        del self.peer_public_keys[stored]
+        self.cached_keys.pop(stored, None)
+        self.core_peers.discard(stored)
+        named = self.peers_by_name.get(stored.name)
+        if(named is not None):
+            named.discard(stored)
+            if(len(named) == 0):
+                del self.peers_by_name[stored.name]
+
+
+    def set_peer_key(self, peer: PeerNode, key: Union[bytes, memoryview, rsa.RSAPublicKey]) -> None:
         '''Sets the public key for a given peer.
 
         Parameters:
             peer (PeerNode.PeerNode): Desired node to have the key associated with.
-            key (Union[bytes, rsa.RSAPublicKey]): The public key to be associated with the host specified.
-                                            If the parameter is of type `bytes`, then it will be
-                                            converted into `rsa.RSAPublicKey`.
+            key (Union[bytes, memoryview, rsa.RSAPublicKey]): The public key to be associated with the host
+                                            specified. If the parameter is a PEM byte string, then it
+                                            will be converted into `rsa.RSAPublicKey`.
         
         '''
-        if(type(key) is bytes):
-            key = serialization.load_pem_public_key(key, backend=default_backend())
-        self.peer_public_keys[peer] = key
+        if(isinstance(key, (bytes, memoryview))):
+            key = serialization.load_pem_public_key(bytes(key), backend=default_backend())
+        if(peer in self.peer_public_keys):
+            self.peer_public_keys[peer] = key
+        else:
+            self.add_peer(peer, key)
+        self.cached_keys.pop(peer, None)
+        if(self.key_cache is not None):
+            self.key_cache.store(peer, key.public_bytes(encoding=serialization.Encoding.DER,
+                                                        format=serialization.PublicFormat.SubjectPublicKeyInfo))
+
+
+    def forget_key(self, peer: PeerNode) -> None:
+        '''Drop a peer's public key, along with any copy of it in the key cache, while keeping the peer itself.
+
+        Parameters:
+            peer (PeerNode.PeerNode): Peer whose key is no longer trusted.
+        
+        '''
+        stored = self.peers.get(peer.key)
+        if(stored is None):
+            return
+        self.peer_public_keys[stored] = None
+        self.cached_keys.pop(stored, None)
+        if(self.key_cache is not None):
+            self.key_cache.forget(stored)
+
+
+    def attach_cache(self, cache: KeyCache) -> None:
+        '''Use a persistent key cache, picking up any fresh keys it holds for peers without one.
+
+        The cached keys are only parsed when first used, so a large cache costs a single query at startup.
+
+        Parameters:
+            cache (KeyCache): Cache to be read from and written to.
+        
+        '''
+        self.key_cache = cache
+        self.load_cached([peer for peer, key in self.peer_public_keys.items() if key is None])
+
+
+    def load_cached(self, peers: Iterable[PeerNode], fingerprints: Union[Dict[PeerNode, bytes], None] = None) -> int:
+        '''Pick up the fresh keys held in the key cache for a set of peers, without parsing them.
+
+        Parameters:
+            peers (Iterable[PeerNode]): Stored peers whose keys are wanted.
+            fingerprints (Union[Dict[PeerNode, bytes], None]): Fingerprint each peer's key is expected to have, such
+                                                                as the one it is listed with in the directory. Cached
+                                                                keys that differ are left in the cache unused.
+
+        Returns:
+            The number of keys picked up.
+
+        '''
+        if(self.key_cache is None):
+            return 0
+        keys = self.key_cache.load(peers)
+        if(fingerprints is not None):
+            keys = {peer: der for peer, der in keys.items() if fingerprints.get(peer) == KeyCache.fingerprint(der)}
+        self.cached_keys.update(keys)
+        return len(keys)
+
+
+    def has_key(self, peer: PeerNode) -> bool:
+        '''Check whether a peer's public key is known, whether parsed or still waiting in the cache.
+
+        Parameters:
+            peer (PeerNode): Peer to be checked.
+
+        Returns:
+            `True` if a layer can be encrypted for the peer.
+        
+        '''
+        return (self.peer_public_keys.get(peer) is not None) or (peer in self.cached_keys)
+
+
+    def missing_peers(self) -> List[PeerNode]:
+        '''List the peers whose public keys still have to be requested.
+
+        Returns:
+            Every known peer without a key.
+        
+        '''
+        return [peer for peer in self.peer_public_keys.keys() if not self.has_key(peer)]
 
 
     def print_peer_keystore(self) -> None:
@@ -131,10 +268,30 @@ class KeyStore(object):
             keystore doesn't have any relevant peers.
         
         '''
-        for peer in self.peer_public_keys.keys():
-            if(p == peer):
-                return peer
-        return None
+        return self.peers.get(p.key)
+
+
+    def get_core_peers(self) -> List[PeerNode]:
+        '''Get every stored peer flagged as a core member.
+
+        Returns:
+            The core peers, in no particular order.
+        
+        '''
+        return list(self.core_peers)
+
+
+    def get_peers_by_name(self, name: str) -> List[PeerNode]:
+        '''Get every stored peer with a given name.
+
+        Parameters:
+            name (str): Human-readable name to be searched for.
+
+        Returns:
+            The matching peers, in no particular order.
+        
+        '''
+        return list(self.peers_by_name.get(name, ()))
     
 
     def get_pub_key(self, p: PeerNode) -> Union[rsa.RSAPublicKey, None]:
@@ -144,13 +301,18 @@ class KeyStore(object):
             p (PeerNode): Information of the peer to search for in the keystore.
 
         Returns:
-            If the peer is stored in the keystore, the public key of the node is returned. Otherwise, returns `None`.
+            If the peer is stored in the keystore, the public key of the node is returned, parsing it from the key
+            cache on first use. Otherwise, returns `None`.
         
         '''
         try:
-            return(self.peer_public_keys[p])
+            key = self.peer_public_keys[p]
         except KeyError as ke:
             return None
+        if((key is None) and (p in self.cached_keys)):
+            key = serialization.load_der_public_key(self.cached_keys.pop(p), backend=default_backend())
+            self.peer_public_keys[p] = key
+        return key
 
 
 
@@ -181,21 +343,49 @@ class KeyStore(object):
     def encrypt_packet(self, packet: Packet, peer: PeerNode) -> bytes:
         '''Encrypts a packet's contents using a public key stored in the keystore.
 
+        A fresh AES-256 session key is wrapped with the peer's public key and the packed packet is sealed with AES-GCM
+        under it, so each layer costs one public key operation and a constant overhead regardless of body size.
+
         Parameters:
             packet (Messages.Packet): Packet containing data to be encrypted.
             peer (PeerNode.PeerNode): Peer whose public key will be used for encryption.
 
         Returns:
-            A `Packet` with the body containing the encrypted preamble and body of the original packet.
+            The wrapped session key, nonce and sealed packet concatenated into a single layer.
+
+        Raises:
+            ValueError: The peer's public key is unknown.
         '''
         pub_key = self.get_pub_key(peer)
-        byte_string = packet.pack()
-        enc_string = b''
-        for i in range(0, int(len(byte_string) / 190) + 1):
-            enc_string += pub_key.encrypt(byte_string[(i * 190):((i + 1) * 190)], padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                                                                                               algorithm=hashes.SHA256(),
-                                                                                               label=None))
-        return enc_string
+        if(pub_key is None):
+            raise(ValueError(f"No public key known for {peer}"))
+        # A key is never reused, so layers sent to the same peer cannot be linked by their wrapped key
+        session_key = AESGCM.generate_key(bit_length=SESSION_KEY_BITS)
+        nonce = urandom(NONCE_SIZE)
+        wrapped_key = pub_key.encrypt(session_key, OAEP)
+        # Wrapped key is bound to the sealed body as associated data
+        return wrapped_key + nonce + AESGCM(session_key).encrypt(nonce, packet.pack(), wrapped_key)
+
+
+    def decrypt_packet(self, layer: bytes) -> Packet:
+        '''Removes a single layer of encryption applied by `encrypt_packet` using the server's private key.
+
+        Parameters:
+            layer (bytes): Encrypted layer received from a peer.
+
+        Returns:
+            The `Packet` that was sealed inside of the layer.
+
+        Raises:
+            cryptography.exceptions.InvalidTag: The layer was not sealed under the key it carries.
+        '''
+        key_size = self.server_keypair.private.key_size // 8
+        wrapped_key = bytes(layer[:key_size])
+        nonce = layer[key_size:(key_size + NONCE_SIZE)]
+        session_key = self.server_keypair.private.decrypt(wrapped_key, OAEP)
+        packet = Packet()
+        packet.unpack(AESGCM(session_key).decrypt(nonce, layer[(key_size + NONCE_SIZE):], wrapped_key))
+        return packet
 
 
 
@@ -0,0 +1,259 @@
+from ConnectionPool import CONNECT_TIMEOUT
+import Messages
+from PeerNode import PeerNode
+
+import asyncio
+from typing import AsyncIterator, Callable, Collection, Dict, Union
+
+
+# Link parameters
+CREATE_TIMEOUT = 10 # Seconds to wait for a neighbour to answer a circuit handshake
+
+
+# ======================================================================================================================
+class Link(object):
+    '''Long-lived connection to a neighbouring node that carries any number of circuits at once.
+
+    Attributes:
+        reader (asyncio.StreamReader): Incoming side of the connection.
+        writer (asyncio.StreamWriter): Outgoing side of the connection.
+        codec (Messages.Codec): Wire format used on the connection.
+        peer (Union[PeerNode, None]): Neighbour at the other end if this node opened the link, otherwise `None`.
+        pending (Dict[int, asyncio.Future]): Circuit handshakes awaiting `MSG_CREATED`, keyed by circuit ID.
+        decoder (Union[Messages.PacketDecoder, Messages.CellDecoder, None]): Decoder of the packets being read, once
+                                                                             reading has started.
+        received (int): Bytes read from the connection.
+        sent (int): Bytes queued to be written to the connection.
+
+    '''
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, codec: Messages.Codec,
+                 peer: Union[PeerNode, None] = None) -> None:
+        self.reader:   asyncio.StreamReader                                      = reader
+        self.writer:   asyncio.StreamWriter                                      = writer
+        self.codec:    Messages.Codec                                            = codec
+        self.peer:     Union[PeerNode, None]                                     = peer
+        self.pending:  Dict[int, asyncio.Future]                                 = dict()
+        self.decoder:  Union[Messages.PacketDecoder, Messages.CellDecoder, None] = None
+        self.received: int                                                       = 0
+        self.sent:     int                                                       = 0
+
+
+    def packets(self, passthrough: Collection[int] = ()) -> AsyncIterator[Messages.Packet]:
+        '''Iterate over packets arriving on the link until it closes.
+
+        Parameters:
+            passthrough (Collection[int]): Preambles to be yielded cell by cell in cell mode.
+
+        Returns:
+            An asynchronous iterator of packets.
+
+        '''
+        self.decoder = self.codec.decoder(passthrough)
+        return self._read()
+
+
+    async def _read(self) -> AsyncIterator[Messages.Packet]:
+        '''Feed the decoder from the connection, counting the bytes read.
+
+        '''
+        while True:
+            data = await self.reader.read(Messages.READ_SIZE)
+            if(not data):
+                return
+            self.received += len(data)
+            self.decoder.feed(data)
+            for packet in self.decoder:
+                yield packet
+
+
+    def detach(self) -> bytes:
+        '''Stop treating the link as a stream of packets, such as when splicing it onto another connection.
+
+        Returns:
+            The bytes already read from the link but not yet decoded.
+
+        '''
+        return b'' if self.decoder is None else self.decoder.detach()
+
+
+    def send(self, packet: Messages.Packet) -> None:
+        '''Queue a packet to be written to the link.
+
+        Parameters:
+            packet (Messages.Packet): Packet to be sent.
+
+        '''
+        data = self.codec.encode(packet)
+        self.sent += len(data)
+        self.writer.write(data)
+
+
+    def write(self, data: bytes) -> None:
+        '''Queue already encoded bytes to be written to the link.
+
+        Parameters:
+            data (bytes): Encoded frame or cells.
+
+        '''
+        self.sent += len(data)
+        self.writer.write(data)
+
+
+    async def drain(self) -> None:
+        '''Wait until the link's write buffer has room again.
+
+        '''
+        await self.writer.drain()
+
+
+    async def create(self, packet: Messages.Packet, timeout: float = CREATE_TIMEOUT) -> Messages.Packet:
+        '''Send a `MSG_CREATE` packet and wait for the neighbour's answer on the same circuit ID.
+
+        Parameters:
+            packet (Messages.Packet): Handshake packet carrying the circuit ID to be created.
+            timeout (float): Seconds to wait for the answer.
+
+        Returns:
+            The `MSG_CREATED` packet sent back by the neighbour.
+
+        Raises:
+            asyncio.TimeoutError: No answer arrived in time.
+
+        '''
+        answer = asyncio.get_running_loop().create_future()
+        self.pending[packet.circ_id] = answer
+        try:
+            self.send(packet)
+            return await asyncio.wait_for(answer, timeout)
+        finally:
+            self.pending.pop(packet.circ_id, None)
+
+
+    def resolve(self, packet: Messages.Packet) -> bool:
+        '''Hand a `MSG_CREATED` packet to the handshake waiting for it.
+
+        Parameters:
+            packet (Messages.Packet): Answer received from the neighbour.
+
+        Returns:
+            `True` if a handshake was waiting for the packet.
+
+        '''
+        answer = self.pending.pop(packet.circ_id, None)
+        if((answer is None) or answer.done()):
+            return False
+        answer.set_result(packet)
+        return True
+
+
+    def close(self) -> None:
+        '''Close the connection and fail any handshakes still waiting on it.
+
+        '''
+        for answer in self.pending.values():
+            if(not answer.done()):
+                answer.set_exception(ConnectionError("Link closed"))
+        self.pending.clear()
+        self.writer.close()
+
+
+    @property
+    def closed(self) -> bool:
+        return self.writer.is_closing()
+
+
+    @property
+    def name(self) -> str:
+        '''Peer the link leads to, by its listening address if this node opened the link, otherwise by host alone
+           as the port is an ephemeral one.
+
+        '''
+        if(self.peer is not None):
+            return self.peer.socket_addr
+        return str(self.writer.get_extra_info("peername")[0])
+
+
+    @property
+    def buffered(self) -> int:
+        return self.writer.transport.get_write_buffer_size()
+
+
+    def __str__(self) -> str:
+        return(str(self.peer) if self.peer is not None else str(self.writer.get_extra_info("peername")))
+
+
+
+# ======================================================================================================================
+class LinkManager(object):
+    '''Keeps a single outgoing link open to each neighbour so relays never reconnect per circuit or message.
+
+    Attributes:
+        codec (Messages.Codec): Wire format used on new links.
+        on_open (Callable[[Link], None]): Called with every new link so its owner can start reading from it.
+        links (Dict[PeerNode, Link]): Open links, keyed by neighbour.
+        connecting (Dict[PeerNode, asyncio.Task]): Connections being opened, shared by concurrent callers.
+
+    '''
+    def __init__(self, codec: Messages.Codec, on_open: Callable[[Link], None]) -> None:
+        self.codec:      Messages.Codec               = codec
+        self.on_open:    Callable[[Link], None]       = on_open
+        self.links:      Dict[PeerNode, Link]         = dict()
+        self.connecting: Dict[PeerNode, asyncio.Task] = dict()
+
+
+    async def get(self, peer: PeerNode) -> Link:
+        '''Get the link to a neighbour, opening one if none is usable.
+
+        Parameters:
+            peer (PeerNode): Neighbour to be reached.
+
+        Returns:
+            An open link to the neighbour.
+
+        Raises:
+            OSError: The neighbour could not be reached.
+
+        '''
+        link = self.links.get(peer)
+        if((link is not None) and (not link.closed)):
+            return link
+        opening = self.connecting.get(peer)
+        if(opening is None):
+            opening = asyncio.create_task(self._open(peer))
+            self.connecting[peer] = opening
+        return await asyncio.shield(opening)
+
+
+    async def _open(self, peer: PeerNode) -> Link:
+        '''Connect to a neighbour and start serving the new link.
+
+        Parameters:
+            peer (PeerNode): Neighbour to be reached.
+
+        Returns:
+            The new link.
+
+        Raises:
+            OSError: The neighbour could not be reached, or did not accept the connection in time.
+
+        '''
+        try:
+            # Bounded, so a neighbour that drops connection attempts does not hold up every circuit waiting on it
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(peer.ip, peer.port), CONNECT_TIMEOUT)
+            link = Link(reader, writer, self.codec, peer)
+            self.links[peer] = link
+            self.on_open(link)
+            return link
+        finally:
+            self.connecting.pop(peer, None)
+
+
+    def forget(self, link: Link) -> None:
+        '''Stop handing out a link once it has closed.
+
+        Parameters:
+            link (Link): Link that is no longer usable.
+
+        '''
+        if((link.peer is not None) and (self.links.get(link.peer) is link)):
+            del self.links[link.peer]
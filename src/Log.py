@@ -0,0 +1,85 @@
+import logging
+from logging import DEBUG, INFO, WARNING, ERROR
+import sys
+import threading
+from time import monotonic
+from typing import Dict, List, Tuple
+
+
+# Output format, matching the prefixes the components have always printed with
+LOG_FORMAT    = "[%(name)s] %(message)s"
+LEVELS        = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+# Rate limiting
+RATE_INTERVAL = 1.0 # Seconds over which the records from each line of code are counted
+RATE_BURST    = 20  # Records a single line of code may emit per interval before the rest are dropped
+
+# Loggers of the two components, named after their old prefixes, and of the optional profiler
+server   = logging.getLogger("SERVER")
+client   = logging.getLogger("CLIENT")
+profiler = logging.getLogger("PROFILE")
+
+
+# ======================================================================================================================
+class RateLimit(logging.Filter):
+    '''Drops records from any line of code that logs more than a burst of them per interval, so a flood of failing
+       packets cannot swamp the output or slow the server down. Once a line logs again in a later interval, the number
+       of records it had dropped is added to the message.
+
+    Attributes:
+        burst (int): Records a line may emit per interval.
+        interval (float): Length of an interval in seconds.
+        sites (Dict[Tuple[str, int], List]): Start of the current interval, records emitted and records dropped,
+                                             keyed by the file and line that logged them.
+        lock (threading.Lock): Guards `sites`, as the client and server components log from different threads.
+
+    Note:
+        The filter is attached to the handler, so records below the logger's level are discarded before it is ever
+        reached and disabled levels cost no more than the level check.
+
+    '''
+    def __init__(self, burst: int = RATE_BURST, interval: float = RATE_INTERVAL) -> None:
+        super().__init__()
+        self.burst:    int                         = burst
+        self.interval: float                       = interval
+        self.sites:    Dict[Tuple[str, int], List] = dict()
+        self.lock:     threading.Lock              = threading.Lock()
+
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        site = (record.pathname, record.lineno)
+        now = monotonic()
+        with self.lock:
+            state = self.sites.get(site)
+            if((state is None) or (now - state[0] >= self.interval)):
+                dropped = 0 if state is None else state[2]
+                self.sites[site] = [now, 1, 0]
+                if(dropped):
+                    record.msg = f"{record.msg} ({dropped} similar messages suppressed)"
+                return True
+            if(state[1] < self.burst):
+                state[1] += 1
+                return True
+            state[2] += 1
+            return False
+
+
+def configure(level: str = "info", burst: int = RATE_BURST, interval: float = RATE_INTERVAL) -> None:
+    '''Send the records of every logger to standard output, through a rate limit.
+
+    Parameters:
+        level (str): Lowest level emitted, one of the keys of `LEVELS`.
+        burst (int): Records a single line of code may emit per interval.
+        interval (float): Length of a rate limiting interval in seconds.
+
+    Raises:
+        KeyError: The level is unknown.
+
+    '''
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    handler.addFilter(RateLimit(burst, interval))
+    for logger in (server, client, profiler):
+        logger.handlers.clear()
+        logger.addHandler(handler)
+        logger.setLevel(LEVELS[level])
+        logger.propagate = False
@@ -1,7 +1,38 @@
+import asyncio
 from dataclasses import dataclass
 from enum import Enum, auto
-from struct import pack, unpack
-from typing import Union
+from functools import lru_cache
+import socket
+from struct import Struct
+from typing import AsyncIterator, Collection, Dict, Iterator, Tuple, Union
+
+
+# Packet header: preamble, destination IPv4 address, destination port, data size, circuit ID, stream ID
+HEADER          = Struct("!H4sHIIH")
+# Framing
+FRAME_HEADER    = Struct("!I")     # Length of the packed packet that follows
+MAX_PACKET_SIZE = 16 * 1024 * 1024 # Largest frame a decoder will accept before treating the stream as corrupt
+READ_SIZE       = 64 * 1024        # Bytes requested from a socket per read
+# Fixed-size cells: header, length of the fragment carried, fragment padded out to the cell size
+CELL_SIZE       = 512
+CELL_LENGTH     = Struct("!H")
+CELL_BATCH      = 128              # Cells read from a socket at once by a `CellDecoder`
+
+
+@lru_cache(maxsize=4096)
+def pack_ip(ip: str) -> bytes:
+    '''Convert a dotted IPv4 address into its 4-byte wire form, treating an empty address as 0.0.0.0.
+
+    '''
+    return socket.inet_aton(ip) if ip else bytes(4)
+
+
+@lru_cache(maxsize=4096)
+def unpack_ip(ip: bytes) -> str:
+    '''Convert a 4-byte wire address back into dotted IPv4 form.
+
+    '''
+    return socket.inet_ntoa(ip)
 
 
 '''
@@ -36,6 +67,17 @@ class Preambles(Enum):
     MSG_ECHO     = auto() # Instruct receiver to echo back message
     MSG_NULLSTR  = auto() # Null string, often sent by crashed clients
     MSG_UNKNOWN  = auto() # Server could not interpret provided message
+    # Circuit handling
+    MSG_CREATE   = auto() # Begin a circuit handshake with the receiver
+    MSG_CREATED  = auto() # Receiver has completed its half of the circuit handshake
+    MSG_RELAY    = auto() # Body is a layered cell travelling along a circuit
+    MSG_EXTEND   = auto() # Last hop of the circuit should extend it to the peer in the header
+    MSG_EXTENDED = auto() # Circuit was extended by one hop
+    MSG_DESTROY  = auto() # Circuit is being torn down
+    MSG_SENDME   = auto() # Receiver may send another increment of packets on the circuit, or on the stream if set
+    MSG_FETCH    = auto() # Receiver should send back the file named in the body on the same stream
+    # Monitoring
+    MSG_STATS    = auto() # Receiver should answer with its counters, as JSON in the body of a packet of the same type
     # Debugging
     MSG_SHUTDOWN = 100 # Instruct remote server to shutdown
 
@@ -48,6 +90,8 @@ class Packet:
     Attributes:
         _preamble (bytes): The operation to be performed on the body data.
         _body (bytes): The primary data body containing all information, if any.
+        _circ_id (int): Identifier of the circuit the packet belongs to on the current link, 0 if none.
+        _stream_id (int): Identifier of the stream within the circuit the packet belongs to, 0 if none.
 
     '''
     _preamble:  int   = Preambles.MSG_NONE.value
@@ -55,9 +99,18 @@ class Packet:
     _dest_port: int   = 7877
     _data_size: int   = 0
     _body:      bytes = bytes()
+    _circ_id:   int   = 0
+    _stream_id: int   = 0
+
+
+    def __post_init__(self) -> None:
+        # Route constructor arguments through the mutators so enums and strings are normalized
+        self.preamble = self._preamble
+        self.body     = self._body
 
 
-    def construct(self, preamble: Enum | int, ip: str, port: int, size: int, body: bytes | str) -> None:
+    def construct(self, preamble: Enum | int, ip: str, port: int, size: int, body: bytes | memoryview | str,
+                  circ_id: int = 0, stream_id: int = 0) -> None:
         '''Changes the internal variables of the instance.
 
         Parameters:
@@ -65,7 +118,9 @@ class Packet:
             ip (str): IP address for the destination.
             port (int): Target port associated with the IP address.
             size (int): Size of the overall message.
-            body (bytes | str): Data associated with the message type.
+            body (bytes | memoryview | str): Data associated with the message type.
+            circ_id (int): Circuit the packet travels along, if any.
+            stream_id (int): Stream within the circuit the packet belongs to, if any.
         
         '''
         self.preamble   = preamble
@@ -73,32 +128,136 @@ class Packet:
         self._dest_port = port
         self._data_size = size
         self.body       = body
+        self._circ_id   = circ_id
+        self._stream_id = stream_id
 
 
-    def pack(self) -> bytes:
+    def pack(self) -> bytearray:
         '''Pack everything in the class into a single bytes object.
 
         Returns:
-            The preamble concatenated with the body of the calling class instance.
+            The header concatenated with the body of the calling class instance.
         
         '''
-        return(pack(f"!H9sHH{int(len(self._body))}s",
-                    self._preamble,
-                    self._dest_ip.encode("utf-8"),
-                    self._dest_port,
-                    self._data_size,
-                    self._body))
+        packed = bytearray(HEADER.size + len(self._body))
+        self.pack_into(packed)
+        return packed
+
+
+    def pack_into(self, buffer: bytearray, offset: int = 0) -> int:
+        '''Pack the packet into an existing buffer, such as one reused between packets.
+
+        Parameters:
+            buffer (bytearray): Writable buffer with room for the header and body at `offset`.
+            offset (int): Position in `buffer` the packet starts at.
+
+        Returns:
+            The number of bytes written.
+        
+        '''
+        HEADER.pack_into(buffer, offset,
+                         self._preamble,
+                         pack_ip(self._dest_ip),
+                         self._dest_port,
+                         self._data_size,
+                         self._circ_id,
+                         self._stream_id)
+        end = offset + HEADER.size + len(self._body)
+        buffer[(offset + HEADER.size):end] = self._body
+        return end - offset
     
 
+    def frame(self) -> bytearray:
+        '''Pack the packet behind a length header so it can be recovered from a byte stream.
+
+        Returns:
+            The length of the packed packet followed by the packet itself.
+        
+        '''
+        framed = bytearray(FRAME_HEADER.size + HEADER.size + len(self._body))
+        FRAME_HEADER.pack_into(framed, 0, HEADER.size + len(self._body))
+        self.pack_into(framed, FRAME_HEADER.size)
+        return framed
+
+
+    def reserve_frame(self, body_size: int, slack: int = 0) -> bytearray:
+        '''Frame the packet's header while leaving its body to be written in place by the caller.
+
+        Parameters:
+            body_size (int): Size of the body that will be written after the header.
+            slack (int): Extra bytes at the end of the buffer for writers that need room past the body, which the
+                         caller must trim afterwards.
+
+        Returns:
+            A buffer holding the framed header, followed by `body_size + slack` bytes of space.
+        
+        '''
+        framed = bytearray(FRAME_HEADER.size + HEADER.size + body_size + slack)
+        FRAME_HEADER.pack_into(framed, 0, HEADER.size + body_size)
+        HEADER.pack_into(framed, FRAME_HEADER.size,
+                         self._preamble,
+                         pack_ip(self._dest_ip),
+                         self._dest_port,
+                         self._data_size,
+                         self._circ_id,
+                         self._stream_id)
+        return framed
+
+
+    def cells(self, cell_size: int = CELL_SIZE) -> bytearray:
+        '''Split the packet into consecutive fixed-size cells, with the data size of each set to the body's length.
+
+        Parameters:
+            cell_size (int): Size of every cell, including its header.
+
+        Returns:
+            A single buffer holding every cell, ready to be sent in one call.
+        
+        '''
+        capacity = cell_size - HEADER.size - CELL_LENGTH.size
+        count = max(1, -(-len(self._body) // capacity))
+        buffer = bytearray(count * cell_size)
+        ip = pack_ip(self._dest_ip)
+        with memoryview(self._body) as body:
+            for i in range(0, count):
+                offset = i * cell_size
+                fragment = body[(i * capacity):((i + 1) * capacity)]
+                HEADER.pack_into(buffer, offset, self._preamble, ip, self._dest_port, len(body), self._circ_id,
+                                 self._stream_id)
+                CELL_LENGTH.pack_into(buffer, offset + HEADER.size, len(fragment))
+                start = offset + HEADER.size + CELL_LENGTH.size
+                buffer[start:(start + len(fragment))] = fragment
+        return buffer
+
+
     def unpack(self, packet: bytes) -> None:
         '''Converts packed byte sequence into a readable packet.
 
         Parameters:
-            packet (bytes): Raw byte sequence to be unpacked into Packet object.
+            packet (bytes): Raw byte sequence to be unpacked into Packet object. The body refers to this memory
+                            rather than copying it, so it must not be modified afterwards.
         
         '''
-        preamble, ip, port, size, body = unpack(f"!H9sHH{len(packet)-15}s", packet)
-        self.construct(preamble, ip, port, size, body)
+        self.unpack_from(packet, 0, len(packet))
+
+
+    def unpack_from(self, buffer: bytes, offset: int, size: int) -> None:
+        '''Unpack a packet stored within a larger buffer without copying its body.
+
+        Parameters:
+            buffer (bytes): Buffer containing the packed packet.
+            offset (int): Position in `buffer` the packet starts at.
+            size (int): Length of the packed packet, including its header.
+        
+        '''
+        preamble, ip, port, size_field, circ_id, stream_id = HEADER.unpack_from(buffer, offset)
+        self._preamble  = preamble
+        self._dest_ip   = unpack_ip(ip)
+        self._dest_port = port
+        self._data_size = size_field
+        self._circ_id   = circ_id
+        self._stream_id = stream_id
+        self._body      = memoryview(buffer)[(offset + HEADER.size):(offset + size)]
 
 
     # Accessors and Mutators -----------------------------------------------------------------------
@@ -114,13 +273,53 @@ class Packet:
         self._preamble = p
 
 
+    @property
+    def dest_ip(self) -> str:
+        return self._dest_ip
+
+
+    @property
+    def dest_port(self) -> int:
+        return self._dest_port
+
+
+    @property
+    def data_size(self) -> int:
+        return self._data_size
+
+
+    @property
+    def circ_id(self) -> int:
+        return self._circ_id
+
+
+    @circ_id.setter
+    def circ_id(self, c: int) -> None:
+        self._circ_id = c
+
+
+    @property
+    def stream_id(self) -> int:
+        return self._stream_id
+
+
+    @stream_id.setter
+    def stream_id(self, s: int) -> None:
+        self._stream_id = s
+
+
+    @property
+    def raw_body(self) -> memoryview:
+        return memoryview(self._body)
+
+
     @property
     def body(self) -> str:
-        return self._body.decode("utf-8")
+        return str(self._body, "utf-8")
     
 
     @body.setter
-    def body(self, b: Union[bytes, str]) -> None:
+    def body(self, b: Union[bytes, memoryview, str]) -> None:
         if(isinstance(b, str)):
             b = b.encode("utf-8")
         self._body = b
@@ -130,3 +329,489 @@ class Packet:
     def __str__(self) -> str:
         return(f"[{self.preamble}, {self.body}]")
 
+
+
+# ======================================================================================================================
+class PacketDecoder(object):
+    '''Incremental decoder that recovers framed packets from a byte stream.
+
+    Bytes may be fed in arbitrarily sized pieces, so packets split across reads or several packets arriving in a
+    single read are both handled.
+
+    Attributes:
+        _pending (memoryview): Unconsumed tail of the most recently fed chunk.
+        _frame (Union[bytearray, None]): Frame being assembled from several chunks, or `None`.
+        _filled (int): Number of bytes of `_frame` received so far.
+
+    Note:
+        Packets contained entirely in one chunk are decoded in place, with their bodies referring to the chunk. Only
+        packets that straddle chunks are copied, once, into a buffer of exactly their frame size. Fed chunks must not
+        be modified afterwards.
+    
+    '''
+    def __init__(self) -> None:
+        self._pending: memoryview             = memoryview(b'')
+        self._frame:   Union[bytearray, None] = None
+        self._filled:  int                    = 0
+
+
+    def feed(self, data: bytes) -> None:
+        '''Append newly received bytes to the decoder.
+
+        Parameters:
+            data (bytes): Bytes read from the stream.
+        
+        '''
+        if(len(self._pending) > 0):
+            # Move the incomplete tail of the last chunk into its own frame buffer
+            if(self._frame is None):
+                self._frame = bytearray(FRAME_HEADER.size)
+                self._filled = 0
+            self._fill()
+            if(len(self._pending) > 0):
+                # Caller fed again without draining complete packets; rare, so just join the two
+                self._pending = memoryview(bytes(self._pending) + bytes(data))
+                return
+        self._pending = memoryview(data)
+
+
+    def recv_from(self, sock: socket.socket) -> int:
+        '''Read whatever is available from a blocking socket into the decoder.
+
+        Parameters:
+            sock (socket.socket): Socket to read from.
+
+        Returns:
+            The number of bytes read, 0 if the connection was closed.
+        
+        '''
+        data = sock.recv(READ_SIZE)
+        self.feed(data)
+        return len(data)
+
+
+    def next_packet(self) -> Union[Packet, None]:
+        '''Decode the next complete packet in the buffer.
+
+        Returns:
+            The decoded `Packet`, or `None` if more bytes are needed.
+
+        Raises:
+            ValueError: The stream announced a packet larger than `MAX_PACKET_SIZE`.
+        
+        '''
+        packet = Packet()
+        if(self._frame is not None):
+            self._fill()
+            if(self._filled < len(self._frame)):
+                return None
+            packet.unpack_from(self._frame, FRAME_HEADER.size, len(self._frame) - FRAME_HEADER.size)
+            self._frame = None
+            return packet
+        if(len(self._pending) < FRAME_HEADER.size):
+            return None
+        size = self._frame_size(self._pending)
+        if(len(self._pending) < (FRAME_HEADER.size + size)):
+            return None
+        packet.unpack_from(self._pending, FRAME_HEADER.size, size)
+        self._pending = self._pending[(FRAME_HEADER.size + size):]
+        return packet
+
+
+    def _fill(self) -> None:
+        '''Copy pending bytes into the frame under assembly, sizing it once its length header is known.
+        
+        '''
+        if(self._filled < FRAME_HEADER.size):
+            take = min(FRAME_HEADER.size - self._filled, len(self._pending))
+            self._frame[self._filled:(self._filled + take)] = self._pending[:take]
+            self._filled += take
+            self._pending = self._pending[take:]
+            if(self._filled < FRAME_HEADER.size):
+                return
+            header = self._frame
+            self._frame = bytearray(FRAME_HEADER.size + self._frame_size(header))
+            self._frame[:FRAME_HEADER.size] = header
+        take = min(len(self._frame) - self._filled, len(self._pending))
+        self._frame[self._filled:(self._filled + take)] = self._pending[:take]
+        self._filled += take
+        self._pending = self._pending[take:]
+
+
+    def detach(self) -> bytes:
+        '''Stop decoding and hand back every byte received past the last packet decoded, so the rest of the stream
+           can be passed on untouched.
+
+        Returns:
+            The undecoded bytes, in stream order.
+        
+        '''
+        leftover = bytearray()
+        if(self._frame is not None):
+            leftover += self._frame[:self._filled]
+        leftover += self._pending
+        self._frame = None
+        self._filled = 0
+        self._pending = memoryview(b'')
+        return bytes(leftover)
+
+
+    @staticmethod
+    def _frame_size(buffer: bytes) -> int:
+        size = FRAME_HEADER.unpack_from(buffer)[0]
+        if(size > MAX_PACKET_SIZE):
+            raise(ValueError(f"Frame of {size} bytes exceeds maximum packet size"))
+        return size
+
+
+    def __iter__(self) -> Iterator[Packet]:
+        packet = self.next_packet()
+        while packet is not None:
+            yield packet
+            packet = self.next_packet()
+
+
+
+# ======================================================================================================================
+class CellDecoder(object):
+    '''Decoder for streams of fixed-size cells that reassembles packets fragmented across several cells.
+
+    Cell boundaries fall at fixed offsets, so no length parsing is needed to find the next cell. Blocking sockets are
+    read in batches with `recv_into` straight into a buffer allocated once per decoder.
+
+    Attributes:
+        _cell_size (int): Size of every cell on the stream.
+        _passthrough (Collection[int]): Preambles yielded as individual cells rather than reassembled.
+        _batch (bytearray): Preallocated buffer receiving up to `CELL_BATCH` cells per read.
+        _pending (memoryview): Unconsumed cells of the most recent read.
+        _cell (bytearray): Cell being assembled from the end of one read and the start of the next.
+        _filled (int): Number of bytes of `_cell` received so far.
+        _partial (Dict[Tuple[int, int, int], Tuple[bytearray, int]]): Bodies being reassembled and their fill
+                                                                      levels, keyed by preamble, circuit ID and
+                                                                      stream ID.
+
+    Note:
+        Cells yielded for a passthrough preamble refer to the decoder's read buffer, so they are only valid until the
+        decoder next reads. Reassembled packets own their memory.
+    
+    '''
+    def __init__(self, cell_size: int = CELL_SIZE, passthrough: Collection[int] = ()) -> None:
+        self._cell_size:   int                                               = cell_size
+        self._passthrough: Collection[int]                                   = passthrough
+        self._batch:       bytearray                                         = bytearray(cell_size * CELL_BATCH)
+        self._pending:     memoryview                                        = memoryview(b'')
+        self._cell:        bytearray                                         = bytearray(cell_size)
+        self._filled:      int                                               = 0
+        self._partial:     Dict[Tuple[int, int, int], Tuple[bytearray, int]] = dict()
+
+
+    def feed(self, data: bytes) -> None:
+        '''Append newly received bytes to the decoder.
+
+        Parameters:
+            data (bytes): Bytes read from the stream.
+        
+        '''
+        if((self._filled + len(self._pending)) > self._cell_size):
+            # Caller fed again without draining complete cells; rare, so just join the two
+            self._pending = memoryview(bytes(self._pending) + bytes(data))
+            return
+        self._stash()
+        self._pending = memoryview(data)
+
+
+    def recv_from(self, sock: socket.socket) -> int:
+        '''Read a batch of cells from a blocking socket directly into the decoder's buffer.
+
+        Parameters:
+            sock (socket.socket): Socket to read from.
+
+        Returns:
+            The number of bytes read, 0 if the connection was closed.
+        
+        '''
+        self._stash()
+        received = sock.recv_into(self._batch)
+        self._pending = memoryview(self._batch)[:received]
+        return received
+
+
+    def next_packet(self) -> Union[Packet, None]:
+        '''Decode cells until a packet is complete or a passthrough cell is found.
+
+        Returns:
+            The decoded `Packet`, or `None` if more bytes are needed.
+        
+        '''
+        while True:
+            if(self._filled > 0):
+                # Finish the cell that straddled two reads
+                take = min(self._cell_size - self._filled, len(self._pending))
+                self._cell[self._filled:(self._filled + take)] = self._pending[:take]
+                self._filled += take
+                self._pending = self._pending[take:]
+                if(self._filled < self._cell_size):
+                    return None
+                self._filled = 0
+                packet = self._decode(memoryview(self._cell), True)
+            elif(len(self._pending) >= self._cell_size):
+                packet = self._decode(self._pending[:self._cell_size], False)
+                self._pending = self._pending[self._cell_size:]
+            else:
+                return None
+            if(packet is not None):
+                return packet
+
+
+    def _decode(self, cell: memoryview, reused: bool) -> Union[Packet, None]:
+        '''Decode a single cell, adding it to any packet it is a fragment of.
+
+        Parameters:
+            cell (memoryview): One whole cell.
+            reused (bool): The cell's memory is overwritten by the next straddling cell, so it must be copied even
+                           when passed through.
+
+        Returns:
+            A passthrough cell or a completed packet, otherwise `None`.
+
+        Raises:
+            ValueError: The cell claims more data than it holds, or than is left of the packet it belongs to.
+        
+        '''
+        preamble, ip, port, total, circ_id, stream_id = HEADER.unpack_from(cell)
+        length = CELL_LENGTH.unpack_from(cell, HEADER.size)[0]
+        start = HEADER.size + CELL_LENGTH.size
+        if(length > (self._cell_size - start)):
+            raise(ValueError(f"Cell claims {length} bytes of data but can hold at most {self._cell_size - start}"))
+        fragment = cell[start:(start + length)]
+        packet = Packet()
+        if(preamble in self._passthrough):
+            packet.construct(preamble, unpack_ip(ip), port, total, bytes(fragment) if reused else fragment, circ_id,
+                             stream_id)
+            return packet
+        # Streams sharing a circuit may interleave their cells, so each one is reassembled separately
+        key = (preamble, circ_id, stream_id)
+        if((key not in self._partial) and (length == total)):
+            # Single cell packet, copied out so the read buffer can be reused
+            packet.construct(preamble, unpack_ip(ip), port, total, bytes(fragment), circ_id, stream_id)
+            return packet
+        if(total > MAX_PACKET_SIZE):
+            raise(ValueError(f"Fragmented packet of {total} bytes exceeds maximum packet size"))
+        body, filled = self._partial.get(key, (None, 0))
+        if(body is None):
+            body = bytearray(total)
+        if((filled + length) > len(body)):
+            self._partial.pop(key, None)
+            raise(ValueError(f"Fragments of a {len(body)} byte packet carry at least {filled + length} bytes"))
+        body[filled:(filled + length)] = fragment
+        filled += length
+        if(filled < total):
+            self._partial[key] = (body, filled)
+            return None
+        self._partial.pop(key, None)
+        packet.construct(preamble, unpack_ip(ip), port, total, memoryview(body), circ_id, stream_id)
+        return packet
+
+
+    def detach(self) -> bytes:
+        '''Stop decoding and hand back every byte received past the last cell decoded, so the rest of the stream can
+           be passed on untouched. Fragments of packets still being reassembled are discarded.
+
+        Returns:
+            The undecoded bytes, in stream order.
+        
+        '''
+        leftover = bytes(self._cell[:self._filled]) + bytes(self._pending)
+        self._filled = 0
+        self._pending = memoryview(b'')
+        self._partial.clear()
+        return leftover
+
+
+    def _stash(self) -> None:
+        '''Move the incomplete cell left at the end of the last read into its own buffer before the next read.
+        
+        '''
+        if(len(self._pending) > 0):
+            self._cell[self._filled:(self._filled + len(self._pending))] = self._pending
+            self._filled += len(self._pending)
+            self._pending = memoryview(b'')
+
+
+    def __iter__(self) -> Iterator[Packet]:
+        packet = self.next_packet()
+        while packet is not None:
+            yield packet
+            packet = self.next_packet()
+
+
+
+# ======================================================================================================================
+class FrameCodec(object):
+    '''Wire format sending each packet as a single length-prefixed frame.
+
+    Attributes:
+        fixed (bool): Whether packets are split into fixed-size cells.
+    
+    '''
+    fixed: bool = False
+
+
+    def encode(self, packet: Packet) -> bytearray:
+        '''Convert a packet into bytes ready to be written to a stream.
+
+        Parameters:
+            packet (Packet): Packet to be sent.
+
+        Returns:
+            The framed packet.
+        
+        '''
+        return packet.frame()
+
+
+    def reserve(self, packet: Packet, body_size: int, slack: int = 0) -> Tuple[bytearray, int]:
+        '''Encode a packet's header, leaving room for its body to be written in place.
+
+        Parameters:
+            packet (Packet): Packet supplying the header fields.
+            body_size (int): Size of the body that will be written.
+            slack (int): Extra bytes at the end of the buffer, which the caller must trim afterwards.
+
+        Returns:
+            The encoded buffer and the offset its body is to be written at.
+        
+        '''
+        return packet.reserve_frame(body_size, slack), FRAME_HEADER.size + HEADER.size
+
+
+    def decoder(self, passthrough: Collection[int] = ()) -> PacketDecoder:
+        '''Create a decoder for a stream in this format.
+
+        Parameters:
+            passthrough (Collection[int]): Unused, as frames always hold whole packets.
+
+        Returns:
+            A new decoder.
+        
+        '''
+        return PacketDecoder()
+
+
+
+class CellCodec(object):
+    '''Wire format splitting every packet into fixed-size cells, in the style of Tor.
+
+    Attributes:
+        fixed (bool): Whether packets are split into fixed-size cells.
+        cell_size (int): Size of every cell.
+        capacity (int): Largest fragment a single cell can carry.
+    
+    '''
+    fixed: bool = True
+
+
+    def __init__(self, cell_size: int = CELL_SIZE) -> None:
+        self.cell_size: int = cell_size
+        self.capacity:  int = cell_size - HEADER.size - CELL_LENGTH.size
+
+
+    def encode(self, packet: Packet) -> bytearray:
+        '''Convert a packet into bytes ready to be written to a stream.
+
+        Parameters:
+            packet (Packet): Packet to be sent.
+
+        Returns:
+            The packet split into one or more cells.
+        
+        '''
+        return packet.cells(self.cell_size)
+
+
+    def reserve(self, packet: Packet, body_size: int, slack: int = 0) -> Tuple[bytearray, int]:
+        '''Encode a single cell's header, leaving room for its fragment to be written in place.
+
+        Parameters:
+            packet (Packet): Packet supplying the header fields, with `data_size` holding the size of the whole
+                             body the fragment belongs to.
+            body_size (int): Size of the fragment that will be written, at most `capacity`.
+            slack (int): Extra bytes at the end of the buffer, which the caller must trim afterwards.
+
+        Returns:
+            The encoded cell and the offset its fragment is to be written at.
+        
+        '''
+        cell = bytearray(self.cell_size + slack)
+        HEADER.pack_into(cell, 0, packet.preamble, pack_ip(packet.dest_ip), packet.dest_port, packet.data_size,
+                         packet.circ_id, packet.stream_id)
+        CELL_LENGTH.pack_into(cell, HEADER.size, body_size)
+        return cell, HEADER.size + CELL_LENGTH.size
+
+
+    def decoder(self, passthrough: Collection[int] = ()) -> CellDecoder:
+        '''Create a decoder for a stream in this format.
+
+        Parameters:
+            passthrough (Collection[int]): Preambles to be yielded cell by cell instead of reassembled.
+
+        Returns:
+            A new decoder.
+        
+        '''
+        return CellDecoder(self.cell_size, passthrough)
+
+
+
+Codec = Union[FrameCodec, CellCodec]
+
+
+
+# ======================================================================================================================
+def recv_packet(sock: socket.socket, decoder: Union[PacketDecoder, CellDecoder]) -> Packet:
+    '''Block until a complete packet has been received on a socket.
+
+    Parameters:
+        sock (socket.socket): Connected socket to read from.
+        decoder (Union[PacketDecoder, CellDecoder]): Decoder holding any bytes already read from `sock`.
+
+    Returns:
+        The next packet on the stream.
+
+    Raises:
+        ConnectionError: The remote end closed the connection before a full packet arrived.
+    
+    '''
+    packet = decoder.next_packet()
+    while packet is None:
+        if(decoder.recv_from(sock) == 0):
+            raise(ConnectionError("Connection closed mid-packet"))
+        packet = decoder.next_packet()
+    return packet
+
+
+async def read_packets(reader: asyncio.StreamReader, codec: Codec, passthrough: Collection[int] = (),
+                       decoder: Union[PacketDecoder, CellDecoder, None] = None) -> AsyncIterator[Packet]:
+    '''Yield every packet arriving on an asyncio stream until it is closed.
+
+    Parameters:
+        reader (asyncio.StreamReader): Stream to read from.
+        codec (Codec): Wire format used on the stream.
+        passthrough (Collection[int]): Preambles to be yielded cell by cell instead of reassembled in cell mode.
+        decoder (Union[PacketDecoder, CellDecoder, None]): Decoder to use, so the caller can reach bytes it has
+                                                           buffered, or `None` to create one from `codec`.
+
+    Note:
+        Packets are decoded only as they are requested, so a caller that stops iterating leaves every later byte in
+        the decoder.
+    
+    '''
+    if(decoder is None):
+        decoder = codec.decoder(passthrough)
+    while True:
+        data = await reader.read(READ_SIZE)
+        if(not data):
+            return
+        decoder.feed(data)
+        for packet in decoder:
+            yield packet
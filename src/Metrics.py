@@ -0,0 +1,206 @@
+from Link import Link
+import Messages
+
+from bisect import bisect_left
+import json
+import os
+import socket
+import threading
+from time import time
+from typing import Dict, Iterable, List, Sequence, Union
+
+
+# Histogram bucket upper bounds, in seconds
+SETUP_BUCKETS    = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CRYPTO_BUCKETS   = (1e-06, 2.5e-06, 5e-06, 1e-05, 2.5e-05, 5e-05, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01)
+# Cryptographic work timed by the server component
+CRYPTO_FORWARD   = "forward"   # Peeling a circuit layer off a cell travelling away from the client
+CRYPTO_BACKWARD  = "backward"  # Adding a circuit layer to a cell travelling back to the client
+CRYPTO_HANDSHAKE = "handshake" # Opening a `MSG_CREATE` onion skin and completing the key exchange
+CRYPTO_ONION     = "onion"     # Peeling one layer of a `MSG_FORWARD` onion
+STATS_TIMEOUT    = 5.0         # Seconds a node has to answer a `MSG_STATS` request
+
+
+def preamble_name(preamble: int) -> str:
+    '''Name a preamble for display, including ones sent by a peer that this node does not know.
+
+    Parameters:
+        preamble (int): Preamble read from a packet header.
+
+    Returns:
+        The name of the message type, or the number itself if it is unknown.
+
+    '''
+    try:
+        return Messages.Preambles(preamble).name
+    except ValueError:
+        return str(preamble)
+
+
+# ======================================================================================================================
+class Histogram(object):
+    '''Counts observations into fixed buckets, cheaply enough to be updated on every packet.
+
+    Attributes:
+        bounds (Sequence[float]): Upper bound of every bucket but the last, which holds everything above them.
+        counts (List[int]): Observations in each bucket.
+        total (float): Sum of every observation.
+
+    '''
+    def __init__(self, bounds: Sequence[float]) -> None:
+        self.bounds: Sequence[float] = bounds
+        self.counts: List[int]       = [0] * (len(bounds) + 1)
+        self.total:  float           = 0.0
+
+
+    def observe(self, value: float) -> None:
+        '''Record one observation.
+
+        Parameters:
+            value (float): Observed value, in the same unit as the bucket bounds.
+
+        '''
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.total += value
+
+
+    def quantile(self, q: float) -> Union[float, None]:
+        '''Estimate a quantile as the upper bound of the bucket it falls in.
+
+        Parameters:
+            q (float): Quantile between 0 and 1.
+
+        Returns:
+            The estimate, infinity if it lies above every bound, or `None` if nothing was observed.
+
+        '''
+        count = sum(self.counts)
+        if(count == 0):
+            return None
+        rank = q * count
+        seen = 0
+        for bound, bucket in zip(self.bounds, self.counts):
+            seen += bucket
+            if(seen >= rank):
+                return bound
+        return float("inf")
+
+
+    def snapshot(self) -> Dict:
+        '''Summarize the histogram in a structure that can be sent as JSON.
+
+        '''
+        count = sum(self.counts)
+        labels = [str(bound) for bound in self.bounds] + ["inf"]
+        return {"count":   count,
+                "mean":    (self.total / count) if count else None,
+                "p50":     self.quantile(0.5),
+                "p99":     self.quantile(0.99),
+                "buckets": dict(zip(labels, self.counts))}
+
+
+
+class Metrics(object):
+    '''Counters kept by a node about the traffic it handles, read out with `MSG_STATS`.
+
+    Attributes:
+        started (float): Wall-clock time the counters were started.
+        packets (Dict[int, int]): Packets received by the server component, keyed by preamble.
+        bytes_in (Dict[str, int]): Bytes received over links that have since closed, keyed by peer.
+        bytes_out (Dict[str, int]): Bytes sent over links that have since closed, keyed by peer.
+        crypto (Dict[str, Histogram]): Seconds spent on each kind of cryptographic work, one observation per layer.
+        extend_latency (Histogram): Seconds the next hop took to answer when this node extended a circuit.
+        build_latency (Histogram): Seconds the client component took to build each whole circuit.
+        lock (threading.Lock): Guards `build_latency`, which the client updates from more than one thread.
+
+    Note:
+        Everything else is only updated by the server component from its event loop, so it takes no lock. Bytes
+        moved over open links are counted by the links themselves and added in when a snapshot is taken.
+
+    '''
+    def __init__(self) -> None:
+        self.started:        float                = time()
+        self.packets:        Dict[int, int]       = dict()
+        self.bytes_in:       Dict[str, int]       = dict()
+        self.bytes_out:      Dict[str, int]       = dict()
+        self.crypto:         Dict[str, Histogram] = {kind: Histogram(CRYPTO_BUCKETS) for kind in
+                                                     (CRYPTO_FORWARD, CRYPTO_BACKWARD, CRYPTO_HANDSHAKE, CRYPTO_ONION)}
+        self.extend_latency: Histogram            = Histogram(SETUP_BUCKETS)
+        self.build_latency:  Histogram            = Histogram(SETUP_BUCKETS)
+        self.lock:           threading.Lock       = threading.Lock()
+
+
+    def circuit_built(self, seconds: float) -> None:
+        '''Record how long the client component took to build a circuit.
+
+        Parameters:
+            seconds (float): Time from the first handshake to the last hop being added.
+
+        '''
+        with self.lock:
+            self.build_latency.observe(seconds)
+
+
+    def link_closed(self, link: Link) -> None:
+        '''Keep the byte counts of a link once it has closed.
+
+        Parameters:
+            link (Link): Link that is no longer used.
+
+        '''
+        self.bytes_in[link.name] = self.bytes_in.get(link.name, 0) + link.received
+        self.bytes_out[link.name] = self.bytes_out.get(link.name, 0) + link.sent
+
+
+    def snapshot(self, links: Iterable[Link], queues: Dict[str, int]) -> Dict:
+        '''Gather every counter into a structure that can be sent as JSON.
+
+        Parameters:
+            links (Iterable[Link]): Links still open, whose byte counts are added to those of closed links.
+            queues (Dict[str, int]): Current depth of the node's queues.
+
+        Returns:
+            The counters, keyed by name.
+
+        '''
+        bytes_in = dict(self.bytes_in)
+        bytes_out = dict(self.bytes_out)
+        for link in links:
+            bytes_in[link.name] = bytes_in.get(link.name, 0) + link.received
+            bytes_out[link.name] = bytes_out.get(link.name, 0) + link.sent
+        with self.lock:
+            build_latency = self.build_latency.snapshot()
+        return {"pid":            os.getpid(),
+                "uptime":         time() - self.started,
+                "packets":        {preamble_name(preamble): count for preamble, count in self.packets.items()},
+                "bytes_in":       bytes_in,
+                "bytes_out":      bytes_out,
+                "crypto":         {kind: histogram.snapshot() for kind, histogram in self.crypto.items()},
+                "extend_latency": self.extend_latency.snapshot(),
+                "build_latency":  build_latency,
+                "queues":         queues}
+
+
+def fetch(ip: str, port: int, codec: Messages.Codec, timeout: float = STATS_TIMEOUT) -> Dict:
+    '''Ask a node for its counters.
+
+    Parameters:
+        ip (str): Address of the node, which only answers requests arriving over its loopback interface.
+        port (int): Port of the node's server component.
+        codec (Messages.Codec): Wire format the node runs with.
+        timeout (float): Seconds to wait for the node to answer.
+
+    Returns:
+        The node's counters, as built by `Metrics.snapshot`.
+
+    Raises:
+        OSError: The node could not be reached or did not answer in time.
+        PermissionError: The node refused to share its counters.
+
+    '''
+    with socket.create_connection((ip, port), timeout=timeout) as sock:
+        sock.sendall(codec.encode(Messages.Packet(Messages.Preambles.MSG_STATS.value, ip, port, 0, b'')))
+        reply = Messages.recv_packet(sock, codec.decoder())
+    if(reply.preamble != Messages.Preambles.MSG_STATS.value):
+        raise(PermissionError(f"Node answered with {Messages.Preambles(reply.preamble)}"))
+    return json.loads(bytes(reply.raw_body))
@@ -1,17 +1,52 @@
+import Circuit
+from CircuitPool import CircuitPool
+import ConnectionPool
+import Directory
+import Dispatch
+import KeyCache
 from KeyStore import KeyStore
+from Link import Link, LinkManager
+import Log
 import Messages
+import Metrics
+from Onion import OnionBuilder
 from PeerNode import PeerNode
+import Prober
+import Profile
+import RouteSelector
+import Transfer
 
 import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeout
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
+import ipaddress
 import json
+import os
 from os import path
 import random
+import signal
 import socket
+import sys
 import threading
-from time import sleep
-from typing import List, Union
+from time import perf_counter, sleep
+from types import FrameType
+from asyncio import selector_events
+from typing import Callable, Coroutine, Dict, List, Set, Tuple, Union
+
+
+SERVER_BACKLOG     = 1024 # Pending connections the listening socket will queue
+RELAY_PASSTHROUGH  = (Messages.Preambles.MSG_RELAY.value,) # Relayed cell by cell rather than reassembled
+# Key bootstrap
+BOOTSTRAP_WORKERS  = 64   # Core nodes contacted at once
+KEY_TIMEOUT        = 5.0  # Seconds a connected core node has to answer a key request
+BOOTSTRAP_DEADLINE = 30.0 # Seconds before the bootstrap carries on without the core nodes yet to answer
+# Circuit building
+BUILD_TIMEOUT      = 10.0 # Seconds a circuit build may wait on a connection or a handshake reply
+MEASURED_TRANSFER  = 256 * 1024 # Bytes a transfer must carry before its throughput weights the relays it ran along
+# Worker processes
+WORKER_POLL        = 1.0  # Seconds between a worker's checks that the process which forked it is still running
 
 
 class Node(object):
@@ -22,41 +57,108 @@ class Node(object):
                     to "relay" most of the time.
         route (list[PeerNode.PeerNode]): The route the client component will use when sending data
                                          to the desired destination.
+        selector (RouteSelector.RouteSelector): Weighted sampler over every relay whose key is known.
+        route_depth (int): Number of relays in each circuit the client builds ahead of time.
+        codec (Messages.Codec): Wire format used on every connection, either length-prefixed frames
+                                or fixed-size cells.
         server_port (int): The port at which the server component can be reached.
         server_sock (socket.socket): The socket object for the server through which network data is
                                      passed.
         server_thread (threading.Thread): Secondary thread the server component will run on
                                           separately from the client.
-        client_socket (socket.socket): Socket object over which client will send outgoing data.
+        server_tasks (Set[asyncio.Task]): Background tasks running on the server's event loop.
+        links (LinkManager): Persistent links to neighbouring relays, shared by every circuit extended through them.
+        active_links (Set[Link]): Every link the server component is reading from, opened by either side.
+        metrics (Metrics.Metrics): Counters of the traffic handled, sent to local peers asking with `MSG_STATS`.
+        dispatcher (Dispatch.Dispatcher): Handlers of the packets the server component acts on, keyed by preamble.
+        pool (ConnectionPool.ConnectionPool): Warm outgoing connections shared by everything the client
+                                              component sends.
         client_thread (threading.Thread): Secondary thread the client will run on separately from
                                           the server.
         keystore (Keystore.Keystore): Keystore object holding all public keys of peers and private
                                       keys of server and client components.
+        onions (OnionBuilder): Builds the layered packets sent along `route` with `MSG_FORWARD`.
+        circuits (Circuit.CircuitTable): Circuits passing through the server component and their keys.
+        transfer_dir (Union[str, None]): Directory files are sent from and stored to when this node ends a circuit,
+                                         or `None` if it does not take part in file transfers.
+        circuit (Circuit.Circuit): Circuit built by the client component along `route`.
+        circuit_pool (CircuitPool): Circuits built ahead of time, ready for new sessions.
+        prober (Union[Prober.Prober, None]): Measures the health of every selectable relay in the background, or
+                                             `None` if probing is disabled.
+        workers (int): Server processes sharing the listening port, each serving the links it accepts.
+        worker_pids (List[int]): Worker processes forked by this process.
+        parent_pid (Union[int, None]): Process that forked this one if it is a worker, otherwise `None`.
+        profiler (Union[Profile.Profiler, None]): Samples where every process spends its time when profiling.
+        directory (Directory.Directory): Relays this node has learned of, passed on to peers asking with `MSG_PEERS`.
+        core_directory (Directory.Directory): Copy of a core node's directory the client component selects relays
+                                              from, kept apart from `directory` so gossip cannot hide changes to it.
+        gossip_seeds (List[PeerNode]): Relays the server component pulls the directory from besides those listed in it.
+        gossip_interval (float): Seconds between the server component's directory pulls, or 0 not to pull at all.
+        gossip_failures (Dict[PeerNode, int]): Directory pulls in a row each relay has failed to answer.
+        sync_interval (float): Seconds between the client component's directory pulls from the core nodes, or 0 to
+                               only pull once at startup.
+        sync_stop (threading.Event): Set when the client component should stop pulling the directory.
+
+    Note:
+        With more than one worker every process binds its own socket to the port with `SO_REUSEPORT`, and the
+        kernel spreads incoming connections across them. Circuit IDs are only meaningful on the link they arrive on,
+        so every circuit lives in the process that accepted its client-facing link, along with the outgoing links
+        it opens, and the processes share no state.
     
     '''
-    def __init__(self, cfg_dir: str, port: Union[int, None] = None, mode: str = "relay") -> None:
+    def __init__(self, cfg_dir: str, port: Union[int, None] = None, mode: str = "relay", workers: int = 1,
+                 profile_dir: Union[str, None] = None) -> None:
         '''Class initializer for `Node` class.
 
         Parameters:
             cfg_dir (str): Directory containing the configuration files for the server and client.
             port (Union[int, None]): The port to listen for connections.
             mode (str): The mode the server should run in.
+            workers (int): Number of server processes to run.
+            profile_dir (Union[str, None]): Directory flame graph samples are written to, or `None` not to profile.
         
         '''
         # Functionality information
-        self.mode:          str              = mode
-        self.route:         List[PeerNode]   = list()
+        self.mode:            str                           = mode
+        self.route:           List[PeerNode]                = list()
+        self.selector:        RouteSelector.RouteSelector   = RouteSelector.RouteSelector()
+        self.route_depth:     int                           = 1
+        self.codec:           Messages.Codec                = Messages.FrameCodec()
         # Server variables
-        self.server_port:   int              = port
-        self.server_sock:   socket.socket    = None
-        self.server_conn:   socket.socket    = None
-        self.server_thread: threading.Thread = None
+        self.server_port:     int                           = port
+        self.server_sock:     socket.socket                 = None
+        self.server_tasks:    Set[asyncio.Task]             = set()
+        self.server_thread:   threading.Thread              = None
+        self.links:           LinkManager                   = None
+        self.active_links:    Set[Link]                     = set()
+        self.circuits:        Circuit.CircuitTable          = Circuit.CircuitTable()
+        self.transfer_dir:    Union[str, None]              = None
+        self.workers:         int                           = max(1, workers)
+        self.worker_pids:     List[int]                     = list()
+        self.parent_pid:      Union[int, None]              = None
+        self.metrics:         Metrics.Metrics               = Metrics.Metrics()
+        self.dispatcher:      Dispatch.Dispatcher           = Dispatch.Dispatcher()
+        self.profiler:        Union[Profile.Profiler, None] = None
+        # Directory variables
+        self.directory:       Directory.Directory           = Directory.Directory()
+        self.core_directory:  Directory.Directory           = Directory.Directory()
+        self.gossip_seeds:    List[PeerNode]                = list()
+        self.gossip_interval: float                         = Directory.GOSSIP_INTERVAL
+        self.gossip_failures: Dict[PeerNode, int]           = dict()
+        self.sync_interval:   float                         = Directory.SYNC_INTERVAL
+        self.sync_stop:       threading.Event               = threading.Event()
         # Client variables
-        self.client_sock:   socket.socket    = None
-        self.client_thread: threading.Thread = None
+        self.pool:            ConnectionPool.ConnectionPool = None
+        self.client_thread:   threading.Thread              = None
+        self.circuit:         Circuit.Circuit               = None
+        self.circuit_pool:    CircuitPool                   = None
+        self.prober:          Union[Prober.Prober, None]    = None
         # Cryptographic information
-        self.keystore:      KeyStore         = KeyStore()
+        self.keystore:        KeyStore                      = KeyStore()
+        self.onions:          OnionBuilder                  = OnionBuilder(self.keystore)
         # Initialization
+        if(profile_dir is not None):
+            self.profiler = Profile.Profiler(profile_dir, self.profile_spans())
         self.load_cfg(path.join(cfg_dir, "server.json"), path.join(cfg_dir, "client.json"))
         self.init_components()
         self.start_threads()
@@ -88,7 +190,20 @@ class Node(object):
             cfg_data = json.load(server_cfg)
         if(self.server_port is None): # Handle port override from argv
             self.server_port = int(cfg_data["connection"]["port"])
+        if(cfg_data["connection"].get("cell_mode", False)):
+            self.codec = Messages.CellCodec()
         self.keystore.load_server_keys(cfg_data["files"]["public_key"], cfg_data["files"]["private_key"])
+        if(cfg_data["files"].get("transfer_dir")):
+            self.transfer_dir = cfg_data["files"]["transfer_dir"]
+            os.makedirs(self.transfer_dir, exist_ok=True)
+        dispatch_cfg = cfg_data.get("dispatch", dict())
+        self.dispatcher.workers = int(dispatch_cfg.get("workers", self.dispatcher.workers))
+        self.register_handlers(dispatch_cfg.get("policies", dict()))
+        directory_cfg = cfg_data.get("directory", dict())
+        self.gossip_interval = float(directory_cfg.get("gossip_interval", self.gossip_interval))
+        for name, socket_addr in directory_cfg.get("seeds", dict()).items():
+            ip, port = socket_addr.split(':')
+            self.gossip_seeds.append(PeerNode(ip, int(port), name))
 
     
     def load_client_cfg(self, cfg_file: str) -> None:
@@ -101,11 +216,41 @@ class Node(object):
         cfg_data = None
         with open(cfg_file, 'r') as client_cfg:
             cfg_data = json.load(client_cfg)
+        if(cfg_data["connection"].get("cell_mode", False)):
+            self.codec = Messages.CellCodec()
+        self.selector = RouteSelector.RouteSelector(bool(cfg_data["connection"].get("distinct_subnets", True)))
+        # Circuits are replaced after a random lifetime between the two reroute bounds
+        self.route_depth = int(cfg_data["connection"].get("route_depth", self.route_depth))
+        self.circuit_pool = CircuitPool(self.new_circuit,
+                                        int(cfg_data["connection"].get("prebuilt_circuits", 2)),
+                                        float(cfg_data["connection"].get("reroute_min", 30)),
+                                        float(cfg_data["connection"].get("reroute_max", 180)))
+        pool_cfg = cfg_data.get("pool", dict())
+        self.pool = ConnectionPool.ConnectionPool(self.codec,
+                                                  int(pool_cfg.get("max_per_peer", ConnectionPool.MAX_PER_PEER)),
+                                                  float(pool_cfg.get("idle_timeout", ConnectionPool.IDLE_TIMEOUT)),
+                                                  float(pool_cfg.get("keepalive", ConnectionPool.KEEPALIVE)),
+                                                  int(pool_cfg.get("retries", ConnectionPool.RETRIES)),
+                                                  float(pool_cfg.get("backoff", ConnectionPool.BACKOFF)))
         self.keystore.load_client_keys(cfg_data["files"]["public_key"], cfg_data["files"]["private_key"])
         for name in cfg_data["cores"]:
             ip, port = cfg_data["cores"][name].split(':')
             port = int(port)
             self.keystore.add_peer(PeerNode(ip, port, name, True), None)
+        if(cfg_data["files"].get("key_cache")):
+            cache = KeyCache.KeyCache(cfg_data["files"]["key_cache"],
+                                      float(cfg_data["connection"].get("key_ttl", KeyCache.KEY_TTL)))
+            cache.prune()
+            self.keystore.attach_cache(cache)
+        self.sync_interval = float(cfg_data.get("directory", dict()).get("sync_interval", self.sync_interval))
+        probe_cfg = cfg_data.get("probe", dict())
+        if(float(probe_cfg.get("interval", Prober.PROBE_INTERVAL)) > 0):
+            self.prober = Prober.Prober(self.pool, self.selector.relays, self.relay_health,
+                                        float(probe_cfg.get("interval", Prober.PROBE_INTERVAL)),
+                                        float(probe_cfg.get("timeout", Prober.PROBE_TIMEOUT)),
+                                        float(probe_cfg.get("alpha", Prober.RTT_ALPHA)),
+                                        int(probe_cfg.get("failures", Prober.FAILURE_THRESHOLD)),
+                                        float(probe_cfg.get("cooldown", Prober.BREAKER_COOLDOWN)))
 
 
     def init_components(self) -> None:
@@ -113,61 +258,254 @@ class Node(object):
         
         '''
         try:
-            # Initialize server
+            # Initialize server; the client component connects on demand through its pool
             if((self.mode == "server") or (self.mode == "relay")):
-                self.server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.server_sock.bind(('', self.server_port))
-            # Initialize client
-            if((self.mode == "client") or (self.mode == "relay")):
-                self.client_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                if((self.workers > 1) and (not hasattr(socket, "SO_REUSEPORT"))):
+                    Log.server.warning("Worker processes are not supported on this platform, running a single server")
+                    self.workers = 1
+                self.server_sock = self.listen_socket()
         except OSError as ose:
-            print(f"Port {self.server_port} is already bound to a process")
+            Log.server.error("Port %s is already bound to a process", self.server_port)
             exit()
 
 
-    def contact_core(self) -> None:
-        '''Contact all members designated as core nodes for their public keys.
+    def listen_socket(self) -> socket.socket:
+        '''Create the socket the server component accepts connections on.
+
+        Returns:
+            A socket bound to the server port, which other worker processes may bind as well.
+
+        '''
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if(self.workers > 1):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(('', self.server_port))
+        return sock
+
+
+    def contact_core(self, timeout: float = KEY_TIMEOUT, deadline: float = BOOTSTRAP_DEADLINE) -> int:
+        '''Contact all members designated as core nodes for their public keys, all at once, skipping any whose
+           keys are still fresh in the key cache, then learn of the other relays from a core node's directory.
+
+        Parameters:
+            timeout (float): Seconds to wait for any one peer to answer once connected.
+            deadline (float): Seconds to wait for the whole bootstrap before carrying on with the keys received.
+
+        Returns:
+            The number of peers whose keys were received.
         
         '''
-        data_packet = Messages.Packet()
         for peer in self.keystore.peer_public_keys.keys():
-            print(f"[CLIENT] Requesting key from {peer.ip}")
-            # Connect to peer
-            self.client_sock.connect((peer.ip, peer.port))
-            # Send request for key and await response
-            data_packet.construct(Messages.Preambles.MSG_GETKEY, peer.ip, peer.port, 0, "")
-            self.client_sock.send(data_packet.pack())
-            data_packet.unpack(self.client_sock.recv(2048))
-            # Naive approach of assuming data is good
-            print("[CLIENT] Key received")
-            peer_key = data_packet.body
-            self.client_sock.close()
-            self.keystore.set_peer_key(PeerNode(ip=peer.ip, port=peer.port), peer_key)
+            if(self.keystore.has_key(peer)):
+                self.add_relay(peer)
+        received = self.fetch_keys(self.keystore.missing_peers(), timeout, deadline)
+        return received + self.sync_directory(timeout, deadline)
+
+
+    def fetch_keys(self, peers: List[PeerNode], timeout: float = KEY_TIMEOUT,
+                   deadline: float = BOOTSTRAP_DEADLINE) -> int:
+        '''Ask a set of peers for their public keys, all at once, making each selectable as soon as its key arrives.
+           A key that does not match the fingerprint its peer is listed with in the directory is refused.
+
+        Parameters:
+            peers (List[PeerNode]): Stored peers whose keys are wanted.
+            timeout (float): Seconds to wait for any one peer to answer once connected.
+            deadline (float): Seconds to wait for every peer before carrying on with the keys received.
+
+        Returns:
+            The number of peers whose keys were received.
+
+        '''
+        if(len(peers) == 0):
+            return 0
+        received = 0
+        workers = ThreadPoolExecutor(max_workers=min(BOOTSTRAP_WORKERS, len(peers)))
+        requests = {workers.submit(self.request_key, peer, timeout): peer for peer in peers}
+        try:
+            # Store each key as soon as it arrives so the slowest peer does not hold up the others
+            for request in as_completed(requests, timeout=deadline):
+                peer = requests[request]
+                try:
+                    peer_key, rtt = request.result()
+                    peer_key = serialization.load_pem_public_key(bytes(peer_key))
+                    listed = self.core_directory.fingerprint(peer)
+                    if((listed is not None) and (Directory.key_fingerprint(peer_key) != listed)):
+                        raise(ValueError("Key does not match the directory"))
+                    self.keystore.set_peer_key(peer, peer_key)
+                    # The key request doubles as a first latency measurement for route selection
+                    peer.record_success(rtt)
+                    self.add_relay(peer)
+                    received += 1
+                    Log.client.info("Key received from %s", peer.socket_addr)
+                except Exception as e:
+                    Log.client.warning("Unable to get key from %s: %s", peer.socket_addr, e)
+        except FuturesTimeout:
+            Log.client.warning("Gave up waiting on %d peer(s)", len(peers) - received)
+        finally:
+            workers.shutdown(wait=False, cancel_futures=True)
+        return received
+
 
+    def sync_directory(self, timeout: float = KEY_TIMEOUT, deadline: float = BOOTSTRAP_DEADLINE) -> int:
+        '''Read what changed in a core node's directory since the client last read it, and fetch the keys of the
+           listed relays it has none for yet. A single core node is asked, trying the others in turn if it does not
+           answer.
 
-    def connect(self, target: PeerNode) -> None:
-        '''Open an outgoing connection to a specified peer.
+        The keystore and route selection are brought in line with the whole copy of the directory rather than with
+        the changes alone, so a relay whose key could not be fetched is tried again at the next read.
+
+        Parameters:
+            timeout (float): Seconds to wait for any one peer to answer once connected.
+            deadline (float): Seconds to wait for the keys of new relays before carrying on with those received.
+
+        Returns:
+            The number of relays whose keys were received.
+
+        '''
+        cores = self.keystore.get_core_peers()
+        random.shuffle(cores)
+        for core in cores:
+            try:
+                # Reading another core, or one that restarted, replaces the copy along with what it no longer lists
+                changes = self.core_directory.apply(core.socket_addr, self.request_peers(core, timeout), True)
+                break
+            except Exception as e:
+                Log.client.warning("Unable to read the directory of %s: %s", core.socket_addr, e)
+        else:
+            return 0
+        for op, relay, fingerprint in changes:
+            stored = self.keystore.get_peer(relay)
+            if((op == Directory.OP_REMOVE) and (stored is not None) and (not stored.is_core)):
+                self.selector.remove(stored)
+                self.keystore.remove_peer(stored)
+        listed = dict()
+        for relay, fingerprint in self.core_directory.listing():
+            stored = self.keystore.get_peer(relay)
+            if(stored is None):
+                stored = PeerNode(relay.ip, relay.port, "relay-" + fingerprint[:4].hex())
+                self.keystore.add_peer(stored, None)
+            elif((not stored.is_core) and (self.keystore.has_key(stored)) and
+                 (Directory.key_fingerprint(self.keystore.get_pub_key(stored)) != fingerprint)):
+                # Relisted under another key, so the old one must not be used again
+                self.selector.remove(stored)
+                self.keystore.forget_key(stored)
+            listed[stored] = fingerprint
+        if(len(changes) > 0):
+            Log.client.info("Directory of %s brought %d change(s)", core.socket_addr, len(changes))
+        # Cached keys are only used while they match the directory, so only relays new to the cache are contacted
+        self.keystore.load_cached([peer for peer in listed if not self.keystore.has_key(peer)], listed)
+        for peer in listed:
+            if(self.keystore.has_key(peer) and (peer not in self.selector)):
+                self.add_relay(peer)
+        return self.fetch_keys([peer for peer in listed if not self.keystore.has_key(peer)], timeout, deadline)
+
+
+    def sync_loop(self) -> None:
+        '''Keep reading directory changes from the core nodes in the background until the client stops.
+
+        '''
+        while not self.sync_stop.wait(self.sync_interval):
+            self.sync_directory()
+
+
+    def request_peers(self, peer: PeerNode, timeout: float = KEY_TIMEOUT) -> bytes:
+        '''Ask a single peer for the changes to its directory since the client last read it, announcing this node's
+           server component to it if there is one.
+
+        Parameters:
+            peer (PeerNode): Peer to be asked.
+            timeout (float): Seconds to wait for the peer to answer once connected.
+
+        Returns:
+            The body of the peer's `MSG_PEERS` reply.
+
+        Raises:
+            OSError: The peer could not be reached or did not answer in time.
+            ValueError: The peer answered with something other than its directory.
+
+        '''
+        request = self.core_directory.request(peer.socket_addr, *self.announcement())
+        with self.pool.connection(peer) as conn:
+            conn.sock.settimeout(timeout)
+            conn.send(Messages.Packet(Messages.Preambles.MSG_PEERS.value, peer.ip, peer.port, 0, request))
+            reply = conn.recv()
+            conn.sock.settimeout(None)
+            if(reply.preamble != Messages.Preambles.MSG_PEERS.value):
+                raise(ValueError(f"Expected a directory, got {Messages.Preambles(reply.preamble)}"))
+            return bytes(reply.raw_body)
+
+
+    def announcement(self) -> Tuple[int, Union[bytes, None]]:
+        '''Describe this node's server component for the directories of the peers it pulls from.
+
+        Returns:
+            The server port and the fingerprint of the server's public key, or 0 and `None` if no server is running.
+
+        '''
+        if(self.server_sock is None):
+            return 0, None
+        return self.server_port, Directory.key_fingerprint(self.keystore.server_keypair.public)
+
+
+    def request_key(self, peer: PeerNode, timeout: float = KEY_TIMEOUT) -> Tuple[memoryview, float]:
+        '''Ask a single peer for its public key.
+
+        Parameters:
+            peer (PeerNode): Peer to be asked.
+            timeout (float): Seconds to wait for the peer to answer once connected.
+
+        Returns:
+            The PEM-encoded key sent back by the peer and the seconds it took to arrive once the request was sent.
+
+        Raises:
+            OSError: The peer could not be reached or did not answer in time.
+            ValueError: The peer answered with something other than a key.
+        
+        '''
+        # Leave the connection warm in the pool for building circuits later
+        with self.pool.connection(peer) as conn:
+            conn.sock.settimeout(timeout)
+            sent = perf_counter()
+            conn.send(Messages.Packet(Messages.Preambles.MSG_GETKEY.value, peer.ip, peer.port, 0, b''))
+            key_packet = conn.recv()
+            rtt = perf_counter() - sent
+            conn.sock.settimeout(None)
+        if(key_packet.preamble != Messages.Preambles.MSG_ISKEY.value):
+            raise(ValueError(f"Expected a key, got {Messages.Preambles(key_packet.preamble)}"))
+        return key_packet.raw_body, rtt
+
+
+    def connect(self, target: PeerNode) -> Union[ConnectionPool.PooledConnection, None]:
+        '''Check out an outgoing connection to a specified peer from the pool.
 
         Parameters:
             target (PeerNode): Target peer node to be connected to.
+
+        Returns:
+            The connection, which the caller must release, or `None` if the peer could not be reached.
         
         '''
-        self.client_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         data_packet = Messages.Packet()
         try:
-            self.client_sock.connect((target.ip, target.port))
-            data_packet.construct(Messages.Preambles.MSG_HELLO, '', 0, 0, '')
-            self.client_sock.send(data_packet.pack())
+            conn = self.pool.acquire(target)
         except Exception as e:
-            print("[CLIENT] Unable to connect with server")
-            print(f"        |-> {e}")
+            Log.client.warning("Unable to connect with server: %s", e)
+            return None
+        try:
+            data_packet.construct(Messages.Preambles.MSG_HELLO, '', 0, 0, '')
+            conn.send(data_packet)
+        except OSError as e:
+            conn.release(False)
+            Log.client.warning("Unable to connect with server: %s", e)
+            return None
+        return conn
 
     
     def clear_route(self) -> None:
         '''Unroute all peers.
         
         '''
-        print("[CLIENT] Unrouted all peers")
+        Log.client.info("Unrouted all peers")
         self.route.clear()
 
     
@@ -179,86 +517,357 @@ class Node(object):
             port (int): The port at which the peer will be contacted through.
         
         '''
-        print(f"[CLENT] Added {peer} to end of current route")
+        Log.client.info("Added %s to end of current route", peer)
         peer = self.keystore.get_peer(peer) # Get version of the peer stored
         if(peer is not None):
             self.route.append(peer)
 
     
     def auto_route(self, depth: int) -> None:
-        '''Automatically create a route of a given size.
+        '''Automatically create a route of a given size, favouring fast relays and never repeating one.
 
         Parameters:
             depth (int): The number of members involved in the transfer.
+
+        Raises:
+            ValueError: The depth is not a positive integer or too few relays with known keys are eligible.
         
         '''
-        if((type(depth) is int) and (depth > 0)):
-            self.route = random.sample(list(self.keystore.peer_public_keys.keys()), k=depth)
-        else:
-            raise(ValueError("Route size must be a positive integer"))
+        self.route = self.selector.select(depth)
         
     
     def open_route(self) -> None:
+        '''Build a circuit through every peer in the route, negotiating one set of symmetric keys per hop.
+        
+        '''
+        Log.client.info("Preparing route for transfer...")
+        self.circuit = self.build_circuit(self.route)
+        Log.client.info("Route established")
+
+
+    def new_circuit(self) -> Circuit.Circuit:
+        '''Select a fresh route and build a circuit along it, as done in the background by the circuit pool.
+
+        Returns:
+            The new circuit.
+        
         '''
+        return self.build_circuit(self.selector.select(self.route_depth))
+
+
+    def build_circuit(self, route: List[PeerNode]) -> Circuit.Circuit:
+        '''Build a circuit through every peer in a route, negotiating one set of symmetric keys per hop.
+
+        Parameters:
+            route (List[PeerNode]): Relays the circuit passes through, in order.
+
+        Returns:
+            The new circuit.
+
+        Raises:
+            ConnectionError: A relay refused the circuit or failed to answer in time.
         
+        Note:
+            A relay that cannot open its onion skin drops the handshake, which looks the same as a relay that is down.
+            Its key is therefore fetched again before the failure is counted against it, in case it was replaced.
+
         '''
-        print("[CLIENT] Preparing route for transfer...")
-        self.client_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        hello_packet = self.hello_packet(0)
-        self.client_sock.connect((self.route[0].ip, self.route[0].port))
-        self.client_sock.send(hello_packet.pack())
-        reply = self.client_sock.recv(2048)
-        print("[CLIENT] Route established")
+        start = perf_counter()
+        first_hop = route[0]
+        try:
+            conn = self.pool.acquire(first_hop, BUILD_TIMEOUT)
+        except OSError:
+            self.relay_failed(first_hop)
+            raise
+        circuit = Circuit.Circuit(Circuit.new_circ_id(), conn)
+        waiting = None
+        try:
+            circuit.conn.sock.settimeout(BUILD_TIMEOUT)
+            # Handshake directly with the first hop
+            handshake = Circuit.Handshake()
+            create_packet = self.create_packet(first_hop, handshake, circuit.circ_id)
+            waiting = first_hop
+            circuit.conn.send(create_packet)
+            reply = circuit.conn.recv(circuit.circ_id)
+            if(reply.preamble != Messages.Preambles.MSG_CREATED.value):
+                raise(ConnectionError(f"{first_hop} refused to create circuit"))
+            circuit.add_hop(first_hop, handshake.complete(reply.raw_body))
+            # Telescope through the remaining hops using the circuit built so far
+            for peer in route[1:]:
+                handshake = Circuit.Handshake()
+                create_packet = self.create_packet(peer, handshake, 0, Messages.Preambles.MSG_EXTEND)
+                waiting = peer
+                circuit.send(create_packet)
+                reply = circuit.recv()
+                if(reply.preamble != Messages.Preambles.MSG_EXTENDED.value):
+                    raise(ConnectionError(f"Circuit could not be extended to {peer}"))
+                circuit.add_hop(peer, handshake.complete(reply.raw_body))
+            circuit.conn.sock.settimeout(None)
+        except OSError:
+            circuit.conn.release(False)
+            if((waiting is not None) and (not self.refresh_key(waiting))):
+                self.relay_failed(waiting)
+            raise
+        except Exception:
+            circuit.conn.release(False)
+            raise
+        self.metrics.circuit_built(perf_counter() - start)
+        return circuit
         
 
+    def refresh_key(self, peer: PeerNode, timeout: float = KEY_TIMEOUT) -> bool:
+        '''Stop using a relay's key after a handshake sent under it went unanswered, and ask the relay for its key
+           again. If the relay cannot be asked either, it is taken to be down rather than rekeyed, and keeps the key
+           it had.
+
+        Parameters:
+            peer (PeerNode): Relay that failed to answer a handshake.
+            timeout (float): Seconds to wait for the relay to answer once connected.
+
+        Returns:
+            `True` if the relay answered with a different key than the one the handshake was sent under.
+
+        '''
+        old_key = self.keystore.get_pub_key(peer)
+        self.keystore.forget_key(peer)
+        self.selector.remove(peer)
+        if(self.fetch_keys([peer], timeout, timeout) == 0):
+            if(old_key is not None):
+                self.keystore.set_peer_key(peer, old_key)
+                self.add_relay(peer)
+            return False
+        new_key = self.keystore.get_pub_key(peer)
+        if((old_key is None) or (new_key.public_numbers() != old_key.public_numbers())):
+            Log.client.info("%s has a new key", peer.socket_addr)
+            return True
+        return False
+
+
+    def relay_failed(self, peer: PeerNode) -> None:
+        '''Count a relay that could not be reached while building a circuit towards opening its breaker.
+
+        Parameters:
+            peer (PeerNode): Relay that failed.
+
+        '''
+        if(self.prober is not None):
+            self.prober.failed(peer)
+
+
+    def relay_health(self, peer: PeerNode) -> None:
+        '''Pass a relay's latest health measurements on to route selection.
+
+        Parameters:
+            peer (PeerNode): Relay that was measured.
+
+        '''
+        self.selector.update(peer, peer.bandwidth, peer.rtt, peer.healthy)
+
+
+    def add_relay(self, peer: PeerNode) -> None:
+        '''Make a relay selectable, weighted by whatever has been measured of it so far.
+
+        Parameters:
+            peer (PeerNode): Relay whose key is known.
+
+        '''
+        self.selector.add(peer,
+                          RouteSelector.DEFAULT_BANDWIDTH if peer.bandwidth is None else peer.bandwidth,
+                          0.0 if peer.rtt is None else peer.rtt)
+
+
+    def transfer_measured(self, circuit: Circuit.Circuit, size: int, seconds: float) -> None:
+        '''Credit the throughput of a finished transfer to every relay of the circuit it ran along.
+
+        Parameters:
+            circuit (Circuit.Circuit): Circuit the transfer ran along.
+            size (int): Bytes transferred.
+            seconds (float): Time the transfer took, from the first byte sent to the last one acknowledged.
+
+        '''
+        # A short transfer mostly measures latency, which is already accounted for
+        if((size < MEASURED_TRANSFER) or (seconds <= 0.0)):
+            return
+        for peer in circuit.route:
+            peer.record_throughput(size / seconds)
+            self.relay_health(peer)
+
+
+    def create_packet(self, peer: PeerNode, handshake: Circuit.Handshake, circ_id: int,
+                      preamble: Messages.Preambles = Messages.Preambles.MSG_CREATE) -> Messages.Packet:
+        '''Craft the packet that starts a circuit handshake with a peer.
+
+        Parameters:
+            peer (PeerNode): Relay the handshake is intended for.
+            handshake (Circuit.Handshake): Client half of the handshake.
+            circ_id (int): Circuit ID to be used on the link to the peer.
+            preamble (Messages.Preambles): `MSG_CREATE` when sent directly to the peer or `MSG_EXTEND` when sent
+                                           along an existing circuit.
+
+        Returns:
+            Packet whose body is the ephemeral public key encrypted for the peer.
+
+        '''
+        onion_skin = Messages.Packet(Messages.Preambles.MSG_CREATE.value, peer.ip, peer.port, 0, handshake.public)
+        return Messages.Packet(preamble.value, peer.ip, peer.port, 0,
+                               self.keystore.encrypt_packet(onion_skin, peer), circ_id)
+
+
     def hello_packet(self, transfer_size: int = 0) -> Messages.Packet:
         '''Craft a multi-layered, encrypted packet to check if route can send data.
         
         Returns:
             Multi-layer "hello" packet used in transmission.
         '''
-        '''
         # Create inner-most packet for destination
         stop_packet = Messages.Packet(Messages.Preambles.MSG_STOP.value, self.route[-1].ip, self.route[-1].port, transfer_size, b'')
-        stop_packet = self.keystore.encrypt_packet(stop_packet, self.route[-1])
-        # Wrap destination packet in layers of encryption
-        rev_peers = list(reversed(self.route[:-1]))
-        layer = stop_packet
-        for hop in rev_peers:
-            layer = Messages.Packet(Messages.Preambles.MSG_FORWARD.value, hop.ip, hop.port, 0, layer)
-            layer = self.keystore.encrypt_packet(layer, hop)
+        # Wrap destination packet in layers of encryption, each naming the hop after it
+        layer = self.onions.build(self.route, stop_packet)
         return Messages.Packet(Messages.Preambles.MSG_FORWARD.value, self.route[0].ip, self.route[0].port, 0, layer)
-        '''
-        stop_packet = Messages.Packet(Messages.Preambles.MSG_TEXT, self.route[-1].ip, self.route[-1].port, transfer_size, b"Hello, world!")
-        rev_peers = list(reversed(self.route[:-1]))
-        #for peer in rev_peers:
-        #    stop_packet = Messages(Messages.Preambles.MSG_FORWARD, peer.ip, peer.port, 0, stop_packet.pack())
-        return stop_packet
     
 
-    def pubkey_packet(self, ip: int, port: str) -> Messages.Packet:
-        '''
+    def pubkey_packet(self, ip: str, port: int) -> Messages.Packet:
+        '''Craft a packet containing the public key of the server component.
+
+        Parameters:
+            ip (str): IP address of the peer requesting the key.
+            port (int): Port of the peer requesting the key.
+
+        Returns:
+            Packet with the PEM-encoded server public key as its body.
         
         '''
-        return Messages.Packet(Messages.Preambles.MSG_ISKEY, ip, port, 0, b'')
+        pem_pub = self.keystore.server_keypair.public.public_bytes(encoding=serialization.Encoding.PEM,
+                                                                   format=serialization.PublicFormat.SubjectPublicKeyInfo)
+        return Messages.Packet(Messages.Preambles.MSG_ISKEY.value, ip, port, 0, pem_pub)
+
+
+    def stats_packet(self, link: Link) -> Messages.Packet:
+        '''Craft the answer to a `MSG_STATS` request, which is only granted to peers on this host.
+
+        Parameters:
+            link (Link): Link the request arrived on.
+
+        Returns:
+            Packet with the server's counters as its JSON body, or a `MSG_DENY` packet for remote peers.
+
+        '''
+        if(not ipaddress.ip_address(link.writer.get_extra_info("peername")[0]).is_loopback):
+            return Messages.Packet(Messages.Preambles.MSG_DENY.value, '', 0, 0, b'')
+        outboxes = [len(circuit.outbox) for circuit in self.circuits]
+        queues = {"circuits":      len(outboxes),
+                  "links":         len(self.active_links),
+                  "tasks":         len(self.server_tasks),
+                  "outbox":        sum(outboxes),
+                  "outbox_max":    max(outboxes, default=0),
+                  "write_buffers": sum(active.buffered for active in self.active_links)}
+        stats = self.metrics.snapshot(self.active_links, queues)
+        stats["directory"] = {"relays": len(self.directory), "version": self.directory.version}
+        return Messages.Packet(Messages.Preambles.MSG_STATS.value, '', 0, 0, json.dumps(stats).encode("utf-8"))
 
     
     def start_threads(self) -> None:
         '''Start the thread to run the server separately from the client.
         
         '''
-        if(self.mode == "server"):
-            self.run_server()
-        elif(self.mode == "client"):
-            self.run_client()
-        else:
-            self.server_thread = threading.Thread(target=self.run_server)
-            self.server_thread.start()
-            sleep(1) # Gives server thread time to start before cores on the same host contact it
-            self.client_thread = threading.Thread(target=self.run_client)
-            self.client_thread.start()
-            self.client_thread.join()
-            self.server_thread.join()
+        # Workers are forked before any thread starts, and only ever run the server component
+        worker = (self.server_sock is not None) and self.fork_workers()
+        self.dispatcher.start()
+        if(self.profiler is not None):
+            if(threading.current_thread() is threading.main_thread()):
+                signal.signal(signal.SIGTERM, self.terminate)
+            self.profiler.start()
+        if(worker):
+            try:
+                self.run_server()
+            finally:
+                self.dispatcher.stop()
+                if(self.profiler is not None):
+                    self.profiler.stop()
+                os._exit(0)
+        try:
+            if(self.mode == "server"):
+                self.run_server()
+            elif(self.mode == "client"):
+                self.run_client()
+            else:
+                self.server_thread = threading.Thread(target=self.run_server)
+                self.server_thread.start()
+                sleep(1) # Gives server thread time to start before cores on the same host contact it
+                self.client_thread = threading.Thread(target=self.run_client)
+                self.client_thread.start()
+                self.client_thread.join()
+                self.server_thread.join()
+        finally:
+            self.stop_workers()
+            self.dispatcher.stop()
+            if(self.profiler is not None):
+                self.profiler.stop()
+
+
+    def terminate(self, signum: int, frame: Union[FrameType, None]) -> None:
+        '''Exit through the usual clean-up on being sent `SIGTERM`, so the profiler's samples are written out on the
+           way, ignoring any further request to terminate meanwhile.
+
+        '''
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        sys.exit(0)
+
+
+    def profile_spans(self) -> Dict[str, Tuple[Callable, ...]]:
+        '''List the functions making up each span the profiler reports on separately.
+
+        Returns:
+            The functions of each span, keyed by the span's name.
+
+        '''
+        transport = selector_events._SelectorSocketTransport
+        return {"unpack":   (Messages.Packet.unpack, Messages.Packet.unpack_from),
+                "dispatch": (Dispatch.Dispatcher.dispatch,),
+                "keystore": (KeyStore.encrypt_packet, KeyStore.decrypt_packet),
+                "layers":   (Circuit.CircuitHop.forward_layer, Circuit.CircuitHop.backward_layer,
+                             Circuit.CircuitHop.forward_into, Circuit.CircuitHop.backward_into),
+                # Socket reads and writes, by the client's blocking connections and the server's event loop
+                "io":       (ConnectionPool.PooledConnection.send, ConnectionPool.PooledConnection.write,
+                             ConnectionPool.PooledConnection.recv, transport._read_ready, transport.write,
+                             transport._write_ready)}
+
+
+    def fork_workers(self) -> bool:
+        '''Fork the extra server processes, each with its own socket bound to the server port.
+
+        Returns:
+            `True` in a newly forked worker, `False` in the original process.
+
+        '''
+        for _ in range(1, self.workers):
+            pid = os.fork()
+            if(pid == 0):
+                self.parent_pid = os.getppid()
+                self.worker_pids.clear()
+                self.server_sock.close()
+                self.server_sock = self.listen_socket()
+                # Workers share no state, so each keeps a directory of its own that readers can tell apart
+                self.directory.reset()
+                return True
+            self.worker_pids.append(pid)
+        if(self.worker_pids):
+            Log.server.info("Started %d worker processes", len(self.worker_pids))
+        return False
+
+
+    def stop_workers(self) -> None:
+        '''Terminate the worker processes and wait for them to exit.
+
+        '''
+        for pid in self.worker_pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in self.worker_pids:
+            os.waitpid(pid, 0)
+        self.worker_pids.clear()
 
     
     def run_client(self) -> None:
@@ -273,17 +882,121 @@ class Node(object):
         '''
         
         '''
-        # Get list of nodes and make a route
-        #self.contact_core()
-        self.auto_route(1)
-        # Establish route with nodes
-        self.route_peer(PeerNode("127.0.0.1", 7877))
-        self.open_route()
+        # Get list of nodes and start building circuits through them
+        self.contact_core()
+        if(self.sync_interval > 0):
+            threading.Thread(target=self.sync_loop, name="directory", daemon=True).start()
+        if(self.prober is not None):
+            self.prober.start()
+        self.circuit_pool.start()
+        # Take an established circuit for this session
+        self.circuit = self.circuit_pool.get()
         # Send message to destination
-
+        self.circuit.send(Messages.Packet(Messages.Preambles.MSG_TEXT.value, '', 0, 0, b"Hello, world!",
+                                          _stream_id=self.circuit.open_stream()))
         # Receive reply
-
+        Log.client.info("Reply: %s", Messages.Preambles(self.circuit.recv().preamble))
         # End connection
+        self.circuit.close()
+        self.circuit_pool.stop()
+        self.sync_stop.set()
+        if(self.prober is not None):
+            self.prober.stop()
+
+
+    def send_file(self, file_path: str, name: Union[str, None] = None,
+                  circuit: Union[Circuit.Circuit, None] = None) -> int:
+        '''Upload a file to the last hop of a circuit, streaming it in fixed-size chunks so memory use stays flat
+           whatever the size of the file.
+
+        Parameters:
+            file_path (str): File to be sent.
+            name (Union[str, None]): Name the file is stored under, or `None` to keep its own.
+            circuit (Union[Circuit.Circuit, None]): Circuit to send along, or `None` for the client's circuit.
+
+        Returns:
+            The number of bytes sent.
+
+        Raises:
+            ConnectionRefusedError: The last hop declined the file.
+            ConnectionError: The circuit was torn down during the transfer.
+
+        '''
+        circuit = self.circuit if circuit is None else circuit
+        stream_id = circuit.open_stream()
+        try:
+            with Transfer.FileSource(file_path) as source:
+                circuit.send(Transfer.offer_packet(name or path.basename(file_path), source.size, stream_id))
+                self.transfer_reply(circuit, stream_id, Messages.Preambles.MSG_OKAY)
+                start = perf_counter()
+                for chunk in source:
+                    # Each chunk is layered as soon as it is sent, so the read buffer is free to be reused
+                    circuit.send(Messages.Packet(Messages.Preambles.MSG_DATA.value, '', 0, len(chunk), chunk,
+                                                 _stream_id=stream_id))
+                self.transfer_reply(circuit, stream_id, Messages.Preambles.MSG_OKAY)
+                self.transfer_measured(circuit, source.size, perf_counter() - start)
+                return source.size
+        finally:
+            circuit.close_stream(stream_id)
+
+
+    def recv_file(self, name: str, file_path: Union[str, None] = None,
+                  circuit: Union[Circuit.Circuit, None] = None) -> int:
+        '''Download a file from the last hop of a circuit, writing each chunk out as it arrives.
+
+        Parameters:
+            name (str): Name of the file at the last hop.
+            file_path (Union[str, None]): Where the file is written, or `None` for `name` in the working directory.
+            circuit (Union[Circuit.Circuit, None]): Circuit to receive along, or `None` for the client's circuit.
+
+        Returns:
+            The number of bytes received.
+
+        Raises:
+            ConnectionRefusedError: The last hop does not have the file.
+            ConnectionError: The circuit was torn down during the transfer.
+
+        '''
+        circuit = self.circuit if circuit is None else circuit
+        stream_id = circuit.open_stream()
+        try:
+            circuit.send(Messages.Packet(Messages.Preambles.MSG_FETCH.value, '', 0, 0, name, _stream_id=stream_id))
+            _, size = Transfer.parse_offer(self.transfer_reply(circuit, stream_id, Messages.Preambles.MSG_ISEND))
+            sink = Transfer.FileSink(name if file_path is None else file_path, size)
+            start = perf_counter()
+            try:
+                while not sink.done:
+                    sink.write(self.transfer_reply(circuit, stream_id, Messages.Preambles.MSG_DATA).raw_body)
+                sink.close()
+            finally:
+                sink.abort()
+            self.transfer_measured(circuit, size, perf_counter() - start)
+            return size
+        finally:
+            circuit.close_stream(stream_id)
+
+
+    def transfer_reply(self, circuit: Circuit.Circuit, stream_id: int,
+                       expected: Messages.Preambles) -> Messages.Packet:
+        '''Wait for the next packet of a file transfer.
+
+        Parameters:
+            circuit (Circuit.Circuit): Circuit the transfer runs along.
+            stream_id (int): Stream of the transfer.
+            expected (Messages.Preambles): Kind of packet the transfer is waiting for.
+
+        Returns:
+            The packet.
+
+        Raises:
+            ConnectionRefusedError: The last hop refused the transfer or answered out of turn.
+
+        '''
+        packet = circuit.recv()
+        if((packet.stream_id != stream_id) or (packet.preamble != expected.value)):
+            raise(ConnectionRefusedError(f"Transfer on stream {stream_id} failed with "
+                                         f"{Messages.Preambles(packet.preamble)}"))
+        return packet
 
 
     # Server components ----------------------------------------------------------------------------
@@ -291,28 +1004,656 @@ class Node(object):
         '''Run the server component of the Node, which communicates with incoming clients.
         
         '''
-        print(f"[SERVER] Running on port {self.server_port}")
-        do_server = True
-        # Run server process
-        data_packet = Messages.Packet()
-        while do_server:
-            self.server_sock.listen(5)
-            self.server_conn, conn_info = self.server_sock.accept()
-            data_packet.unpack(self.server_conn.recv(2048))
-            print(f"[SERVER] Packet type: {Messages.Preambles(data_packet.preamble)}")
-            # Key exchange
-            if(data_packet.preamble == Messages.Preambles.MSG_GETKEY.value):
-                pubkey_packet = self.pubkey_packet(conn_info[0], conn_info[1])
-                self.server_conn.send(pubkey_packet.pack())
-                self.server_conn.close()
-            if(data_packet.preamble == Messages.Preambles.MSG_FORWARD.value):
-                print(f"Forward message received")
+        Log.server.info("Running on port %s", self.server_port)
+        asyncio.run(self.serve())
+        Log.server.info("Terminating operation")
+
 
-        print(f"[SERVER] Terminating operation")
+    async def serve(self) -> None:
+        '''Accept incoming connections on the event loop, serving each one from its own task.
+        
+        '''
+        self.links = LinkManager(self.codec, self.start_link)
+        server = await asyncio.start_server(self.handle_connection, sock=self.server_sock, backlog=SERVER_BACKLOG)
+        if(self.gossip_interval > 0):
+            self.spawn(self.gossip())
+        async with server:
+            if(self.parent_pid is None):
+                await server.serve_forever()
+            else:
+                await self.watch_parent()
 
 
+    async def watch_parent(self) -> None:
+        '''Keep a worker process serving until the process that forked it exits.
+
+        '''
+        while os.getppid() == self.parent_pid:
+            await asyncio.sleep(WORKER_POLL)
+        Log.server.warning("Worker %d lost its parent process", os.getpid())
+
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        '''Wrap an accepted client or relay connection in a link and serve it.
+
+        Parameters:
+            reader (asyncio.StreamReader): Incoming side of the connection.
+            writer (asyncio.StreamWriter): Outgoing side of the connection.
+        
+        '''
+        # Accepted sockets do not always get Nagle disabled by asyncio, and a reply written just after a `MSG_SENDME`
+        # would otherwise wait out the client's delayed ACK
+        writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        await self.serve_link(Link(reader, writer, self.codec))
+
+
+    def start_link(self, link: Link) -> None:
+        '''Serve a link this node opened to a neighbour in the background.
+
+        Parameters:
+            link (Link): Newly opened link.
+        
+        '''
+        self.spawn(self.serve_link(link))
+
+
+    async def serve_link(self, link: Link) -> None:
+        '''Read packets from a link and dispatch them to their handlers until it closes.
+
+        Parameters:
+            link (Link): Link to a client or neighbouring relay, carrying any number of circuits.
+        
+        '''
+        self.active_links.add(link)
+        counts = self.metrics.packets
+        # Checked once per link, so tracing every packet costs nothing while it is disabled
+        trace = Log.server.isEnabledFor(Log.DEBUG)
+        try:
+            async for data_packet in link.packets(RELAY_PASSTHROUGH):
+                counts[data_packet.preamble] = counts.get(data_packet.preamble, 0) + 1
+                if(trace):
+                    Log.server.debug("Packet type: %s", Metrics.preamble_name(data_packet.preamble))
+                if(await self.dispatcher.dispatch(link, data_packet)):
+                    break # Connection was spliced onto the next hop and has since closed
+                await link.drain()
+        except Exception as e:
+            Log.server.warning("Dropping link to %s: %s", link, e)
+        finally:
+            self.active_links.discard(link)
+            self.metrics.link_closed(link)
+            self.links.forget(link)
+            for circuit in self.circuits.drop_link(link):
+                if(circuit.next_conn is link):
+                    self.send_destroy(circuit.prev_conn, circuit.prev_id)
+                elif(circuit.next_conn is not None):
+                    self.send_destroy(circuit.next_conn, circuit.next_id)
+            link.close()
+
+
+    def register_handlers(self, policies: Dict[str, str]) -> None:
+        '''Register the server component's handler for every type of packet it acts on.
+
+        Parameters:
+            policies (Dict[str, str]): Where the expensive part of a handler is carried out, as the name of a
+                                       `Dispatch.Policy` keyed by the name of the packet type. Only handlers given
+                                       such work in this method can be moved off the event loop.
+
+        Raises:
+            KeyError: A packet type or policy is unknown.
+
+        '''
+        policy = {Messages.Preambles[name].value: Dispatch.Policy[value.upper()] for name, value in policies.items()}
+        create = Messages.Preambles.MSG_CREATE.value
+        # Key exchange
+        self.dispatcher.register(Messages.Preambles.MSG_GETKEY, self.answer_key)
+        self.dispatcher.register(Messages.Preambles.MSG_FORWARD, self.forward_layer)
+        # Circuit handling
+        self.dispatcher.register(create, self.create_circuit, policy.get(create, Dispatch.Policy.INLINE),
+                                 self.open_handshake)
+        self.dispatcher.register(Messages.Preambles.MSG_CREATED, self.resolve_handshake)
+        self.dispatcher.register(Messages.Preambles.MSG_RELAY, self.relay_cell)
+        self.dispatcher.register(Messages.Preambles.MSG_DESTROY, self.destroy_circuit)
+        # Utility and monitoring
+        self.dispatcher.register(Messages.Preambles.MSG_PEERS, self.answer_peers)
+        self.dispatcher.register(Messages.Preambles.MSG_ECHO, self.answer_echo)
+        self.dispatcher.register(Messages.Preambles.MSG_STATS, self.answer_stats)
+
+
+    def answer_key(self, link: Link, data_packet: Messages.Packet) -> None:
+        '''Send this node's public key to a peer that asked for it with `MSG_GETKEY`.
+
+        Parameters:
+            link (Link): Link the request arrived on.
+            data_packet (Messages.Packet): Received request.
+
+        '''
+        conn_info = link.writer.get_extra_info("peername")
+        link.send(self.pubkey_packet(conn_info[0], conn_info[1]))
+
+
+    def answer_peers(self, link: Link, data_packet: Messages.Packet) -> None:
+        '''Send a peer the changes to the directory it has not read yet, first listing the peer itself if it
+           announced a server component along with its request.
+
+        Parameters:
+            link (Link): Link the request arrived on.
+            data_packet (Messages.Packet): Received `MSG_PEERS` request.
+
+        '''
+        request = data_packet.raw_body
+        if(len(request) >= Directory.REQUEST.size + Directory.ANNOUNCE.size):
+            port, fingerprint = Directory.ANNOUNCE.unpack_from(request, Directory.REQUEST.size)
+            # Only the port is announced, so a peer cannot list relays at any address but its own
+            host = link.writer.get_extra_info("peername")[0]
+            try:
+                if(self.directory.add(host, port, fingerprint)):
+                    Log.server.info("Relay %s:%d joined the directory", host, port)
+            except ValueError as ve:
+                Log.server.debug("Not listing relay: %s", ve)
+        link.send(Messages.Packet(Messages.Preambles.MSG_PEERS.value, '', 0, 0, self.directory.delta(request)))
+
+
+    def answer_echo(self, link: Link, data_packet: Messages.Packet) -> None:
+        '''Send a `MSG_ECHO` packet straight back to the peer, letting it measure the round trip to this node.
+
+        Parameters:
+            link (Link): Link the packet arrived on.
+            data_packet (Messages.Packet): Received packet.
+
+        '''
+        link.send(data_packet)
+
+
+    def resolve_handshake(self, link: Link, data_packet: Messages.Packet) -> None:
+        '''Hand a `MSG_CREATED` reply to the circuit extension waiting for it on the link.
+
+        Parameters:
+            link (Link): Link the reply arrived on.
+            data_packet (Messages.Packet): Received reply.
+
+        '''
+        link.resolve(data_packet)
+
+
+    def answer_stats(self, link: Link, data_packet: Messages.Packet) -> None:
+        '''Send this node's counters to a peer that asked for them with `MSG_STATS`.
+
+        Parameters:
+            link (Link): Link the request arrived on.
+            data_packet (Messages.Packet): Received request.
+
+        '''
+        link.send(self.stats_packet(link))
+
+
+    def open_handshake(self, body: bytes) -> Tuple[bytes, bytes, bytes, float]:
+        '''Open the onion skin of a `MSG_CREATE` packet and complete the relay half of its handshake. This is the
+           expensive part of creating a circuit, and may run in a thread or process of its own.
+
+        Parameters:
+            body (bytes): Body of the `MSG_CREATE` packet.
+
+        Returns:
+            The body of the `MSG_CREATED` reply, the forward and backward keys of the new hop, and the seconds taken.
+
+        '''
+        start = perf_counter()
+        onion_skin = self.keystore.decrypt_packet(body)
+        reply, forward_key, backward_key = Circuit.respond_keys(onion_skin.raw_body)
+        return reply, forward_key, backward_key, perf_counter() - start
+
+
+    def create_circuit(self, link: Link, data_packet: Messages.Packet,
+                       handshake: Tuple[bytes, bytes, bytes, float]) -> None:
+        '''Remember the keys negotiated for a new circuit and answer the client's handshake.
+
+        Parameters:
+            link (Link): Link the handshake arrived on.
+            data_packet (Messages.Packet): Received `MSG_CREATE` packet.
+            handshake (Tuple[bytes, bytes, bytes, float]): Result of `open_handshake` for the packet.
+        
+        '''
+        reply, forward_key, backward_key, seconds = handshake
+        self.metrics.crypto[Metrics.CRYPTO_HANDSHAKE].observe(seconds)
+        hop = Circuit.CircuitHop(forward_key, backward_key)
+        self.circuits.add(Circuit.RelayCircuit(hop, link, data_packet.circ_id))
+        link.send(Messages.Packet(Messages.Preambles.MSG_CREATED.value, '', 0, 0, reply, data_packet.circ_id))
+
+
+    async def relay_cell(self, link: Link, data_packet: Messages.Packet) -> None:
+        '''Move a cell one hop along its circuit in whichever direction it is travelling, or act on it.
+
+        Parameters:
+            link (Link): Link the cell arrived on.
+            data_packet (Messages.Packet): Received `MSG_RELAY` packet.
+        
+        '''
+        circuit = self.circuits.get(link, data_packet.circ_id)
+        if(circuit is None):
+            Log.server.warning("Unknown circuit %d", data_packet.circ_id)
+            return
+        if(link is circuit.next_conn):
+            # Reply from later in the circuit, so add this node's layer and pass it back towards the client
+            self.reply_cell(circuit, data_packet)
+            await circuit.prev_conn.drain()
+            return
+        cell_body = data_packet.raw_body
+        if(circuit.next_conn is not None):
+            # Not the last hop, so peel straight into the outgoing frame
+            relay_packet = Messages.Packet(Messages.Preambles.MSG_RELAY.value, '', 0, data_packet.data_size, b'',
+                                           circuit.next_id)
+            frame, offset = self.codec.reserve(relay_packet, len(cell_body), Circuit.LAYER_SLACK)
+            start = perf_counter()
+            circuit.hop.forward_into(cell_body, frame, offset)
+            self.metrics.crypto[Metrics.CRYPTO_FORWARD].observe(perf_counter() - start)
+            del frame[-Circuit.LAYER_SLACK:]
+            circuit.next_conn.write(frame)
+            await circuit.next_conn.drain()
+            return
+        # Last hop, so wait for every fragment of the cell body when running with fixed-size cells
+        start = perf_counter()
+        cell_body = circuit.hop.forward_layer(cell_body)
+        self.metrics.crypto[Metrics.CRYPTO_FORWARD].observe(perf_counter() - start)
+        cell_body = circuit.collect(cell_body, data_packet.data_size)
+        if(cell_body is None):
+            return
+        inner_packet = Messages.Packet()
+        inner_packet.unpack(cell_body)
+        if(inner_packet.preamble == Messages.Preambles.MSG_SENDME.value):
+            circuit.flow.sendme(inner_packet)
+            self.flush_replies(circuit)
+            return
+        for stream_id in circuit.flow.delivered(inner_packet):
+            self.send_reply(circuit, Messages.Packet(Messages.Preambles.MSG_SENDME.value, '', 0, 0, b'',
+                                                     _stream_id=stream_id))
+        if(inner_packet.preamble == Messages.Preambles.MSG_EXTEND.value):
+            # Handshaking with the next hop takes a round trip, so the link keeps serving other circuits meanwhile
+            self.spawn(self.extend_circuit(circuit, inner_packet))
+        elif(inner_packet.preamble == Messages.Preambles.MSG_ECHO.value):
+            self.reply_packet(circuit, inner_packet)
+        elif(inner_packet.preamble == Messages.Preambles.MSG_ISEND.value):
+            self.accept_file(circuit, inner_packet)
+        elif(inner_packet.preamble == Messages.Preambles.MSG_DATA.value):
+            self.store_chunk(circuit, inner_packet)
+        elif(inner_packet.preamble == Messages.Preambles.MSG_FETCH.value):
+            # Sending a file has to wait on the client's window, so the link keeps serving other circuits meanwhile
+            self.spawn(self.serve_file(circuit, inner_packet.stream_id, inner_packet.body))
+        else:
+            Log.server.debug("Circuit %d stream %d delivered %s", data_packet.circ_id, inner_packet.stream_id,
+                             Metrics.preamble_name(inner_packet.preamble))
+            self.reply_packet(circuit, Messages.Packet(Messages.Preambles.MSG_OKAY.value, '', 0, 0, b'',
+                                                       _stream_id=inner_packet.stream_id))
+
+
+    async def extend_circuit(self, circuit: Circuit.RelayCircuit, extend_packet: Messages.Packet) -> None:
+        '''Extend a circuit ending at this node by forwarding the client's handshake to the next hop.
+
+        Parameters:
+            circuit (Circuit.RelayCircuit): Circuit being extended.
+            extend_packet (Messages.Packet): Decrypted `MSG_EXTEND` packet naming the next hop.
+        
+        '''
+        Log.server.debug("Extending circuit to %s:%d", extend_packet.dest_ip, extend_packet.dest_port)
+        try:
+            start = perf_counter()
+            next_conn = await self.links.get(PeerNode(extend_packet.dest_ip, extend_packet.dest_port))
+            next_id = self.circuits.new_circ_id(next_conn)
+            create_packet = Messages.Packet(Messages.Preambles.MSG_CREATE.value, extend_packet.dest_ip,
+                                            extend_packet.dest_port, 0, extend_packet.raw_body, next_id)
+            created_packet = await next_conn.create(create_packet)
+            self.metrics.extend_latency.observe(perf_counter() - start)
+        except (OSError, ConnectionError, asyncio.TimeoutError) as ose:
+            Log.server.warning("Unable to extend circuit: %s", ose)
+            self.reply_packet(circuit, Messages.Packet(Messages.Preambles.MSG_DENY.value, '', 0, 0, b''))
+            return
+        if(self.circuits.get(circuit.prev_conn, circuit.prev_id) is not circuit):
+            # Circuit was torn down while waiting, so release the new hop again
+            self.send_destroy(next_conn, next_id)
+            return
+        self.circuits.extend(circuit, next_conn, next_id)
+        self.reply_packet(circuit, Messages.Packet(Messages.Preambles.MSG_EXTENDED.value, '', 0, 0,
+                                                   created_packet.raw_body))
+
+
+    def reply_packet(self, circuit: Circuit.RelayCircuit, packet: Messages.Packet) -> None:
+        '''Send a packet back towards the client that built a circuit ending at this node, holding it back while the
+           client's window is closed.
+
+        Parameters:
+            circuit (Circuit.RelayCircuit): Circuit the reply travels along.
+            packet (Messages.Packet): Reply for the client.
+        
+        '''
+        if((len(circuit.outbox) == 0) and circuit.flow.can_package(packet)):
+            circuit.flow.packaged(packet)
+            self.send_reply(circuit, packet)
+            return
+        if(len(circuit.outbox) >= Circuit.CIRCUIT_WINDOW):
+            # A client within its own window can never cause this many replies, so it is ignoring flow control
+            Log.server.warning("Circuit %d overran its window", circuit.prev_id)
+            self.circuits.remove(circuit)
+            self.send_destroy(circuit.prev_conn, circuit.prev_id)
+            return
+        circuit.outbox.append(packet)
 
 
+    def flush_replies(self, circuit: Circuit.RelayCircuit) -> None:
+        '''Send as many held back replies as the client's reopened window allows, in order.
+
+        Parameters:
+            circuit (Circuit.RelayCircuit): Circuit whose window was reopened.
+        
+        '''
+        while circuit.outbox and circuit.flow.can_package(circuit.outbox[0]):
+            packet = circuit.outbox.popleft()
+            circuit.flow.packaged(packet)
+            self.send_reply(circuit, packet)
+        circuit.writable.set()
+
+
+    def accept_file(self, circuit: Circuit.RelayCircuit, offer: Messages.Packet) -> None:
+        '''Start receiving a file the client offered to upload.
+
+        Parameters:
+            circuit (Circuit.RelayCircuit): Circuit the file arrives on.
+            offer (Messages.Packet): Decrypted `MSG_ISEND` packet naming the file and giving its size.
+        
+        '''
+        reply = Messages.Preambles.MSG_OKAY.value
+        try:
+            if(self.transfer_dir is None):
+                raise(ValueError("File transfers are disabled"))
+            name, size = Transfer.parse_offer(offer)
+            sink = Transfer.FileSink(path.join(self.transfer_dir, name), size)
+            Log.server.info("Receiving %s (%d bytes) on stream %d", name, size, offer.stream_id)
+            if(sink.done):
+                sink.close()
+            else:
+                circuit.sinks[offer.stream_id] = sink
+        except (OSError, ValueError) as e:
+            Log.server.warning("Refusing file: %s", e)
+            reply = Messages.Preambles.MSG_DENY.value
+        self.reply_packet(circuit, Messages.Packet(reply, '', 0, 0, b'', _stream_id=offer.stream_id))
+        if((reply == Messages.Preambles.MSG_OKAY.value) and (offer.stream_id not in circuit.sinks)):
+            # An empty file is complete as soon as it is offered
+            self.reply_packet(circuit, Messages.Packet(reply, '', 0, 0, b'', _stream_id=offer.stream_id))
+
+
+    def store_chunk(self, circuit: Circuit.RelayCircuit, chunk: Messages.Packet) -> None:
+        '''Write the next chunk of a file being uploaded, confirming the file once it is complete.
+
+        Parameters:
+            circuit (Circuit.RelayCircuit): Circuit the chunk arrived on.
+            chunk (Messages.Packet): Decrypted `MSG_DATA` packet.
+        
+        '''
+        sink = circuit.sinks.get(chunk.stream_id)
+        if(sink is None):
+            Log.server.warning("Data on stream %d without a file offer", chunk.stream_id)
+            return
+        reply = None
+        try:
+            if(sink.write(chunk.raw_body)):
+                del circuit.sinks[chunk.stream_id]
+                sink.close()
+                reply = Messages.Preambles.MSG_OKAY.value
+        except (OSError, ValueError) as e:
+            Log.server.warning("Abandoning file %s: %s", sink.path, e)
+            del circuit.sinks[chunk.stream_id]
+            sink.abort()
+            reply = Messages.Preambles.MSG_DENY.value
+        if(reply is not None):
+            self.reply_packet(circuit, Messages.Packet(reply, '', 0, 0, b'', _stream_id=chunk.stream_id))
+
+
+    async def serve_file(self, circuit: Circuit.RelayCircuit, stream_id: int, name: str) -> None:
+        '''Send a file back to the client in fixed-size chunks, pausing whenever its window closes.
+
+        Parameters:
+            circuit (Circuit.RelayCircuit): Circuit the file is sent along.
+            stream_id (int): Stream the client asked for the file on.
+            name (str): Name of the file within the transfer directory.
+        
+        '''
+        try:
+            if(self.transfer_dir is None):
+                raise(ValueError("File transfers are disabled"))
+            source = Transfer.FileSource(path.join(self.transfer_dir, Transfer.safe_name(name)))
+        except (OSError, ValueError) as e:
+            Log.server.warning("Refusing to send file: %s", e)
+            self.reply_packet(circuit, Messages.Packet(Messages.Preambles.MSG_DENY.value, '', 0, 0, b'',
+                                                       _stream_id=stream_id))
+            return
+        Log.server.info("Sending %s (%d bytes) on stream %d", name, source.size, stream_id)
+        with source:
+            self.reply_packet(circuit, Transfer.offer_packet(name, source.size, stream_id))
+            try:
+                for chunk in source:
+                    packet = Messages.Packet(Messages.Preambles.MSG_DATA.value, '', 0, len(chunk), chunk,
+                                             _stream_id=stream_id)
+                    # The chunk is a view of the read buffer, so it may only be sent straight away, never queued
+                    while((self.circuits.get(circuit.prev_conn, circuit.prev_id) is circuit)
+                          and (circuit.outbox or (not circuit.flow.can_package(packet)))):
+                        circuit.writable.clear()
+                        await asyncio.wait_for(circuit.writable.wait(), Transfer.STALL_TIMEOUT)
+                    if(self.circuits.get(circuit.prev_conn, circuit.prev_id) is not circuit):
+                        return # Torn down by the client or a relay
+                    self.reply_packet(circuit, packet)
+                    await circuit.prev_conn.drain()
+            except (ConnectionError, asyncio.TimeoutError) as e:
+                Log.server.warning("Unable to finish sending %s: %r", name, e)
+
+
+    def send_reply(self, circuit: Circuit.RelayCircuit, packet: Messages.Packet) -> None:
+        '''Layer a packet and write it towards the client, regardless of flow control.
+
+        Parameters:
+            circuit (Circuit.RelayCircuit): Circuit the reply travels along.
+            packet (Messages.Packet): Reply for the client.
+        
+        '''
+        start = perf_counter()
+        cell_body = circuit.hop.backward_layer(packet.pack())
+        self.metrics.crypto[Metrics.CRYPTO_BACKWARD].observe(perf_counter() - start)
+        circuit.prev_conn.send(Messages.Packet(Messages.Preambles.MSG_RELAY.value, '', 0, 0, cell_body,
+                                               circuit.prev_id))
+
+
+    def reply_cell(self, circuit: Circuit.RelayCircuit, cell: Messages.Packet) -> None:
+        '''Add this node's layer to a cell travelling back towards the client.
+
+        Parameters:
+            circuit (Circuit.RelayCircuit): Circuit the cell travels along.
+            cell (Messages.Packet): Cell received from the next hop, already carrying the layers of any later hops.
+        
+        '''
+        cell_body = cell.raw_body
+        relay_packet = Messages.Packet(Messages.Preambles.MSG_RELAY.value, '', 0, cell.data_size, b'', circuit.prev_id)
+        frame, offset = self.codec.reserve(relay_packet, len(cell_body), Circuit.LAYER_SLACK)
+        start = perf_counter()
+        circuit.hop.backward_into(cell_body, frame, offset)
+        self.metrics.crypto[Metrics.CRYPTO_BACKWARD].observe(perf_counter() - start)
+        del frame[-Circuit.LAYER_SLACK:]
+        circuit.prev_conn.write(frame)
+
+
+    def destroy_circuit(self, link: Link, data_packet: Messages.Packet) -> None:
+        '''Tear down a circuit and pass the request on to its other end.
+
+        Parameters:
+            link (Link): Link the request arrived on.
+            data_packet (Messages.Packet): Received `MSG_DESTROY` packet.
+        
+        '''
+        circuit = self.circuits.get(link, data_packet.circ_id)
+        if(circuit is None):
+            return
+        self.circuits.remove(circuit)
+        if(link is circuit.next_conn):
+            self.send_destroy(circuit.prev_conn, circuit.prev_id)
+        elif(circuit.next_conn is not None):
+            self.send_destroy(circuit.next_conn, circuit.next_id)
+
+
+    def send_destroy(self, link: Link, circ_id: int) -> None:
+        '''Tell a neighbour that a circuit is gone, leaving the link itself open for its other circuits.
+
+        Parameters:
+            link (Link): Link the circuit uses.
+            circ_id (int): Circuit ID used on `link`.
+        
+        '''
+        if(not link.closed):
+            link.send(Messages.Packet(Messages.Preambles.MSG_DESTROY.value, '', 0, 0, b'', circ_id))
+
+
+    async def forward_layer(self, link: Link, data_packet: Messages.Packet) -> bool:
+        '''Peel one layer of encryption from an onion packet and act on its contents.
+
+        When the layer names a next hop, the rest of the connection is spliced onto a new connection to it, so every
+        later byte in either direction is passed along as soon as it arrives rather than one packet per round trip.
+
+        Parameters:
+            link (Link): Link the packet arrived on.
+            data_packet (Messages.Packet): Received `MSG_FORWARD` packet whose body is encrypted for this node.
+
+        Returns:
+            `True` if the link was spliced and has been closed, otherwise `False`.
+        
+        '''
+        start = perf_counter()
+        inner_packet = self.keystore.decrypt_packet(data_packet.raw_body)
+        self.metrics.crypto[Metrics.CRYPTO_ONION].observe(perf_counter() - start)
+        if(inner_packet.preamble == Messages.Preambles.MSG_FORWARD.value):
+            Log.server.debug("Forwarding layer to %s:%d", inner_packet.dest_ip, inner_packet.dest_port)
+            try:
+                # Bounded like every other outgoing connection, so a dead next hop does not pin the forwarding task
+                next_reader, next_writer = await asyncio.wait_for(asyncio.open_connection(inner_packet.dest_ip,
+                                                                                          inner_packet.dest_port),
+                                                                  ConnectionPool.CONNECT_TIMEOUT)
+            except (OSError, asyncio.TimeoutError) as ose:
+                Log.server.warning("Unable to reach next hop %s:%d: %r", inner_packet.dest_ip, inner_packet.dest_port,
+                                   ose)
+                link.send(Messages.Packet(Messages.Preambles.MSG_DENY.value, '', 0, 0, b''))
+                return False
+            # Bytes already read past the onion packet belong to the next hop as well
+            next_writer.write(self.codec.encode(inner_packet))
+            next_writer.write(link.detach())
+            await splice(link.reader, link.writer, next_reader, next_writer)
+            return True
+        elif(inner_packet.preamble == Messages.Preambles.MSG_STOP.value):
+            Log.server.debug("Route terminates here, expecting %d bytes", inner_packet.data_size)
+            okay_packet = Messages.Packet(Messages.Preambles.MSG_OKAY.value, inner_packet.dest_ip, inner_packet.dest_port, 0, b'')
+            link.send(okay_packet)
+
+
+    async def gossip(self) -> None:
+        '''Pull the directory of a relay picked at random, from those listed and the seeds, at every interval.
+
+        '''
+        port, fingerprint = self.announcement()
+        while True:
+            await asyncio.sleep(self.gossip_interval)
+            # Never pull from this relay itself, should another node have listed it
+            candidates = [relay for relay in self.directory.relays()
+                          if (relay.port != port) or (self.directory.fingerprint(relay) != fingerprint)]
+            candidates.extend(seed for seed in self.gossip_seeds if seed not in self.directory)
+            if(len(candidates) > 0):
+                await self.pull_peers(random.choice(candidates))
+
+
+    async def pull_peers(self, peer: PeerNode) -> None:
+        '''Read the changes to a relay's directory since it was last read, announcing this relay to it. A listed
+           relay that fails to answer several pulls in a row is dropped from the directory.
+
+        Parameters:
+            peer (PeerNode): Relay to be asked.
+
+        '''
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(peer.ip, peer.port),
+                                                    Directory.GOSSIP_TIMEOUT)
+            link = Link(reader, writer, self.codec, peer)
+            try:
+                request = self.directory.request(peer.socket_addr, *self.announcement())
+                link.send(Messages.Packet(Messages.Preambles.MSG_PEERS.value, peer.ip, peer.port, 0, request))
+                reply = await asyncio.wait_for(anext(link.packets()), Directory.GOSSIP_TIMEOUT)
+                if(reply.preamble != Messages.Preambles.MSG_PEERS.value):
+                    raise(ValueError(f"Expected a directory, got {Metrics.preamble_name(reply.preamble)}"))
+                changes = self.directory.apply(peer.socket_addr, reply.raw_body)
+            finally:
+                link.close()
+        except Exception as e:
+            failures = self.gossip_failures.get(peer, 0) + 1
+            self.gossip_failures[peer] = failures
+            Log.server.debug("Unable to pull the directory of %s: %r", peer.socket_addr, e)
+            if((failures >= Directory.GOSSIP_FAILURES) and self.directory.remove(peer)):
+                Log.server.info("Dropped unresponsive relay %s from the directory", peer.socket_addr)
+                del self.gossip_failures[peer]
+            return
+        self.gossip_failures.pop(peer, None)
+        if(len(changes) > 0):
+            Log.server.debug("Directory of %s brought %d change(s)", peer.socket_addr, len(changes))
+
+
+    def spawn(self, coro: Coroutine) -> asyncio.Task:
+        '''Run a coroutine in the background on the server's event loop, holding a reference until it finishes.
+
+        Parameters:
+            coro (Coroutine): Coroutine to be scheduled.
+
+        Returns:
+            The task wrapping the coroutine.
+        
+        '''
+        task = asyncio.create_task(coro)
+        self.server_tasks.add(task)
+        task.add_done_callback(self.server_tasks.discard)
+        return task
+
+
+
+
+
+# ======================================================================================================================
+async def pump(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    '''Copy bytes from one stream to another until the first reaches its end, then pass the end on.
+
+    Parameters:
+        reader (asyncio.StreamReader): Stream to read from.
+        writer (asyncio.StreamWriter): Stream to write to, whose buffer bounds how far the reader can get ahead.
+    
+    '''
+    try:
+        while True:
+            data = await reader.read(Messages.READ_SIZE)
+            if(not data):
+                break
+            writer.write(data)
+            await writer.drain()
+        if(writer.can_write_eof()):
+            writer.write_eof()
+    except (ConnectionError, OSError):
+        writer.close()
+
+
+async def splice(reader_a: asyncio.StreamReader, writer_a: asyncio.StreamWriter,
+                 reader_b: asyncio.StreamReader, writer_b: asyncio.StreamWriter) -> None:
+    '''Join two connections, copying both directions at once until both have finished.
+
+    Parameters:
+        reader_a (asyncio.StreamReader): Incoming side of the first connection.
+        writer_a (asyncio.StreamWriter): Outgoing side of the first connection.
+        reader_b (asyncio.StreamReader): Incoming side of the second connection.
+        writer_b (asyncio.StreamWriter): Outgoing side of the second connection.
+    
+    '''
+    try:
+        await asyncio.gather(pump(reader_a, writer_b), pump(reader_b, writer_a))
+    finally:
+        writer_a.close()
+        writer_b.close()
+
 
 # ======================================================================================================================
 def create_argv() -> argparse.Namespace:
@@ -334,17 +1675,38 @@ def create_argv() -> argparse.Namespace:
     parser.add_argument("-m", "--mode",
                         help="Mode override",
                         type=str,
-                        choices=["server", "client", "relay", "keygen"],
+                        choices=["server", "client", "relay", "keygen", "stats"],
                         default="relay")
+    parser.add_argument("-w", "--workers",
+                        help="Number of server processes sharing the port",
+                        type=int,
+                        default=1)
+    parser.add_argument("--profile",
+                        help="Directory to write flame graph samples of the hot paths to, on exit or on SIGUSR1",
+                        type=str,
+                        dest="profile_dir")
+    parser.add_argument("-l", "--log_level",
+                        help="Lowest level of messages logged",
+                        type=str,
+                        choices=list(Log.LEVELS.keys()),
+                        default="info")
     return parser.parse_args()
 
 
 # ======================================================================================================================
 if __name__ == "__main__":
     argv = create_argv()
+    Log.configure(argv.log_level)
     if(argv.mode == "keygen"):
         kgen = KeyStore()
         kgen.gen_keys("keys/server.pub", "keys/server.priv")
         kgen.gen_keys("keys/client.pub", "keys/client.priv")
+    elif(argv.mode == "stats"):
+        # Ask the server running on this host, using the port and wire format from its configuration
+        with open(path.join(argv.cfg_dir, "server.json"), 'r') as server_cfg:
+            cfg_data = json.load(server_cfg)
+        port = argv.port if argv.port is not None else int(cfg_data["connection"]["port"])
+        codec = Messages.CellCodec() if cfg_data["connection"].get("cell_mode", False) else Messages.FrameCodec()
+        print(json.dumps(Metrics.fetch("127.0.0.1", port, codec), indent=4))
     else:
-        n = Node(argv.cfg_dir, argv.port, argv.mode)
+        n = Node(argv.cfg_dir, argv.port, argv.mode, argv.workers, argv.profile_dir)
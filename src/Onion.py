@@ -0,0 +1,120 @@
+from KeyStore import KeyStore, NONCE_SIZE, OAEP, SESSION_KEY_BITS
+import Messages
+from Messages import HEADER, Packet
+from PeerNode import PeerNode
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from os import urandom
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+
+# Layer format, matching `KeyStore.encrypt_packet`: [wrapped session key][GCM nonce][ciphertext][GCM tag]
+TAG_SIZE = 16 # AES-GCM authentication tag closing every layer
+
+
+# ======================================================================================================================
+class OnionBuilder(object):
+    '''Builds the nested, hybrid-encrypted onions sent with `MSG_FORWARD`, for any number of routes at once.
+
+    Every onion is laid out in a single buffer allocated at its final size. The innermost packet is packed at the
+    spot it ends up in, and each layer is then encrypted in place around the one inside it, working outwards, so the
+    payload is never copied from one layer to the next. Each hop peels its layer with `KeyStore.decrypt_packet`.
+
+    Attributes:
+        keystore (KeyStore): Source of the public keys of the hops.
+        headers (Dict[PeerNode, bytes]): Packed `MSG_FORWARD` header naming each hop, reused by every onion that
+                                         passes through it.
+
+    '''
+    def __init__(self, keystore: KeyStore) -> None:
+        self.keystore: KeyStore              = keystore
+        self.headers:  Dict[PeerNode, bytes] = dict()
+
+
+    def build(self, route: Sequence[PeerNode], packet: Packet) -> bytearray:
+        '''Wrap a packet in one layer for every hop of a route.
+
+        Parameters:
+            route (Sequence[PeerNode]): Hops the onion passes through, in order.
+            packet (Messages.Packet): Packet delivered to the last hop.
+
+        Returns:
+            The onion, ready to be the body of a `MSG_FORWARD` packet sent to the first hop.
+
+        Raises:
+            ValueError: The route is empty or a hop's key is unknown.
+
+        '''
+        return self.build_many(((route, packet),))[0]
+
+
+    def build_many(self, onions: Iterable[Tuple[Sequence[PeerNode], Packet]]) -> List[bytearray]:
+        '''Wrap several packets, each along its own route, looking up every hop's key only once.
+
+        Parameters:
+            onions (Iterable[Tuple[Sequence[PeerNode], Messages.Packet]]): Route and innermost packet of each onion.
+
+        Returns:
+            The onions, in the order they were requested.
+
+        Raises:
+            ValueError: A route is empty or a hop's key is unknown.
+
+        '''
+        keys = dict()
+        built = list()
+        for route, packet in onions:
+            if(len(route) == 0):
+                raise(ValueError("Onion route must contain at least one hop"))
+            for hop in route:
+                if(hop not in keys):
+                    keys[hop] = self.keystore.get_pub_key(hop)
+                    if(keys[hop] is None):
+                        raise(ValueError(f"No public key known for {hop}"))
+            built.append(self._build(route, packet, keys))
+        return built
+
+
+    def _build(self, route: Sequence[PeerNode], packet: Packet, keys: Dict[PeerNode, rsa.RSAPublicKey]) -> bytearray:
+        '''Lay out and encrypt a single onion, under a fresh session key for every layer.
+
+        '''
+        # Layer i starts at starts[i] and its plaintext is a header naming hop i + 1 followed by layer i + 1
+        starts = [0]
+        for hop in route[:-1]:
+            starts.append(starts[-1] + (keys[hop].key_size // 8) + NONCE_SIZE + HEADER.size)
+        inner = starts[-1] + (keys[route[-1]].key_size // 8) + NONCE_SIZE
+        onion = bytearray(inner + HEADER.size + len(packet.raw_body) + (len(route) * TAG_SIZE))
+        packet.pack_into(onion, inner)
+        with memoryview(onion) as view:
+            for i in range(len(route) - 1, -1, -1):
+                key_end = starts[i] + (keys[route[i]].key_size // 8)
+                plain = key_end + NONCE_SIZE
+                end = len(onion) - ((i + 1) * TAG_SIZE)
+                if(i < len(route) - 1):
+                    onion[plain:(plain + HEADER.size)] = self._header(route[i + 1])
+                session_key = AESGCM.generate_key(bit_length=SESSION_KEY_BITS)
+                nonce = urandom(NONCE_SIZE)
+                wrapped_key = keys[route[i]].encrypt(session_key, OAEP)
+                onion[starts[i]:key_end] = wrapped_key
+                onion[key_end:plain] = nonce
+                # Wrapped key is bound to the sealed body as associated data, as in `KeyStore.encrypt_packet`
+                encryptor = Cipher(algorithms.AES(session_key), modes.GCM(nonce)).encryptor()
+                encryptor.authenticate_additional_data(wrapped_key)
+                encryptor.update_into(view[plain:end], view[plain:(end + TAG_SIZE)])
+                encryptor.finalize()
+                onion[end:(end + TAG_SIZE)] = encryptor.tag
+        return onion
+
+
+    def _header(self, hop: PeerNode) -> bytes:
+        '''Get the packed `MSG_FORWARD` header that sends a layer on to a hop.
+
+        '''
+        header = self.headers.get(hop)
+        if(header is None):
+            header = HEADER.pack(Messages.Preambles.MSG_FORWARD.value, Messages.pack_ip(hop.ip), hop.port, 0, 0, 0)
+            self.headers[hop] = header
+        return header
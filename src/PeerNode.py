@@ -1,8 +1,45 @@
 from dataclasses import dataclass
+from enum import Enum, auto
 import socket
+from time import monotonic
+from typing import Tuple, Union
 
 from cryptography.hazmat.primitives.asymmetric import rsa
 
+
+# Health tracking
+RTT_ALPHA         = 0.2  # Weight of the newest round trip time in a peer's moving average
+FAILURE_THRESHOLD = 3    # Failed attempts in a row that open a peer's breaker
+BREAKER_COOLDOWN  = 30.0 # Seconds an open breaker waits before a single trial attempt is let through
+
+
+class Breaker(Enum):
+    '''State of the circuit breaker kept for every peer, which stops a dead peer from being tried over and over.
+
+    '''
+    CLOSED    = auto() # Peer is answering and may be used
+    OPEN      = auto() # Peer failed too often and is left alone until the cooldown ends
+    HALF_OPEN = auto() # Cooldown ended, and the next attempt decides whether the breaker closes or opens again
+
+
+
+def pack_addr(ip: str, port: int) -> Union[int, Tuple[str, int]]:
+    '''Pack an address into a single value that is cheap to hash and compare.
+
+    Parameters:
+        ip (str): IPv4 address or host name.
+        port (int): Port number.
+
+    Returns:
+        The IPv4 address and port as one 48-bit integer, or the pair itself if the address is not dotted IPv4.
+
+    '''
+    try:
+        return (int.from_bytes(socket.inet_aton(ip), "big") << 16) | int(port)
+    except OSError:
+        return (ip, int(port))
+
+
 # ======================================================================================================================
 class PeerNode(object):
     '''Class used to maintain information about peer nodes.
@@ -12,13 +49,36 @@ class PeerNode(object):
         _port (int): Target port server component is running on.
         _name (str): Customizable human-readable name for peer.
         _is_core (bool): Flag indicating if the node is a trusted core member.
+        _key (Union[int, Tuple[str, int]]): Packed address the node is hashed and compared by.
+        _hash (int): Hash of `_key`, computed once.
+        _rtt (Union[float, None]): Moving average of the round trip times measured to the node, in seconds.
+        _bandwidth (Union[float, None]): Highest throughput, in bytes per second, of a transfer along a circuit
+                                         through the node.
+        _failures (int): Attempts in a row to reach the node that failed.
+        _breaker (Breaker): Whether the node may be used.
+        _opened (float): Monotonic time the breaker last opened.
+
+    Note:
+        Peers are used as dictionary keys throughout, so a peer's address must not be changed while it is stored in
+        one. The health of a peer is not part of its identity, and is updated in place by whoever measures it.
     
     '''
+    __slots__ = ("_ip", "_port", "_name", "_is_core", "_key", "_hash", "_rtt", "_bandwidth", "_failures", "_breaker",
+                 "_opened")
+
+
     def __init__(self, ip: str = "", port: int = 8192, name: str = "UNDEFINED", is_core = False) -> None:
-        self._ip:      str  = ip
-        self._port:    str  = port
-        self._name:    str  = name
-        self._is_core: bool = is_core
+        self._ip:        str                         = ip
+        self._port:      int                         = port
+        self._name:      str                         = name
+        self._is_core:   bool                        = is_core
+        self._key:       Union[int, Tuple[str, int]] = pack_addr(ip, port)
+        self._hash:      int                         = hash(self._key)
+        self._rtt:       Union[float, None]          = None
+        self._bandwidth: Union[float, None]          = None
+        self._failures:  int                         = 0
+        self._breaker:   Breaker                     = Breaker.CLOSED
+        self._opened:    float                       = 0.0
 
 
     # Accessors and mutators -----------------------------------------------------------------------
@@ -30,6 +90,7 @@ class PeerNode(object):
     @ip.setter
     def ip(self, i: str) -> None:
         self._ip = i
+        self._rekey()
     
     
     @property
@@ -40,6 +101,7 @@ class PeerNode(object):
     @port.setter
     def port(self, p: int) -> None:
         self._port = p
+        self._rekey()
 
     
     @property
@@ -74,17 +136,124 @@ class PeerNode(object):
             port = int(port)
             self._ip = ip
             self._port = port
+            self._rekey()
         except Exception as e:
             print("Socket address is not properly formatted")
 
 
+    @property
+    def key(self) -> Union[int, Tuple[str, int]]:
+        return self._key
+
+
+    @property
+    def rtt(self) -> Union[float, None]:
+        return self._rtt
+
+
+    @property
+    def bandwidth(self) -> Union[float, None]:
+        return self._bandwidth
+
+
+    @property
+    def failures(self) -> int:
+        return self._failures
+
+
+    @property
+    def breaker(self) -> Breaker:
+        return self._breaker
+
+
+    @property
+    def healthy(self) -> bool:
+        return self._breaker is Breaker.CLOSED
+
+
+    # Health tracking ------------------------------------------------------------------------------
+    def record_success(self, rtt: float, alpha: float = RTT_ALPHA) -> bool:
+        '''Fold a successful round trip into the node's moving average and close its breaker.
+
+        Parameters:
+            rtt (float): Round trip time measured, in seconds.
+            alpha (float): Weight of the new measurement against the average so far.
+
+        Returns:
+            `True` if the breaker was not closed before.
+
+        '''
+        self._rtt = rtt if self._rtt is None else (alpha * rtt) + ((1.0 - alpha) * self._rtt)
+        self._failures = 0
+        recovered = self._breaker is not Breaker.CLOSED
+        self._breaker = Breaker.CLOSED
+        return recovered
+
+
+    def record_throughput(self, rate: float) -> None:
+        '''Fold the throughput of a transfer along a circuit through the node into its bandwidth estimate.
+
+        A circuit runs at the pace of its slowest relay, so a transfer only shows that every relay along it can carry
+        at least that much. The highest rate seen is therefore kept, rather than an average that would drag a fast
+        relay down to the pace of whatever it was paired with.
+
+        Parameters:
+            rate (float): Bytes per second the transfer achieved.
+
+        '''
+        if((self._bandwidth is None) or (rate > self._bandwidth)):
+            self._bandwidth = rate
+
+
+    def record_failure(self, threshold: int = FAILURE_THRESHOLD) -> bool:
+        '''Count a failed attempt to reach the node, opening its breaker once too many fail in a row or as soon as a
+           trial attempt fails.
+
+        Parameters:
+            threshold (int): Failures in a row that open the breaker.
+
+        Returns:
+            `True` if the breaker opened.
+
+        '''
+        self._failures += 1
+        if((self._breaker is Breaker.HALF_OPEN) or
+           ((self._breaker is Breaker.CLOSED) and (self._failures >= threshold))):
+            self._breaker = Breaker.OPEN
+            self._opened = monotonic()
+            return True
+        return False
+
+
+    def trial_due(self, cooldown: float = BREAKER_COOLDOWN) -> bool:
+        '''Check whether the node may be tried, letting a single trial through once an open breaker has cooled down.
+
+        Parameters:
+            cooldown (float): Seconds an open breaker waits before the trial.
+
+        Returns:
+            `True` unless the breaker is open and still cooling down.
+
+        '''
+        if((self._breaker is Breaker.OPEN) and (monotonic() - self._opened >= cooldown)):
+            self._breaker = Breaker.HALF_OPEN
+        return self._breaker is not Breaker.OPEN
+
+
+    def _rekey(self) -> None:
+        self._key = pack_addr(self._ip, self._port)
+        self._hash = hash(self._key)
+
+
     # Overrides ------------------------------------------------------------------------------------
     def __hash__(self):
-        return(hash(self.socket_addr))
+        return self._hash
 
 
     def __eq__(self, other) -> bool:
-        return((self.socket_addr == other.socket_addr))
+        if(not isinstance(other, PeerNode)):
+            return NotImplemented
+        return(self._key == other._key)
     
 
     def __str__(self) -> str:
@@ -0,0 +1,162 @@
+import ConnectionPool
+import Log
+import Messages
+from PeerNode import PeerNode, RTT_ALPHA, FAILURE_THRESHOLD, BREAKER_COOLDOWN
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+from time import perf_counter
+from typing import Callable, Iterable, Union
+
+
+# Prober parameters
+PROBE_INTERVAL = 10.0 # Seconds between two rounds of probes
+PROBE_TIMEOUT  = 2.0  # Seconds a connected peer has to echo a probe back
+PROBE_WORKERS  = 16   # Peers probed at once
+PROBE_SIZE     = 8    # Random bytes carried by a probe, which the echo must match
+
+
+# ======================================================================================================================
+class Prober(object):
+    '''Measures the health of known relays in the background by sending each a `MSG_ECHO` packet at every interval.
+
+    Round trip times are folded into each peer's moving average, and failures into its circuit breaker. Peers whose
+    breaker is open are only probed again once it has cooled down, and a single successful probe closes it. Every
+    outcome is passed on, so route selection can favour fast relays and skip the ones that are down.
+
+    Attributes:
+        pool (ConnectionPool.ConnectionPool): Connections probes are sent over, which are kept warm for circuits.
+        peers (Callable[[], Iterable[PeerNode]]): Lists the peers to be probed.
+        on_change (Callable[[PeerNode], None]): Called with a peer after each probe of it, or failure to reach it.
+        interval (float): Seconds between rounds.
+        timeout (float): Seconds a peer has to answer once connected.
+        alpha (float): Weight of the newest round trip time in each moving average.
+        threshold (int): Failures in a row that open a peer's breaker.
+        cooldown (float): Seconds an open breaker waits before a trial probe.
+        stopped (threading.Event): Set when probing should end.
+        thread (Union[threading.Thread, None]): Background prober, if started.
+
+    '''
+    def __init__(self, pool: ConnectionPool.ConnectionPool, peers: Callable[[], Iterable[PeerNode]],
+                 on_change: Callable[[PeerNode], None], interval: float = PROBE_INTERVAL,
+                 timeout: float = PROBE_TIMEOUT, alpha: float = RTT_ALPHA, threshold: int = FAILURE_THRESHOLD,
+                 cooldown: float = BREAKER_COOLDOWN) -> None:
+        self.pool:      ConnectionPool.ConnectionPool    = pool
+        self.peers:     Callable[[], Iterable[PeerNode]] = peers
+        self.on_change: Callable[[PeerNode], None]       = on_change
+        self.interval:  float                            = interval
+        self.timeout:   float                            = timeout
+        self.alpha:     float                            = alpha
+        self.threshold: int                              = threshold
+        self.cooldown:  float                            = cooldown
+        self.stopped:   threading.Event                  = threading.Event()
+        self.thread:    Union[threading.Thread, None]    = None
+
+
+    def start(self) -> None:
+        '''Start probing in the background, beginning with a round straight away.
+
+        '''
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="prober", daemon=True)
+        self.thread.start()
+
+
+    def stop(self) -> None:
+        '''Stop probing once the round under way has finished.
+
+        '''
+        self.stopped.set()
+        if(self.thread is not None):
+            self.thread.join()
+            self.thread = None
+
+
+    def run(self) -> None:
+        '''Probe every peer at each interval until stopped. Runs on the prober thread.
+
+        '''
+        with ThreadPoolExecutor(max_workers=PROBE_WORKERS, thread_name_prefix="probe") as workers:
+            while True:
+                # A peer whose connections are all taken by circuits is evidently up, and would only be waited on
+                due = [peer for peer in self.peers()
+                       if (not self.pool.saturated(peer)) and peer.trial_due(self.cooldown)]
+                # Consumed so every probe of the round has finished before the next wait
+                for _ in workers.map(self.probe, due):
+                    pass
+                if(self.stopped.wait(self.interval)):
+                    return
+
+
+    def probe(self, peer: PeerNode) -> None:
+        '''Send a single probe to a peer and record the outcome. Only a peer that cannot be reached or does not
+           answer in time counts as failing, as any answer at all shows it is up.
+
+        Parameters:
+            peer (PeerNode): Peer to be probed.
+
+        '''
+        try:
+            rtt = self.echo(peer)
+        except OSError as e:
+            Log.client.debug("Probe of %s failed: %s", peer.socket_addr, e)
+            self.failed(peer)
+            return
+        except Exception as e:
+            Log.client.debug("Probe of %s was answered with something else: %s", peer.socket_addr, e)
+            return
+        self.succeeded(peer, rtt)
+
+
+    def echo(self, peer: PeerNode) -> float:
+        '''Time a `MSG_ECHO` round trip to a peer, making a single connection attempt if none is open. The connection
+           is closed rather than returned to the pool if anything but the probe comes back on it.
+
+        Parameters:
+            peer (PeerNode): Peer to be probed.
+
+        Returns:
+            The round trip time in seconds.
+
+        Raises:
+            OSError: The peer could not be reached or did not answer in time.
+            ValueError: The peer answered with something other than the probe.
+
+        '''
+        nonce = os.urandom(PROBE_SIZE)
+        with self.pool.connection(peer, self.timeout, 1) as conn:
+            conn.sock.settimeout(self.timeout)
+            sent = perf_counter()
+            conn.send(Messages.Packet(Messages.Preambles.MSG_ECHO.value, peer.ip, peer.port, 0, nonce))
+            reply = conn.recv()
+            rtt = perf_counter() - sent
+            conn.sock.settimeout(None)
+            if((reply.preamble != Messages.Preambles.MSG_ECHO.value) or (bytes(reply.raw_body) != nonce)):
+                raise(ValueError("Probe was not echoed back"))
+        return rtt
+
+
+    def succeeded(self, peer: PeerNode, rtt: float) -> None:
+        '''Record a round trip to a peer, whether measured by a probe or by other traffic.
+
+        Parameters:
+            peer (PeerNode): Peer that answered.
+            rtt (float): Round trip time in seconds.
+
+        '''
+        if(peer.record_success(rtt, self.alpha)):
+            Log.client.info("%s is reachable again", peer.socket_addr)
+        self.on_change(peer)
+
+
+    def failed(self, peer: PeerNode) -> None:
+        '''Record a failed attempt to reach a peer, whether by a probe or by other traffic.
+
+        Parameters:
+            peer (PeerNode): Peer that could not be reached.
+
+        '''
+        if(peer.record_failure(self.threshold)):
+            Log.client.warning("Avoiding %s after %d failed attempt(s)", peer.socket_addr, peer.failures)
+        self.on_change(peer)
@@ -0,0 +1,158 @@
+import Log
+
+import os
+from os import path
+import signal
+import sys
+import threading
+from types import CodeType, FrameType
+from typing import Callable, Dict, Iterable, Set, Union
+
+
+# Profiler parameters
+SAMPLE_INTERVAL = 0.005     # Seconds between two samples of every thread's stack
+DUMP_SIGNAL     = "SIGUSR1" # Signal that makes a running node write out what it has sampled so far
+ALL_SPAN        = "all"     # Span holding every sample, whatever code it landed in
+FOLDED_SUFFIX   = ".folded" # Files hold one "frame;frame;frame count" line per distinct stack
+
+
+# ======================================================================================================================
+class Profiler(object):
+    '''Sampling profiler whose samples are grouped into spans, each being a set of functions such as packet
+       unpacking or hybrid encryption, so a flame graph can be drawn of where the time inside each of them goes.
+
+    A background thread looks at the stack of every other thread at a fixed interval. A sample belongs to a span
+    whenever one of the span's functions is on the stack, and is recorded from the outermost such call down. Nothing is
+    added to the functions themselves, so a node that is not profiled runs exactly the same code, and a coroutine only
+    counts towards a span while it is actually running rather than while it waits.
+
+    Attributes:
+        output_dir (str): Directory the folded stacks of every span are written to.
+        interval (float): Seconds between samples.
+        spans (Dict[str, Set[CodeType]]): Code of the functions making up each span.
+        samples (Dict[str, Dict[str, int]]): Number of times each folded stack was sampled, keyed by span.
+        lock (threading.Lock): Guards `samples` between the sampling thread and a dump.
+        dump_requested (threading.Event): Set by the dump signal so the sampling thread writes the files, as a signal
+                                          handler must not wait on `lock`.
+        stopped (threading.Event): Set when sampling should end.
+        thread (Union[threading.Thread, None]): Sampling thread, once started.
+        labels (Dict[CodeType, str]): Name shown in the flame graph for the code of every function sampled so far.
+
+    Note:
+        The output is the "folded" format read by `flamegraph.pl`, speedscope and most other flame graph tools, one file
+        per span and process, named `<span>-<pid>.folded`.
+
+    '''
+    def __init__(self, output_dir: str, spans: Dict[str, Iterable[Callable]],
+                 interval: float = SAMPLE_INTERVAL) -> None:
+        self.output_dir:     str                           = output_dir
+        self.interval:       float                         = interval
+        self.spans:          Dict[str, Set[CodeType]]      = {name: {function.__code__ for function in functions}
+                                                                for name, functions in spans.items()}
+        self.samples:        Dict[str, Dict[str, int]]     = {name: dict() for name in list(self.spans) + [ALL_SPAN]}
+        self.lock:           threading.Lock                = threading.Lock()
+        self.dump_requested: threading.Event               = threading.Event()
+        self.stopped:        threading.Event               = threading.Event()
+        self.thread:         Union[threading.Thread, None] = None
+        self.labels:         Dict[CodeType, str]           = dict()
+        os.makedirs(output_dir, exist_ok=True)
+
+
+    def start(self) -> None:
+        '''Start sampling, and write out the samples whenever the dump signal arrives if this is the main thread.
+
+        '''
+        if((threading.current_thread() is threading.main_thread()) and hasattr(signal, DUMP_SIGNAL)):
+            signal.signal(getattr(signal, DUMP_SIGNAL), self.request_dump)
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+        self.thread.start()
+
+
+    def stop(self) -> None:
+        '''Stop sampling and write out everything sampled.
+
+        '''
+        self.stopped.set()
+        if(self.thread is not None):
+            self.thread.join()
+            self.thread = None
+        self.dump()
+
+
+    def request_dump(self, signum: int = 0, frame: Union[FrameType, None] = None) -> None:
+        '''Have the sampling thread write out the samples taken so far. Safe to call from a signal handler.
+
+        '''
+        self.dump_requested.set()
+
+
+    def run(self) -> None:
+        '''Sample until stopped. Runs on the sampling thread.
+
+        '''
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            self.sample(own)
+            if(self.dump_requested.is_set()):
+                self.dump_requested.clear()
+                self.dump()
+
+
+    def sample(self, own: int) -> None:
+        '''Record the current stack of every thread but the sampling one.
+
+        Parameters:
+            own (int): Identifier of the sampling thread.
+
+        '''
+        for ident, leaf in sys._current_frames().items():
+            if(ident == own):
+                continue
+            frames = list()
+            frame = leaf
+            while frame is not None:
+                frames.append(frame)
+                frame = frame.f_back
+            frames.reverse()
+            labels = [self.label(frame.f_code) for frame in frames]
+            with self.lock:
+                self._count(ALL_SPAN, ';'.join(labels))
+                for name, codes in self.spans.items():
+                    for depth, frame in enumerate(frames):
+                        if(frame.f_code in codes):
+                            self._count(name, ';'.join(labels[depth:]))
+                            break
+
+
+    def label(self, code: CodeType) -> str:
+        '''Name a function the way it is shown in a flame graph, by its name, file and first line.
+
+        '''
+        label = self.labels.get(code)
+        if(label is None):
+            label = f"{code.co_name} ({path.basename(code.co_filename)}:{code.co_firstlineno})"
+            self.labels[code] = label
+        return label
+
+
+    def _count(self, span: str, stack: str) -> None:
+        '''Add one sample of a folded stack to a span. The caller must hold `lock`.
+
+        '''
+        counts = self.samples[span]
+        counts[stack] = counts.get(stack, 0) + 1
+
+
+    def dump(self) -> None:
+        '''Write the folded stacks of every span, replacing the files of any earlier dump.
+
+        '''
+        with self.lock:
+            snapshot = {span: sorted(counts.items()) for span, counts in self.samples.items()}
+        for span, stacks in snapshot.items():
+            file_path = path.join(self.output_dir, f"{span}-{os.getpid()}{FOLDED_SUFFIX}")
+            with open(file_path, 'w') as folded:
+                for stack, count in stacks:
+                    folded.write(f"{stack} {count}\n")
+            Log.profiler.info("Wrote %d samples of span %s to %s", sum(count for _, count in stacks), span, file_path)
@@ -0,0 +1,335 @@
+from PeerNode import PeerNode
+
+import random
+import threading
+from typing import Collection, Dict, Hashable, List, Set, Tuple, Union
+
+
+# Relay weighting
+DEFAULT_BANDWIDTH = 1024 * 1024 # Bytes per second assumed for a relay that has not been measured
+LATENCY_SCALE     = 0.1         # Round trip time, in seconds, that halves a relay's weight
+
+
+def relay_weight(bandwidth: float, rtt: float) -> float:
+    '''Combine a relay's measured capacity and latency into its selection weight.
+
+    Parameters:
+        bandwidth (float): Bytes per second the relay is able to carry.
+        rtt (float): Round trip time to the relay in seconds.
+
+    Returns:
+        A weight proportional to bandwidth and falling off as latency grows.
+
+    '''
+    return max(0.0, bandwidth) / (1.0 + (max(0.0, rtt) / LATENCY_SCALE))
+
+
+def subnet(peer: PeerNode) -> Hashable:
+    '''Find the /16 network a peer belongs to, so routes can avoid several hops run by the same operator.
+
+    Parameters:
+        peer (PeerNode): Peer to be grouped.
+
+    Returns:
+        The upper 16 bits of an IPv4 address, or the host name itself if the peer has no IPv4 address.
+
+    '''
+    if(isinstance(peer.key, int)):
+        return peer.key >> 32
+    return peer.ip
+
+
+# ======================================================================================================================
+class FenwickTree(object):
+    '''Binary indexed tree over a growable array of weights, giving logarithmic updates and weighted sampling.
+
+    Attributes:
+        weights (List[float]): Weight of every slot.
+        tree (List[float]): Partial sums, 1-indexed, with `tree[i]` covering the `i & -i` slots ending at slot `i`.
+        positive (int): Number of slots with a weight above zero.
+
+    Note:
+        Updates apply differences to the partial sums, so zeroing a slot can leave a rounding residue behind. The
+        count of weighted slots is kept exactly, so a tree without any reports a total of zero, and `find` only ever
+        returns a slot that has weight.
+
+    '''
+    def __init__(self) -> None:
+        self.weights:  List[float] = list()
+        self.tree:     List[float] = [0.0]
+        self.positive: int         = 0
+
+
+    def append(self, weight: float) -> int:
+        '''Add a slot to the end of the tree.
+
+        Parameters:
+            weight (float): Weight of the new slot.
+
+        Returns:
+            Index of the new slot.
+
+        '''
+        i = len(self.tree)
+        self.weights.append(0.0)
+        self.tree.append(self.prefix(i - 1) - self.prefix(i - (i & -i)))
+        self.update(i - 1, weight)
+        return i - 1
+
+
+    def update(self, index: int, weight: float) -> None:
+        '''Change the weight of a slot.
+
+        Parameters:
+            index (int): Slot to be changed.
+            weight (float): New weight.
+
+        '''
+        weight = max(0.0, weight)
+        delta = weight - self.weights[index]
+        self.positive += (weight > 0.0) - (self.weights[index] > 0.0)
+        self.weights[index] = weight
+        i = index + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+
+    def prefix(self, count: int) -> float:
+        '''Sum the weights of the first `count` slots.
+
+        '''
+        total = 0.0
+        while count > 0:
+            total += self.tree[count]
+            count -= count & -count
+        return total
+
+
+    def total(self) -> float:
+        if(self.positive == 0):
+            return 0.0
+        return max(0.0, self.prefix(len(self.weights)))
+
+
+    def find(self, target: float) -> int:
+        '''Find the slot whose cumulative weight range contains a point, which samples slots in proportion to
+           their weights when the point is uniformly distributed over `[0, total())`.
+
+        Parameters:
+            target (float): Point within the cumulative weights.
+
+        Returns:
+            Index of the slot, which always has a weight above zero.
+
+        Raises:
+            ValueError: No slot has any weight.
+
+        '''
+        if(self.positive == 0):
+            raise(ValueError("No slot has any weight"))
+        pos = 0
+        step = 1 << len(self.weights).bit_length()
+        while step > 0:
+            nxt = pos + step
+            if((nxt < len(self.tree)) and (self.tree[nxt] <= target)):
+                target -= self.tree[nxt]
+                pos = nxt
+            step >>= 1
+        if((pos < len(self.weights)) and (self.weights[pos] > 0.0)):
+            return pos
+        # Rounding can land on a slot without weight, so fall back to the closest one that has some
+        for index in range(min(pos, len(self.weights)) - 1, -1, -1):
+            if(self.weights[index] > 0.0):
+                return index
+        for index in range(pos + 1, len(self.weights)):
+            if(self.weights[index] > 0.0):
+                return index
+        raise(ValueError("No slot has any weight"))
+
+
+    def __len__(self) -> int:
+        return len(self.weights)
+
+
+
+# ======================================================================================================================
+class RouteSelector(object):
+    '''Weighted relay sampler that builds routes in logarithmic time, however many relays are known.
+
+    Relays are grouped by /16 network. A Fenwick tree over the groups picks a network in proportion to its combined
+    weight, and a Fenwick tree within that group picks the relay. Exclusions are applied by zeroing weights for the
+    duration of a single selection and restoring them afterwards.
+
+    Attributes:
+        distinct_subnets (bool): Whether a route may use at most one relay from each /16 network.
+        groups (Dict[Hashable, int]): Index of each network's group.
+        group_tree (FenwickTree): Combined weight of each group.
+        member_trees (List[FenwickTree]): Weight of each relay, one tree per group.
+        members (List[List[PeerNode]]): Relays in each group, in slot order.
+        slots (Dict[PeerNode, Tuple[int, int]]): Group and slot of every relay ever added.
+        metrics (Dict[PeerNode, Tuple[float, float]]): Bandwidth and round trip time of every selectable relay.
+        down (Set[PeerNode]): Selectable relays that are currently unhealthy, kept with a weight of zero.
+        lock (threading.Lock): Guards everything above, as relays are added and measured in the background while
+                               the circuit builder selects routes.
+
+    '''
+    def __init__(self, distinct_subnets: bool = True) -> None:
+        self.distinct_subnets: bool                                = distinct_subnets
+        self.groups:           Dict[Hashable, int]                 = dict()
+        self.group_tree:       FenwickTree                         = FenwickTree()
+        self.member_trees:     List[FenwickTree]                   = list()
+        self.members:          List[List[PeerNode]]                = list()
+        self.slots:            Dict[PeerNode, Tuple[int, int]]     = dict()
+        self.metrics:          Dict[PeerNode, Tuple[float, float]] = dict()
+        self.down:             Set[PeerNode]                       = set()
+        self.lock:             threading.Lock                      = threading.Lock()
+
+
+    def add(self, peer: PeerNode, bandwidth: float = DEFAULT_BANDWIDTH, rtt: float = 0.0) -> None:
+        '''Make a relay selectable, or update it if it already is.
+
+        Parameters:
+            peer (PeerNode): Relay to be added.
+            bandwidth (float): Bytes per second the relay is able to carry.
+            rtt (float): Round trip time to the relay in seconds.
+
+        '''
+        with self.lock:
+            self._add(peer, bandwidth, rtt)
+
+
+    def update(self, peer: PeerNode, bandwidth: Union[float, None] = None, rtt: Union[float, None] = None,
+               healthy: Union[bool, None] = None) -> None:
+        '''Record new measurements for a selectable relay.
+
+        Parameters:
+            peer (PeerNode): Relay that was measured.
+            bandwidth (Union[float, None]): Bytes per second the relay carried, or `None` to keep the last value.
+            rtt (Union[float, None]): Round trip time to the relay, or `None` to keep the last value.
+            healthy (Union[bool, None]): Whether the relay may be selected, or `None` to leave it as it was. An
+                                         unhealthy relay keeps its measurements but is never picked.
+
+        '''
+        with self.lock:
+            if(peer not in self.metrics):
+                return
+            if(healthy is not None):
+                if(healthy):
+                    self.down.discard(peer)
+                else:
+                    self.down.add(peer)
+            old_bandwidth, old_rtt = self.metrics[peer]
+            self._add(peer,
+                      old_bandwidth if bandwidth is None else bandwidth,
+                      old_rtt if rtt is None else rtt)
+
+
+    def remove(self, peer: PeerNode) -> None:
+        '''Stop selecting a relay. Its slot is kept so adding it again costs no allocation.
+
+        Parameters:
+            peer (PeerNode): Relay to be removed.
+
+        '''
+        with self.lock:
+            self.down.discard(peer)
+            if(self.metrics.pop(peer, None) is not None):
+                self._set_weight(peer, 0.0)
+
+
+    def select(self, depth: int, exclude: Collection[PeerNode] = ()) -> List[PeerNode]:
+        '''Pick the relays of a route, each in proportion to its weight, without repeating a relay.
+
+        Parameters:
+            depth (int): Number of relays in the route.
+            exclude (Collection[PeerNode]): Relays that must not appear in the route.
+
+        Returns:
+            The relays, in the order they should be traversed.
+
+        Raises:
+            ValueError: Too few relays satisfy the constraints.
+
+        '''
+        if((type(depth) is not int) or (depth <= 0)):
+            raise(ValueError("Route size must be a positive integer"))
+        undo = list()
+        route = list()
+        with self.lock:
+            try:
+                for peer in exclude:
+                    if(peer in self.metrics):
+                        self._exclude(peer, undo, False)
+                while len(route) < depth:
+                    total = self.group_tree.total()
+                    if(total <= 0.0):
+                        raise(ValueError(f"Not enough eligible relays for a route of {depth} hops"))
+                    group = self.group_tree.find(random.random() * total)
+                    members = self.member_trees[group]
+                    peer = self.members[group][members.find(random.random() * members.total())]
+                    # Unhealthy relays are kept at a weight of zero, but are checked for as well in case one slips by
+                    if(peer in self.down):
+                        self._exclude(peer, undo, False)
+                        continue
+                    route.append(peer)
+                    self._exclude(peer, undo, self.distinct_subnets)
+            finally:
+                for tree, index, weight in reversed(undo):
+                    tree.update(index, weight)
+        return route
+
+
+    def _add(self, peer: PeerNode, bandwidth: float, rtt: float) -> None:
+        '''Make a relay selectable, or update it if it already is. The caller must hold `lock`.
+
+        '''
+        if(peer not in self.slots):
+            group = self.groups.get(subnet(peer))
+            if(group is None):
+                group = self.group_tree.append(0.0)
+                self.groups[subnet(peer)] = group
+                self.member_trees.append(FenwickTree())
+                self.members.append(list())
+            self.slots[peer] = (group, self.member_trees[group].append(0.0))
+            self.members[group].append(peer)
+        self.metrics[peer] = (bandwidth, rtt)
+        self._set_weight(peer, 0.0 if peer in self.down else relay_weight(bandwidth, rtt))
+
+
+    def _set_weight(self, peer: PeerNode, weight: float) -> None:
+        group, slot = self.slots[peer]
+        members = self.member_trees[group]
+        members.update(slot, weight)
+        self.group_tree.update(group, members.total())
+
+
+    def _exclude(self, peer: PeerNode, undo: List[Tuple[FenwickTree, int, float]], whole_group: bool) -> None:
+        '''Temporarily zero a relay, or its entire group, recording the old weights in `undo`.
+
+        '''
+        group, slot = self.slots[peer]
+        undo.append((self.group_tree, group, self.group_tree.weights[group]))
+        if(whole_group):
+            self.group_tree.update(group, 0.0)
+            return
+        members = self.member_trees[group]
+        undo.append((members, slot, members.weights[slot]))
+        members.update(slot, 0.0)
+        self.group_tree.update(group, members.total())
+
+
+    def relays(self) -> List[PeerNode]:
+        '''List every selectable relay, healthy or not.
+
+        '''
+        with self.lock:
+            return list(self.metrics)
+
+
+    def __contains__(self, peer: PeerNode) -> bool:
+        return peer in self.metrics
+
+
+    def __len__(self) -> int:
+        return len(self.metrics)
@@ -0,0 +1,174 @@
+import Messages
+from Messages import Packet
+
+import os
+from struct import Struct
+from typing import BinaryIO, Iterator, Tuple, Union
+
+
+# Bulk transfer parameters
+CHUNK_SIZE     = 16 * 1024    # Payload of each `MSG_DATA` packet in a transfer
+WRITE_BUFFER   = 1024 * 1024  # Bytes the receiving side gathers before writing to disk
+STALL_TIMEOUT  = 30.0         # Seconds a relay sending a file waits for the client to reopen its window
+PARTIAL_SUFFIX = ".part"      # Appended to a file's name until every byte of it has arrived
+OFFER          = Struct("!Q") # Size of the file, ahead of its name in the body of a `MSG_ISEND` offer
+
+
+def offer_packet(name: str, size: int, stream_id: int) -> Packet:
+    '''Announce a file that is about to be sent on a stream.
+
+    Parameters:
+        name (str): Name the file is stored under at the other end.
+        size (int): Size of the file in bytes, which may exceed the 32-bit `data_size` header field.
+        stream_id (int): Stream the file's chunks will follow on.
+
+    Returns:
+        A `MSG_ISEND` packet carrying the size and name.
+
+    '''
+    return Packet(Messages.Preambles.MSG_ISEND.value, '', 0, 0, OFFER.pack(size) + name.encode("utf-8"),
+                  _stream_id=stream_id)
+
+
+def parse_offer(packet: Packet) -> Tuple[str, int]:
+    '''Read the name and size out of a `MSG_ISEND` offer.
+
+    Parameters:
+        packet (Messages.Packet): Received offer.
+
+    Returns:
+        The file's name and size in bytes.
+
+    Raises:
+        ValueError: The offer is malformed or names a file outside the transfer directory.
+
+    '''
+    body = packet.raw_body
+    if(len(body) < OFFER.size):
+        raise(ValueError("Truncated file offer"))
+    return safe_name(str(body[OFFER.size:], "utf-8")), OFFER.unpack_from(body)[0]
+
+
+def safe_name(name: str) -> str:
+    '''Check that a file name sent by a peer cannot escape the directory it is stored in.
+
+    Parameters:
+        name (str): Name received from the peer.
+
+    Returns:
+        The name, unchanged.
+
+    Raises:
+        ValueError: The name is empty or contains a path.
+
+    '''
+    if((name in ('', '.', "..")) or (os.path.basename(name) != name) or ('\0' in name)):
+        raise(ValueError(f"Invalid file name {name!r}"))
+    return name
+
+
+# ======================================================================================================================
+class FileSource(object):
+    '''Reads a file in fixed-size chunks into a single buffer that is reused for every chunk, so memory use does not
+       grow with the size of the file.
+
+    Attributes:
+        file (BinaryIO): Unbuffered handle of the file being read.
+        size (int): Size of the file in bytes.
+        buffer (bytearray): Buffer every chunk is read into.
+
+    Note:
+        Each chunk is a view of `buffer` and is only valid until the next one is read, so it must be sent or copied
+        before the iteration continues.
+
+    '''
+    def __init__(self, file_path: str, chunk_size: int = CHUNK_SIZE) -> None:
+        self.file:   BinaryIO  = open(file_path, "rb", buffering=0)
+        self.size:   int       = os.fstat(self.file.fileno()).st_size
+        self.buffer: bytearray = bytearray(chunk_size)
+
+
+    def __iter__(self) -> Iterator[memoryview]:
+        with memoryview(self.buffer) as view:
+            while True:
+                count = self.file.readinto(view)
+                if(not count):
+                    return
+                yield view[:count]
+
+
+    def close(self) -> None:
+        self.file.close()
+
+
+    def __enter__(self) -> "FileSource":
+        return self
+
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+
+class FileSink(object):
+    '''Writes the chunks of an incoming file through a large buffer, keeping it under a temporary name until every
+       byte has arrived.
+
+    Attributes:
+        path (str): Final location of the file.
+        remaining (int): Bytes still expected.
+        file (Union[BinaryIO, None]): Buffered handle of the partial file, or `None` once closed.
+
+    '''
+    def __init__(self, file_path: str, size: int, buffer_size: int = WRITE_BUFFER) -> None:
+        self.path:      str                   = file_path
+        self.remaining: int                   = size
+        self.file:      Union[BinaryIO, None] = open(file_path + PARTIAL_SUFFIX, "wb", buffering=buffer_size)
+
+
+    def write(self, chunk: Union[bytes, memoryview]) -> bool:
+        '''Append the next chunk of the file.
+
+        Parameters:
+            chunk (Union[bytes, memoryview]): Data received from the peer.
+
+        Returns:
+            `True` once the whole file has been received.
+
+        Raises:
+            ValueError: The peer sent more data than it offered.
+
+        '''
+        if(len(chunk) > self.remaining):
+            raise(ValueError(f"Received {len(chunk) - self.remaining} bytes more than offered"))
+        self.file.write(chunk)
+        self.remaining -= len(chunk)
+        return self.done
+
+
+    @property
+    def done(self) -> bool:
+        return self.remaining == 0
+
+
+    def close(self) -> None:
+        '''Flush the file and move it to its final name.
+
+        '''
+        self.file.close()
+        self.file = None
+        os.replace(self.path + PARTIAL_SUFFIX, self.path)
+
+
+    def abort(self) -> None:
+        '''Give up on the file and delete what was received of it.
+
+        '''
+        if(self.file is None):
+            return
+        self.file.close()
+        self.file = None
+        try:
+            os.remove(self.path + PARTIAL_SUFFIX)
+        except OSError:
+            pass
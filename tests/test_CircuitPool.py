@@ -0,0 +1,44 @@
+from CircuitPool import CircuitPool
+
+import threading
+from time import monotonic
+
+import pytest
+
+
+class SlowCircuit(object):
+    '''Stands in for a circuit whose first hop takes a long time to acknowledge the teardown.
+
+    '''
+    def __init__(self) -> None:
+        self.closing = threading.Event()
+        self.release = threading.Event()
+
+
+    def close(self) -> None:
+        self.closing.set()
+        self.release.wait(5.0)
+
+
+def test_closing_a_retired_circuit_does_not_block_others():
+    pool = CircuitPool(lambda: None, 2, 60.0, 60.0)
+    retired, fresh, spare = SlowCircuit(), SlowCircuit(), SlowCircuit()
+    pool.ready.extend([(monotonic() - 1.0, retired), (monotonic() + 60.0, spare), (monotonic() + 60.0, fresh)])
+    first = threading.Thread(target=pool.get)
+    first.start()
+    assert retired.closing.wait(5.0)
+    try:
+        # The first caller is still tearing the retired circuit down
+        start = monotonic()
+        assert pool.get(1.0) in (fresh, spare)
+        assert monotonic() - start < 0.5
+    finally:
+        retired.release.set()
+        first.join()
+    assert len(pool) == 0
+
+
+def test_get_times_out_when_nothing_is_ready():
+    pool = CircuitPool(lambda: None, 1, 60.0, 60.0)
+    with pytest.raises(TimeoutError):
+        pool.get(0.05)
@@ -0,0 +1,84 @@
+from ConnectionPool import ConnectionPool, PooledConnection
+import Messages
+from PeerNode import PeerNode
+
+import socket
+import threading
+from time import monotonic, sleep
+
+import pytest
+
+
+@pytest.mark.parametrize("codec", [Messages.FrameCodec(), Messages.CellCodec()], ids=["frames", "cells"])
+def test_recv_drops_cells_of_earlier_circuits(codec: Messages.Codec):
+    pool = ConnectionPool(codec)
+    near, far = socket.socketpair()
+    with near, far:
+        conn = PooledConnection(pool, PeerNode("127.0.0.1", 7000), near)
+        # Still in flight from a circuit torn down before the connection went back to the pool
+        far.sendall(codec.encode(Messages.Packet(Messages.Preambles.MSG_RELAY.value, '', 0, 0, b"stale", 7)))
+        far.sendall(codec.encode(Messages.Packet(Messages.Preambles.MSG_DESTROY.value, '', 0, 0, b'', 7)))
+        far.sendall(codec.encode(Messages.Packet(Messages.Preambles.MSG_ECHO.value, '', 0, 0, b"probe")))
+        far.sendall(codec.encode(Messages.Packet(Messages.Preambles.MSG_CREATED.value, '', 0, 0, b"keys", 9)))
+        reply = conn.recv()
+        assert (reply.preamble, bytes(reply.raw_body)) == (Messages.Preambles.MSG_ECHO.value, b"probe")
+        reply = conn.recv(9)
+        assert (reply.preamble, bytes(reply.raw_body)) == (Messages.Preambles.MSG_CREATED.value, b"keys")
+
+
+def listener() -> socket.socket:
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(8)
+    return server
+
+
+def test_release_wakes_the_caller_waiting_on_that_peer():
+    pool = ConnectionPool(Messages.FrameCodec(), max_per_peer=1)
+    with listener() as a, listener() as b:
+        peers = [PeerNode(*server.getsockname()) for server in (a, b)]
+        held = [pool.acquire(peer) for peer in peers]
+        got = dict()
+        waiters = [threading.Thread(target=lambda peer=peer: got.update({peer: pool.acquire(peer, 3.0)}))
+                   for peer in peers]
+        for waiter in waiters:
+            waiter.start()
+        sleep(0.2)
+        # Whichever caller wakes first, the one waiting on the released peer must still get its connection
+        start = monotonic()
+        held[1].release()
+        waiters[1].join()
+        assert got[peers[1]] is held[1]
+        assert monotonic() - start < 1.0
+        held[0].release()
+        waiters[0].join()
+        assert got[peers[0]] is held[0]
+        pool.close()
+
+
+def test_acquire_timeout_is_not_restarted_by_other_peers():
+    pool = ConnectionPool(Messages.FrameCodec(), max_per_peer=1)
+    with listener() as a, listener() as b:
+        busy, other = PeerNode(*a.getsockname()), PeerNode(*b.getsockname())
+        held = pool.acquire(busy)
+        stop = threading.Event()
+        start = monotonic()
+
+        def churn() -> None:
+            # Keeps notifying the condition without ever freeing a connection to the busy peer, for long enough
+            # that a wait restarted on every wakeup would overrun
+            while (not stop.is_set()) and (monotonic() - start < 2.0):
+                pool.acquire(other, 1.0).release()
+                sleep(0.05)
+
+        churner = threading.Thread(target=churn)
+        churner.start()
+        try:
+            with pytest.raises(TimeoutError):
+                pool.acquire(busy, 0.5)
+        finally:
+            stop.set()
+            churner.join()
+        assert monotonic() - start < 0.7
+        held.release()
+        pool.close()
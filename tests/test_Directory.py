@@ -0,0 +1,164 @@
+import Directory
+from Directory import Directory as RelayDirectory, OP_ADD, OP_REMOVE
+from KeyStore import KeyStore
+from Node import Node
+from PeerNode import PeerNode
+import RouteSelector
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import pytest
+
+
+FINGERPRINT_A = bytes(32)
+FINGERPRINT_B = bytes([1]) * 32
+
+
+def read(reader: RelayDirectory, source: RelayDirectory, name: str = "core", replace: bool = False):
+    return reader.apply(name, source.delta(reader.request(name)), replace)
+
+
+def test_first_read_is_the_whole_directory():
+    source = RelayDirectory()
+    source.add("10.0.0.1", 1000, FINGERPRINT_A)
+    source.add("10.0.0.2", 1000, FINGERPRINT_B)
+    reader = RelayDirectory()
+    changes = read(reader, source)
+    assert {(op, relay.socket_addr, fingerprint) for op, relay, fingerprint in changes} == \
+           {(OP_ADD, "10.0.0.1:1000", FINGERPRINT_A), (OP_ADD, "10.0.0.2:1000", FINGERPRINT_B)}
+    assert read(reader, source) == []
+
+
+def test_delta_only_carries_the_latest_changes():
+    source = RelayDirectory()
+    source.add("10.0.0.1", 1000, FINGERPRINT_A)
+    source.add("10.0.0.2", 1000, FINGERPRINT_A)
+    reader = RelayDirectory()
+    read(reader, source)
+    source.add("10.0.0.1", 1000, FINGERPRINT_B)
+    source.remove(PeerNode("10.0.0.2", 1000))
+    source.add("10.0.0.3", 1000, FINGERPRINT_A)
+    source.remove(PeerNode("10.0.0.3", 1000))
+    delta = source.delta(reader.request("core"))
+    # Only the latest change to each of the three relays is sent
+    assert len(delta) == Directory.DELTA_HEADER.size + (3 * Directory.ENTRY.size)
+    changes = reader.apply("core", delta)
+    assert {(op, relay.socket_addr) for op, relay, _ in changes} == \
+           {(OP_ADD, "10.0.0.1:1000"), (OP_REMOVE, "10.0.0.2:1000")}
+    assert reader.entries == source.entries
+
+
+def test_stale_removal_keeps_newer_key():
+    source = RelayDirectory()
+    source.add("10.0.0.1", 1000, FINGERPRINT_A)
+    reader = RelayDirectory()
+    read(reader, source)
+    reader.add("10.0.0.1", 1000, FINGERPRINT_B)
+    source.remove(PeerNode("10.0.0.1", 1000))
+    assert read(reader, source) == []
+    assert reader.fingerprint(PeerNode("10.0.0.1", 1000)) == FINGERPRINT_B
+
+
+def test_history_overflow_sends_whole_directory():
+    source = RelayDirectory(history_size=2)
+    reader = RelayDirectory()
+    read(reader, source)
+    for i in range(0, 4):
+        source.add(f"10.0.0.{i}", 1000, FINGERPRINT_A)
+    delta = source.delta(reader.request("core"))
+    assert Directory.DELTA_HEADER.unpack_from(delta)[1] == 0
+    read(reader, source)
+    assert reader.entries == source.entries
+
+
+def test_delta_that_skips_versions_is_refused():
+    source = RelayDirectory()
+    source.add("10.0.0.1", 1000, FINGERPRINT_A)
+    reader = RelayDirectory()
+    read(reader, source)
+    request = reader.request("core")
+    source.add("10.0.0.2", 1000, FINGERPRINT_A)
+    read(reader, source)
+    source.add("10.0.0.3", 1000, FINGERPRINT_A)
+    with pytest.raises(ValueError):
+        # Starts from a version the reader has already moved past
+        reader.apply("core", source.delta(request))
+    with pytest.raises(ValueError):
+        reader.apply("core", bytes(Directory.DELTA_HEADER.size - 1))
+
+
+def test_whole_directory_prunes_only_when_replacing():
+    source = RelayDirectory()
+    source.add("10.0.0.1", 1000, FINGERPRINT_A)
+    source.add("10.0.0.2", 1000, FINGERPRINT_A)
+    merged = RelayDirectory()
+    mirror = RelayDirectory()
+    read(merged, source)
+    read(mirror, source, replace=True)
+    # A restarted node starts a new directory, listing only one of the relays
+    restarted = RelayDirectory()
+    restarted.add("10.0.0.1", 1000, FINGERPRINT_A)
+    assert read(merged, restarted) == []
+    assert len(merged) == 2
+    changes = read(mirror, restarted, replace=True)
+    assert [(op, relay.socket_addr) for op, relay, _ in changes] == [(OP_REMOVE, "10.0.0.2:1000")]
+    assert PeerNode("10.0.0.2", 1000) not in mirror
+
+
+# ======================================================================================================================
+@pytest.fixture(scope="module")
+def relay_key() -> rsa.RSAPublicKey:
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048).public_key()
+
+
+def syncing_node(core_directory: RelayDirectory, key: rsa.RSAPublicKey) -> Node:
+    '''Build just enough of a node to run `sync_directory` against a core's directory, handing out `key` to every
+       relay whose key is fetched.
+
+    '''
+    node = Node.__new__(Node)
+    node.keystore = KeyStore()
+    node.selector = RouteSelector.RouteSelector(distinct_subnets=False)
+    node.directory = RelayDirectory()
+    node.core_directory = RelayDirectory()
+    node.keystore.add_peer(PeerNode("10.9.0.1", 9000, "core", True), key)
+    node.request_peers = lambda peer, timeout: core_directory.delta(node.core_directory.request(peer.socket_addr))
+
+    def fetch_keys(peers, timeout, deadline):
+        for peer in peers:
+            node.keystore.set_peer_key(peer, key)
+            node.selector.add(peer)
+        return len(peers)
+    node.fetch_keys = fetch_keys
+    return node
+
+
+def test_sync_sets_up_relays_already_gossiped(relay_key: rsa.RSAPublicKey):
+    core = RelayDirectory()
+    fingerprint = Directory.key_fingerprint(relay_key)
+    relays = [PeerNode("10.0.0.1", 1000), PeerNode("10.0.0.2", 1000)]
+    node = syncing_node(core, relay_key)
+    for relay in relays:
+        core.add(relay.ip, relay.port, fingerprint)
+        # The server component already learned of the relay by gossip
+        node.directory.add(relay.ip, relay.port, fingerprint)
+    assert node.sync_directory() == 2
+    assert set(node.selector.relays()) == set(relays)
+
+
+def test_sync_prunes_relays_missing_from_whole_directory(relay_key: rsa.RSAPublicKey):
+    core = RelayDirectory()
+    fingerprint = Directory.key_fingerprint(relay_key)
+    kept, dropped = PeerNode("10.0.0.1", 1000), PeerNode("10.0.0.2", 1000)
+    core.add(kept.ip, kept.port, fingerprint)
+    core.add(dropped.ip, dropped.port, fingerprint)
+    node = syncing_node(core, relay_key)
+    node.sync_directory()
+    assert set(node.selector.relays()) == {kept, dropped}
+    # The core restarted and no longer lists one of the relays
+    restarted = RelayDirectory()
+    restarted.add(kept.ip, kept.port, fingerprint)
+    node.request_peers = lambda peer, timeout: restarted.delta(node.core_directory.request(peer.socket_addr))
+    node.sync_directory()
+    assert node.selector.relays() == [kept]
+    assert node.keystore.get_peer(dropped) is None
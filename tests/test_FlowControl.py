@@ -0,0 +1,63 @@
+from Circuit import CIRCUIT_INCREMENT, CIRCUIT_WINDOW, STREAM_INCREMENT, STREAM_WINDOW, FlowControl
+import Messages
+
+
+def data(stream_id: int = 0) -> Messages.Packet:
+    return Messages.Packet(Messages.Preambles.MSG_DATA.value, '', 0, 0, b'', _stream_id=stream_id)
+
+
+def sendme(stream_id: int = 0) -> Messages.Packet:
+    return Messages.Packet(Messages.Preambles.MSG_SENDME.value, '', 0, 0, b'', _stream_id=stream_id)
+
+
+def test_circuit_window_closes_and_reopens():
+    flow = FlowControl()
+    for _ in range(0, CIRCUIT_WINDOW):
+        assert flow.can_package(data())
+        flow.packaged(data())
+    assert not flow.can_package(data())
+    # Acknowledgements are never held back by the window they reopen
+    assert flow.can_package(sendme())
+    flow.sendme(sendme())
+    assert flow.package == CIRCUIT_INCREMENT
+    assert flow.can_package(data())
+
+
+def test_stream_window_closes_independently():
+    flow = FlowControl()
+    for _ in range(0, STREAM_WINDOW):
+        flow.packaged(data(1))
+    assert not flow.can_package(data(1))
+    assert flow.can_package(data(2))
+    assert flow.can_package(data())
+    flow.sendme(sendme(1))
+    assert flow.stream_package[1] == STREAM_INCREMENT
+    assert flow.can_package(data(1))
+    flow.end_stream(1)
+    assert 1 not in flow.stream_package
+
+
+def test_receiver_owes_a_sendme_per_increment():
+    flow = FlowControl()
+    owed = list()
+    for _ in range(0, CIRCUIT_INCREMENT):
+        owed.extend(flow.delivered(data(3)))
+    assert owed.count(0) == 1
+    assert owed.count(3) == CIRCUIT_INCREMENT // STREAM_INCREMENT
+    assert flow.delivered(sendme()) == []
+    assert flow.deliver == CIRCUIT_WINDOW
+
+
+def test_windows_match_between_both_ends():
+    sender, receiver = FlowControl(), FlowControl()
+    sent = 0
+    for _ in range(0, 10 * CIRCUIT_WINDOW):
+        # The sender stops once a window is closed, until the receiver's acknowledgements reopen it
+        assert sender.can_package(data(1))
+        sender.packaged(data(1))
+        sent += 1
+        for stream_id in receiver.delivered(data(1)):
+            sender.sendme(sendme(stream_id))
+    assert sent == 10 * CIRCUIT_WINDOW
+    assert sender.package == CIRCUIT_WINDOW
+    assert sender.stream_package[1] == STREAM_WINDOW
@@ -0,0 +1,20 @@
+import KeyCache
+from PeerNode import PeerNode
+
+import os
+
+
+def test_load_returns_only_the_fresh_keys_asked_for(tmp_path):
+    cache = KeyCache.KeyCache(str(tmp_path / "keys.db"), ttl=60.0)
+    peers = [PeerNode("10.0.%d.%d" % (i // 256, i % 256), 7000) for i in range(0, 3 * KeyCache.LOAD_CHUNK)]
+    keys = {peer: os.urandom(32) for peer in peers}
+    for peer, der in keys.items():
+        cache.store(peer, der)
+    with cache.db:
+        cache.db.execute("UPDATE peer_keys SET fetched = 0 WHERE socket_addr = ?", (peers[1].socket_addr,))
+        cache.db.execute("UPDATE peer_keys SET fingerprint = ? WHERE socket_addr = ?",
+                         (bytes(32), peers[2].socket_addr))
+    # Spans several chunks, skips the expired and damaged entries, and ignores the peers that were not asked for
+    wanted = peers[:(2 * KeyCache.LOAD_CHUNK + 1)] + [PeerNode("10.255.0.1", 7000)]
+    assert cache.load(wanted) == {peer: keys[peer] for peer in wanted[:-1] if peer not in peers[1:3]}
+    cache.close()
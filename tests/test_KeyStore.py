@@ -0,0 +1,46 @@
+from KeyStore import KeyStore
+import Messages
+from Onion import OnionBuilder
+from PeerNode import PeerNode
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import pytest
+
+
+@pytest.fixture(scope="module")
+def keystore() -> KeyStore:
+    keystore = KeyStore()
+    keystore.server_keypair.private = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    keystore.server_keypair.public = keystore.server_keypair.private.public_key()
+    for i in range(0, 3):
+        keystore.add_peer(PeerNode("127.0.0.1", 7000 + i), keystore.server_keypair.public)
+    return keystore
+
+
+def test_layers_do_not_share_wrapped_keys(keystore: KeyStore):
+    peer = PeerNode("127.0.0.1", 7000)
+    packet = Messages.Packet(Messages.Preambles.MSG_DATA.value, "127.0.0.1", 7000, 5, b"hello")
+    key_size = keystore.server_keypair.public.key_size // 8
+    layers = [keystore.encrypt_packet(packet, peer) for _ in range(0, 4)]
+    assert len({layer[:key_size] for layer in layers}) == len(layers)
+    for layer in layers:
+        assert bytes(keystore.decrypt_packet(layer).raw_body) == b"hello"
+
+
+def test_onions_do_not_share_wrapped_keys(keystore: KeyStore):
+    route = [PeerNode("127.0.0.1", 7000 + i) for i in range(0, 3)]
+    packet = Messages.Packet(Messages.Preambles.MSG_DATA.value, "127.0.0.1", 7002, 5, b"hello")
+    key_size = keystore.server_keypair.public.key_size // 8
+    wrapped = list()
+    for onion in OnionBuilder(keystore).build_many([(route, packet), (route, packet)]):
+        layer = onion
+        for hop in route[1:]:
+            wrapped.append(bytes(layer[:key_size]))
+            peeled = keystore.decrypt_packet(layer)
+            assert peeled.preamble == Messages.Preambles.MSG_FORWARD.value
+            assert (peeled.dest_ip, peeled.dest_port) == (hop.ip, hop.port)
+            layer = peeled.raw_body
+        wrapped.append(bytes(layer[:key_size]))
+        assert bytes(keystore.decrypt_packet(layer).raw_body) == b"hello"
+    assert len(set(wrapped)) == len(wrapped)
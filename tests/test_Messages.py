@@ -0,0 +1,121 @@
+import Messages
+from Messages import CellCodec, Packet, Preambles
+
+import os
+import socket
+
+import pytest
+
+
+def packet(size: int, circ_id: int = 1, preamble: int = Preambles.MSG_RELAY.value) -> Packet:
+    return Packet(preamble, "10.0.0.1", 7000, size, os.urandom(size), circ_id, 3)
+
+
+def fields(p: Packet):
+    return (p.preamble, p.dest_ip, p.dest_port, p.circ_id, p.stream_id, bytes(p.raw_body))
+
+
+def decode(decoder, data: bytes, step: int):
+    '''Feed a stream to a decoder in slices of `step` bytes, collecting every packet it yields.
+
+    '''
+    packets = list()
+    for offset in range(0, len(data), step):
+        decoder.feed(data[offset:(offset + step)])
+        packets.extend(fields(p) for p in decoder)
+    return packets
+
+
+@pytest.mark.parametrize("size", [0, 1, CellCodec().capacity, CellCodec().capacity + 1, 100000])
+@pytest.mark.parametrize("step", [1, 37, Messages.CELL_SIZE, 1 << 20])
+def test_cells_reassemble_however_the_stream_is_split(size: int, step: int):
+    codec = CellCodec()
+    sent = [packet(size), packet(17, 2)]
+    data = b''.join(bytes(codec.encode(p)) for p in sent)
+    assert len(data) % codec.cell_size == 0
+    assert decode(codec.decoder(), data, step) == [fields(p) for p in sent]
+
+
+def test_fragments_of_different_circuits_interleave():
+    codec = CellCodec()
+    first, second = packet(3 * codec.capacity, 1), packet(2 * codec.capacity, 2)
+    cells = [bytes(codec.encode(p)) for p in (first, second)]
+    split = [[cells[i][j:(j + codec.cell_size)] for j in range(0, len(cells[i]), codec.cell_size)] for i in (0, 1)]
+    data = b''.join([split[0][0], split[1][0], split[0][1], split[1][1], split[0][2]])
+    assert decode(codec.decoder(), data, 1000) == [fields(second), fields(first)]
+
+
+def test_passthrough_cells_are_not_reassembled():
+    codec = CellCodec()
+    sent = packet(2 * codec.capacity)
+    decoded = decode(codec.decoder(passthrough=(Preambles.MSG_RELAY.value,)), bytes(codec.encode(sent)), 7)
+    assert len(decoded) == 2
+    assert b''.join(cell[-1] for cell in decoded) == bytes(sent.raw_body)
+
+
+def test_oversized_fragmented_packet_is_refused():
+    codec = CellCodec()
+    cell, offset = codec.reserve(Packet(Preambles.MSG_DATA.value, "10.0.0.1", 7000, Messages.MAX_PACKET_SIZE + 1),
+                                 codec.capacity)
+    decoder = codec.decoder()
+    decoder.feed(bytes(cell))
+    with pytest.raises(ValueError):
+        decoder.next_packet()
+
+
+def raw_cell(total: int, length: int, fill: int) -> bytes:
+    '''Craft a cell by hand, declaring whatever data and fragment sizes a test needs.
+
+    '''
+    cell = bytearray(Messages.CELL_SIZE)
+    Messages.HEADER.pack_into(cell, 0, Preambles.MSG_DATA.value, bytes(4), 0, total, 1, 0)
+    Messages.CELL_LENGTH.pack_into(cell, Messages.HEADER.size, length)
+    start = Messages.HEADER.size + Messages.CELL_LENGTH.size
+    cell[start:(start + fill)] = bytes(fill)
+    return bytes(cell)
+
+
+@pytest.mark.parametrize("cells", [
+    [raw_cell(10, CellCodec().capacity, CellCodec().capacity)],
+    [raw_cell(1000, CellCodec().capacity + 1, CellCodec().capacity)],
+    [raw_cell(CellCodec().capacity + 10, CellCodec().capacity, CellCodec().capacity)] * 2,
+], ids=["fragment-past-total", "fragment-past-cell", "fragments-past-total"])
+def test_cells_claiming_too_much_data_are_refused(cells):
+    decoder = CellCodec().decoder()
+    decoder.feed(b''.join(cells))
+    with pytest.raises(ValueError):
+        list(decoder)
+
+
+def test_fragments_of_streams_sharing_a_circuit_interleave():
+    codec = CellCodec()
+    first, second = packet(2 * codec.capacity), packet(2 * codec.capacity)
+    second.stream_id = 4
+    cells = [bytes(codec.encode(p)) for p in (first, second)]
+    size = codec.cell_size
+    data = cells[0][:size] + cells[1][:size] + cells[0][size:] + cells[1][size:]
+    assert decode(codec.decoder(), data, size) == [fields(first), fields(second)]
+
+
+def test_detach_returns_bytes_past_the_last_packet():
+    codec = CellCodec()
+    first = bytes(codec.encode(packet(10)))
+    rest = bytes(codec.encode(packet(10, 2)))
+    decoder = codec.decoder()
+    decoder.feed(first + rest[:50])
+    assert [p.circ_id for p in decoder] == [1]
+    assert decoder.detach() == rest[:50]
+
+
+@pytest.mark.parametrize("codec", [Messages.FrameCodec(), CellCodec()], ids=["frames", "cells"])
+def test_recv_packet_reads_from_a_socket(codec: Messages.Codec):
+    sent = [packet(size, i + 1) for i, size in enumerate((0, 5000, 70000))]
+    near, far = socket.socketpair()
+    with near, far:
+        for p in sent:
+            far.sendall(codec.encode(p))
+        decoder = codec.decoder()
+        assert [fields(Messages.recv_packet(near, decoder)) for _ in sent] == [fields(p) for p in sent]
+        far.close()
+        with pytest.raises(ConnectionError):
+            Messages.recv_packet(near, decoder)
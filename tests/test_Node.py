@@ -0,0 +1,148 @@
+import Circuit
+from ConnectionPool import ConnectionPool
+import Directory
+import KeyCache
+from KeyStore import KeyStore
+import Messages
+import Metrics
+from Node import MEASURED_TRANSFER, Node
+from PeerNode import PeerNode
+import Prober
+from RouteSelector import RouteSelector
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+import socket
+import threading
+
+import pytest
+
+
+def key_pair() -> KeyStore:
+    keystore = KeyStore()
+    keystore.server_keypair.private = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    keystore.server_keypair.public = keystore.server_keypair.private.public_key()
+    return keystore
+
+
+class Relay(object):
+    '''Answers key requests and handshakes the way a relay does, dropping the link on an onion skin it cannot open.
+
+    '''
+    def __init__(self, keys: KeyStore, answer_keys: bool = True) -> None:
+        self.keys = keys
+        self.answer_keys = answer_keys
+        self.server = socket.create_server(("127.0.0.1", 0))
+        self.peer = PeerNode(*self.server.getsockname())
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self) -> None:
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.serve, args=(conn,), daemon=True).start()
+
+    def serve(self, conn: socket.socket) -> None:
+        codec = Messages.FrameCodec()
+        decoder = codec.decoder()
+        with conn:
+            while True:
+                try:
+                    packet = Messages.recv_packet(conn, decoder)
+                except OSError:
+                    return
+                if((packet.preamble == Messages.Preambles.MSG_GETKEY.value) and self.answer_keys):
+                    pem = self.keys.server_keypair.public.public_bytes(
+                        encoding=serialization.Encoding.PEM, format=serialization.PublicFormat.SubjectPublicKeyInfo)
+                    conn.sendall(codec.encode(Messages.Packet(Messages.Preambles.MSG_ISKEY.value, '', 0, 0, pem)))
+                elif(packet.preamble == Messages.Preambles.MSG_CREATE.value):
+                    try:
+                        onion_skin = self.keys.decrypt_packet(packet.raw_body)
+                    except Exception:
+                        return
+                    reply = Circuit.respond_keys(onion_skin.raw_body)[0]
+                    conn.sendall(codec.encode(Messages.Packet(Messages.Preambles.MSG_CREATED.value, '', 0, 0, reply,
+                                                              packet.circ_id)))
+                else:
+                    return
+
+    def close(self) -> None:
+        self.server.close()
+
+
+def client(tmp_path, relay: PeerNode, key: rsa.RSAPublicKey) -> Node:
+    # Only what building circuits touches, without reading any configuration or starting any threads
+    node = Node.__new__(Node)
+    node.keystore = KeyStore()
+    node.keystore.attach_cache(KeyCache.KeyCache(str(tmp_path / "keys.db")))
+    node.pool = ConnectionPool(Messages.FrameCodec())
+    node.selector = RouteSelector()
+    node.core_directory = Directory.Directory()
+    node.metrics = Metrics.Metrics()
+    node.prober = Prober.Prober(node.pool, node.selector.relays, node.relay_health)
+    node.keystore.set_peer_key(relay, key)
+    node.selector.add(relay)
+    return node
+
+
+def der(key: rsa.RSAPublicKey) -> bytes:
+    return key.public_bytes(encoding=serialization.Encoding.DER,
+                            format=serialization.PublicFormat.SubjectPublicKeyInfo)
+
+
+def test_rotated_key_is_fetched_again_without_blaming_the_relay(tmp_path):
+    old, new = key_pair(), key_pair()
+    relay = Relay(new)
+    node = client(tmp_path, relay.peer, old.server_keypair.public)
+    try:
+        with pytest.raises(ConnectionError):
+            node.build_circuit([relay.peer])
+        assert der(node.keystore.get_pub_key(relay.peer)) == der(new.server_keypair.public)
+        assert node.keystore.key_cache.load([relay.peer]) == {relay.peer: der(new.server_keypair.public)}
+        assert relay.peer in node.selector
+        assert relay.peer.failures == 0
+        circuit = node.build_circuit([relay.peer])
+        assert len(circuit.hops) == 1
+        circuit.conn.release(False)
+    finally:
+        node.pool.close()
+        relay.close()
+
+
+def test_relay_that_cannot_be_asked_keeps_its_key(tmp_path):
+    old, new = key_pair(), key_pair()
+    relay = Relay(new, answer_keys=False)
+    node = client(tmp_path, relay.peer, old.server_keypair.public)
+    try:
+        with pytest.raises(ConnectionError):
+            node.build_circuit([relay.peer])
+        assert der(node.keystore.get_pub_key(relay.peer)) == der(old.server_keypair.public)
+        assert node.keystore.key_cache.load([relay.peer]) == {relay.peer: der(old.server_keypair.public)}
+        assert relay.peer in node.selector
+        assert relay.peer.failures == 1
+    finally:
+        node.pool.close()
+        relay.close()
+
+
+def test_transfers_weight_every_relay_of_their_circuit_by_peak_throughput(tmp_path):
+    route = [PeerNode("10.%d.0.1" % i, 7000) for i in range(0, 3)]
+    node = client(tmp_path, route[0], key_pair().server_keypair.public)
+    for peer in route[1:]:
+        node.add_relay(peer)
+    circuit = Circuit.Circuit(1, None)
+    circuit.route.extend(route)
+    size = MEASURED_TRANSFER
+    node.transfer_measured(circuit, size, 0.5)
+    node.transfer_measured(circuit, size, 2.0)
+    assert [node.selector.metrics[peer][0] for peer in route] == [2 * size] * len(route)
+    # Too short to tell throughput apart from latency
+    node.transfer_measured(circuit, size - 1, 0.001)
+    assert [peer.bandwidth for peer in route] == [2 * size] * len(route)
+    # Readding a relay, such as after fetching its key again, keeps what was measured of it
+    node.selector.remove(route[0])
+    node.add_relay(route[0])
+    assert node.selector.metrics[route[0]][0] == 2 * size
+    node.pool.close()
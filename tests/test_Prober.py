@@ -0,0 +1,103 @@
+from ConnectionPool import ConnectionPool
+import Messages
+from PeerNode import Breaker, PeerNode
+from Prober import Prober
+
+import socket
+import threading
+
+import pytest
+
+
+def test_breaker_opens_after_failures_in_a_row():
+    peer = PeerNode("10.0.0.1", 1000)
+    assert not peer.record_failure(3)
+    peer.record_success(0.01)
+    assert not peer.record_failure(3)
+    assert not peer.record_failure(3)
+    assert peer.breaker is Breaker.CLOSED
+    assert peer.record_failure(3)
+    assert peer.breaker is Breaker.OPEN
+    assert not peer.healthy
+    assert not peer.trial_due(60.0)
+
+
+def test_trial_after_cooldown_closes_or_reopens():
+    peer = PeerNode("10.0.0.1", 1000)
+    peer.record_failure(1)
+    assert peer.trial_due(0.0)
+    assert peer.breaker is Breaker.HALF_OPEN
+    # A failed trial opens the breaker again straight away
+    assert peer.record_failure(3)
+    assert peer.breaker is Breaker.OPEN
+    assert peer.trial_due(0.0)
+    assert peer.record_success(0.02)
+    assert peer.breaker is Breaker.CLOSED
+    assert peer.healthy
+    assert peer.failures == 0
+
+
+def test_rtt_is_a_moving_average():
+    peer = PeerNode("10.0.0.1", 1000)
+    assert peer.rtt is None
+    peer.record_success(0.1, 0.5)
+    peer.record_success(0.3, 0.5)
+    assert peer.rtt == pytest.approx(0.2)
+
+
+# ======================================================================================================================
+@pytest.fixture
+def relay():
+    '''Listen like a relay that answers every packet with `reply`, or echoes it back if `reply` is `None`.
+
+    '''
+    codec = Messages.FrameCodec()
+    server = socket.create_server(("127.0.0.1", 0))
+    state = {"reply": None}
+
+    def serve():
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                return
+            with conn:
+                decoder = codec.decoder()
+                try:
+                    while True:
+                        packet = Messages.recv_packet(conn, decoder)
+                        conn.sendall(codec.encode(packet if state["reply"] is None else state["reply"]))
+                except (ConnectionError, OSError):
+                    pass
+    threading.Thread(target=serve, daemon=True).start()
+    yield PeerNode("127.0.0.1", server.getsockname()[1]), codec, state
+    server.close()
+
+
+def test_probe_records_round_trip(relay):
+    peer, codec, _ = relay
+    pool = ConnectionPool(codec)
+    Prober(pool, lambda: [peer], lambda p: None).probe(peer)
+    assert peer.rtt is not None
+    assert peer.failures == 0
+    assert len(pool.idle[peer]) == 1
+    pool.close()
+
+
+def test_wrong_answer_is_not_a_failure(relay):
+    peer, codec, state = relay
+    state["reply"] = Messages.Packet(Messages.Preambles.MSG_RELAY.value, '', 0, 0, b"stale")
+    pool = ConnectionPool(codec)
+    changed = list()
+    Prober(pool, lambda: [peer], changed.append, threshold=1).probe(peer)
+    assert (peer.failures, peer.breaker, changed) == (0, Breaker.CLOSED, [])
+    # The connection is left in an unknown state, so it is closed rather than pooled
+    assert (pool.idle.get(peer, []), pool.open[peer]) == ([], 0)
+
+
+def test_unreachable_peer_is_a_failure():
+    with socket.create_server(("127.0.0.1", 0)) as server:
+        port = server.getsockname()[1]
+    peer = PeerNode("127.0.0.1", port)
+    Prober(ConnectionPool(Messages.FrameCodec()), lambda: [peer], lambda p: None, threshold=1).probe(peer)
+    assert peer.breaker is Breaker.OPEN
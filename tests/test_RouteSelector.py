@@ -0,0 +1,94 @@
+from PeerNode import PeerNode
+from RouteSelector import FenwickTree, RouteSelector
+
+import random
+
+import pytest
+
+
+def churned_selector(count: int, distinct_subnets: bool) -> RouteSelector:
+    '''Build a selector whose trees have been through enough random updates to carry rounding residue.
+
+    '''
+    rng = random.Random(1)
+    selector = RouteSelector(distinct_subnets=distinct_subnets)
+    peers = [PeerNode(f"10.0.0.{i}", 1000 + i) for i in range(0, count)]
+    for peer in peers:
+        selector.add(peer)
+    for _ in range(0, 50):
+        selector.update(rng.choice(peers), bandwidth=rng.uniform(1.0, 1e7), rtt=rng.uniform(0.0, 0.5))
+    return selector
+
+
+def test_fenwick_find_samples_by_weight():
+    tree = FenwickTree()
+    for weight in (1.0, 0.0, 3.0):
+        tree.append(weight)
+    assert tree.total() == 4.0
+    assert tree.find(0.5) == 0
+    assert tree.find(1.0) == 2
+    assert tree.find(3.999) == 2
+
+
+def test_fenwick_find_skips_rounding_residue():
+    tree = FenwickTree()
+    for weight in (0.1, 0.2, 0.7):
+        tree.append(weight)
+    for index in range(0, 3):
+        tree.update(index, 0.0)
+    assert tree.total() == 0.0
+    with pytest.raises(ValueError):
+        tree.find(0.0)
+    tree.update(1, 0.3)
+    for _ in range(0, 100):
+        assert tree.find(random.random() * tree.total()) == 1
+
+
+def test_select_never_repeats_a_relay():
+    selector = churned_selector(3, False)
+    for _ in range(0, 2000):
+        route = selector.select(3)
+        assert len(set(route)) == 3
+
+
+def test_select_deeper_than_eligible_relays_raises():
+    selector = churned_selector(3, False)
+    for _ in range(0, 2000):
+        with pytest.raises(ValueError):
+            selector.select(4)
+    with pytest.raises(ValueError):
+        selector.select(2, exclude=selector.relays()[:2])
+
+
+def test_select_uses_one_relay_per_subnet():
+    selector = RouteSelector()
+    for i in range(0, 4):
+        selector.add(PeerNode(f"10.0.0.{i}", 1000 + i))
+    selector.add(PeerNode("10.1.0.1", 1000))
+    for _ in range(0, 200):
+        route = selector.select(2)
+        assert {peer.ip.split(".")[1] for peer in route} == {"0", "1"}
+    with pytest.raises(ValueError):
+        selector.select(3)
+
+
+def test_removed_relay_is_not_selected():
+    selector = churned_selector(3, False)
+    gone = selector.relays()[0]
+    selector.remove(gone)
+    for _ in range(0, 500):
+        assert gone not in selector.select(2)
+    with pytest.raises(ValueError):
+        selector.select(3)
+
+
+def test_down_relay_is_never_selected():
+    selector = churned_selector(2, False)
+    healthy, down = selector.relays()
+    selector.update(down, healthy=False)
+    for _ in range(0, 2000):
+        assert selector.select(1) == [healthy]
+        with pytest.raises(ValueError):
+            selector.select(2)
+    selector.update(down, healthy=True)
+    assert set(selector.select(2)) == {healthy, down}
@@ -0,0 +1,334 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import Circuit
+from GenerateConfigs import generate_client, generate_server
+from KeyStore import KeyStore
+import Messages
+from Node import Node
+from PeerNode import PeerNode
+
+import argparse
+from cryptography import __version__ as cryptography_version
+from cryptography.hazmat.primitives.asymmetric import rsa
+import json
+import platform
+import socket
+import statistics
+import subprocess
+import tempfile
+from time import perf_counter, perf_counter_ns, sleep, time
+from typing import Callable, Dict, List
+
+
+DEFAULT_OUTPUT = "benchmarks.json"
+BODY_SIZES     = (0, 64, 512, 4096, 65536) # Packet bodies covered by the micro-benchmarks
+REPEATS        = 5                         # Timed runs of each micro-benchmark, of which the median is kept
+BASE_PORT      = 9100                      # First port given to the local relays
+RELAY_STARTUP  = 10.0                      # Seconds a local relay has to start accepting connections
+SMALL_BODY     = 64                        # Body of the echoes timed for latency and message rate
+BULK_BODY      = 16 * 1024                 # Body of the echoes timed for throughput
+
+
+def time_op(op: Callable[[], object], count: int) -> float:
+    '''Time an operation, keeping the median of several runs to damp out noise.
+
+    Parameters:
+        op (Callable[[], object]): Operation being measured.
+        count (int): Calls per timed run.
+
+    Returns:
+        Nanoseconds per call.
+
+    '''
+    runs = list()
+    for _ in range(0, REPEATS):
+        start = perf_counter_ns()
+        for _ in range(0, count):
+            op()
+        runs.append((perf_counter_ns() - start) / count)
+    return statistics.median(runs)
+
+
+def percentile(samples: List[float], fraction: float) -> float:
+    '''Pick the sample below which a given fraction of the samples fall.
+
+    '''
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    '''Reduce latency samples in seconds to the milliseconds worth tracking.
+
+    '''
+    return {"p50_ms": percentile(samples, 0.50) * 1e3,
+            "p99_ms": percentile(samples, 0.99) * 1e3,
+            "mean_ms": statistics.fmean(samples) * 1e3}
+
+
+# ======================================================================================================================
+def micro_benchmarks(count: int) -> Dict[str, Dict[str, float]]:
+    '''Time the packet codec and the encryption layers in isolation.
+
+    Parameters:
+        count (int): Calls per timed run.
+
+    Returns:
+        Nanoseconds per call, keyed by benchmark and then by body size.
+
+    '''
+    results = {"pack": dict(), "unpack": dict(), "frame_encode": dict(), "cell_encode": dict(),
+               "encrypt_packet": dict(), "decrypt_packet": dict(), "circuit_wrap_3": dict()}
+    keystore = KeyStore()
+    keystore.server_keypair.private = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    keystore.server_keypair.public = keystore.server_keypair.private.public_key()
+    peer = PeerNode("127.0.0.1", BASE_PORT)
+    keystore.add_peer(peer, keystore.server_keypair.public)
+    circuit = Circuit.Circuit(1, None)
+    for _ in range(0, 3):
+        circuit.add_hop(peer, Circuit.CircuitHop(os.urandom(32), os.urandom(32)))
+    cells = Messages.CellCodec()
+    # Public key operations are far slower, so they get fewer calls
+    slow = max(1, count // 100)
+    for size in BODY_SIZES:
+        packet = Messages.Packet(Messages.Preambles.MSG_DATA.value, "127.0.0.1", BASE_PORT, size, os.urandom(size))
+        packed = bytes(packet.pack())
+        layer = keystore.encrypt_packet(packet, peer)
+        key = str(size)
+        results["pack"][key] = time_op(packet.pack, count)
+        results["unpack"][key] = time_op(lambda: Messages.Packet().unpack(packed), count)
+        results["frame_encode"][key] = time_op(packet.frame, count)
+        results["cell_encode"][key] = time_op(lambda: cells.encode(packet), count)
+        results["encrypt_packet"][key] = time_op(lambda: keystore.encrypt_packet(packet, peer), slow)
+        results["decrypt_packet"][key] = time_op(lambda: keystore.decrypt_packet(layer), slow)
+        results["circuit_wrap_3"][key] = time_op(lambda: circuit.wrap(packet), count)
+        print(f"[BENCH] Micro {size} bytes: pack {results['pack'][key]:.0f} ns, "
+              f"encrypt {results['encrypt_packet'][key]:.0f} ns")
+    return results
+
+
+
+# ======================================================================================================================
+class BenchmarkClient(Node):
+    '''Client whose session runs the macro-benchmarks instead of the demo exchange.
+
+    Attributes:
+        hops (List[int]): Route lengths to be measured.
+        messages (int): Echoes sent for each measurement.
+        builds (int): Circuits built to time setup.
+        results (Dict[str, Dict[str, float]]): Measurements, keyed by route length.
+
+    '''
+    def __init__(self, cfg_dir: str, hops: List[int], messages: int, circuits: int) -> None:
+        self.hops:     List[int]                   = hops
+        self.messages: int                         = messages
+        self.builds:   int                         = circuits
+        self.results:  Dict[str, Dict[str, float]] = dict()
+        super().__init__(cfg_dir, mode="client")
+
+
+    def run_client(self) -> None:
+        if(self.contact_core() < max(self.hops)):
+            raise(RuntimeError("Not every local relay answered the key requests"))
+        for depth in self.hops:
+            self.results[str(depth)] = self.measure(depth)
+            print(f"[BENCH] {depth} hops: {json.dumps(self.results[str(depth)])}")
+        self.pool.close()
+
+
+    def measure(self, depth: int) -> Dict[str, float]:
+        '''Measure circuits of one length.
+
+        Parameters:
+            depth (int): Number of relays in each circuit.
+
+        Returns:
+            Setup latency, echo latency, message rate and throughput.
+
+        '''
+        setup = list()
+        for _ in range(0, self.builds):
+            route = self.selector.select(depth)
+            start = perf_counter()
+            circuit = self.build_circuit(route)
+            setup.append(perf_counter() - start)
+            circuit.close()
+        circuit = self.build_circuit(self.selector.select(depth))
+        try:
+            small = Messages.Packet(Messages.Preambles.MSG_ECHO.value, '', 0, 0, os.urandom(SMALL_BODY))
+            bulk = Messages.Packet(Messages.Preambles.MSG_ECHO.value, '', 0, 0, os.urandom(BULK_BODY))
+            # Round trips one at a time
+            latency = list()
+            for _ in range(0, self.messages):
+                start = perf_counter()
+                circuit.send(small)
+                circuit.recv()
+                latency.append(perf_counter() - start)
+            # Pipelined, with flow control deciding how far ahead the client gets
+            rate = self.pipeline(circuit, small)
+            throughput = self.pipeline(circuit, bulk) * BULK_BODY / 1e6
+        finally:
+            circuit.close()
+        results = {"setup_" + name: value for name, value in summarize(setup).items()}
+        results.update({"echo_" + name: value for name, value in summarize(latency).items()})
+        results["msgs_per_s"] = rate
+        results["mb_per_s"] = throughput
+        return results
+
+
+    def pipeline(self, circuit: Circuit.Circuit, packet: Messages.Packet) -> float:
+        '''Send a burst of echoes before reading any of the replies.
+
+        Returns:
+            Echoes completed per second.
+
+        '''
+        start = perf_counter()
+        circuit.send_many(packet for _ in range(0, self.messages))
+        for _ in range(0, self.messages):
+            circuit.recv()
+        return self.messages / (perf_counter() - start)
+
+
+
+# ======================================================================================================================
+def write_configs(work_dir: str, relays: int, base_port: int, cell_mode: bool) -> str:
+    '''Generate keys and configuration files for a set of local relays and a client.
+
+    Parameters:
+        work_dir (str): Scratch directory the files are written to.
+        relays (int): Number of relays.
+        base_port (int): Port of the first relay, with the others on the ports after it.
+        cell_mode (bool): Whether every node uses fixed-size cells.
+
+    Returns:
+        The configuration directory.
+
+    '''
+    cfg_dir = os.path.join(work_dir, "cfg")
+    os.makedirs(cfg_dir)
+    keys = os.path.join(work_dir, "node")
+    KeyStore().gen_keys(keys + ".pub", keys + ".priv")
+    generate_server(os.path.join(cfg_dir, "server.json"))
+    generate_client(os.path.join(cfg_dir, "client.json"))
+    for name in ("server", "client"):
+        cfg_file = os.path.join(cfg_dir, name + ".json")
+        with open(cfg_file, 'r') as cfg_read:
+            cfg_data = json.load(cfg_read)
+        cfg_data["connection"]["cell_mode"] = cell_mode
+        cfg_data["files"] = {"public_key": keys + ".pub", "private_key": keys + ".priv"}
+        if(name == "client"):
+            cfg_data["cores"] = {f"relay{i}": f"127.0.0.1:{base_port + i}" for i in range(0, relays)}
+            # Every relay shares the loopback network
+            cfg_data["connection"]["distinct_subnets"] = False
+        with open(cfg_file, 'w') as cfg_write:
+            cfg_write.write(json.dumps(cfg_data, indent=4))
+    return cfg_dir
+
+
+def start_relays(cfg_dir: str, relays: int, base_port: int) -> List[subprocess.Popen]:
+    '''Start local relays and wait until each one accepts connections.
+
+    Returns:
+        The relay processes.
+
+    Raises:
+        RuntimeError: A relay did not start in time.
+
+    '''
+    node = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "Node.py")
+    processes = [subprocess.Popen([sys.executable, node, "--cfg_dir", cfg_dir, "-m", "server", "-p", str(port)],
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                 for port in range(base_port, base_port + relays)]
+    deadline = perf_counter() + RELAY_STARTUP
+    for port in range(base_port, base_port + relays):
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if(perf_counter() > deadline):
+                    raise(RuntimeError(f"Relay on port {port} did not start"))
+                sleep(0.1)
+    return processes
+
+
+def macro_benchmarks(hops: List[int], messages: int, circuits: int, base_port: int,
+                     cell_mode: bool) -> Dict[str, Dict[str, float]]:
+    '''Measure circuits of several lengths through relays running on loopback.
+
+    Returns:
+        Measurements, keyed by route length.
+
+    '''
+    with tempfile.TemporaryDirectory() as work_dir:
+        cfg_dir = write_configs(work_dir, max(hops), base_port, cell_mode)
+        processes = start_relays(cfg_dir, max(hops), base_port)
+        try:
+            return BenchmarkClient(cfg_dir, hops, messages, circuits).results
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.wait()
+
+
+def create_argv() -> argparse.Namespace:
+    '''Parse the command line arguments passed in with the program.
+
+    Returns:
+        A namespace through which arguments can be accessed.
+
+    '''
+    parser = argparse.ArgumentParser(prog="Arbitrary Network Benchmarks",
+                                     description="Offline benchmarks of the codec, crypto and local circuits")
+    parser.add_argument("-o", "--output",
+                        help="File the JSON results are written to",
+                        type=str,
+                        default=DEFAULT_OUTPUT)
+    parser.add_argument("--hops",
+                        help="Comma separated route lengths to measure",
+                        type=str,
+                        default="1,2,3,4,5")
+    parser.add_argument("--messages",
+                        help="Echoes sent for each measurement",
+                        type=int,
+                        default=1000)
+    parser.add_argument("--circuits",
+                        help="Circuits built to time setup",
+                        type=int,
+                        default=20)
+    parser.add_argument("--count",
+                        help="Calls per timed run of each micro-benchmark",
+                        type=int,
+                        default=2000)
+    parser.add_argument("-p", "--port",
+                        help="Port of the first local relay",
+                        type=int,
+                        default=BASE_PORT)
+    parser.add_argument("--cell_mode",
+                        help="Run the relays with fixed-size cells",
+                        action="store_true")
+    parser.add_argument("--micro_only",
+                        help="Skip the benchmarks that start local relays",
+                        action="store_true")
+    return parser.parse_args()
+
+
+# ======================================================================================================================
+if __name__ == "__main__":
+    argv = create_argv()
+    report = {"timestamp": time(),
+              "python": platform.python_version(),
+              "cryptography": cryptography_version,
+              "platform": platform.platform(),
+              "parameters": vars(argv),
+              "micro": micro_benchmarks(argv.count)}
+    if(not argv.micro_only):
+        report["macro"] = macro_benchmarks([int(depth) for depth in argv.hops.split(',')], argv.messages,
+                                           argv.circuits, argv.port, argv.cell_mode)
+    with open(argv.output, 'w') as report_file:
+        report_file.write(json.dumps(report, indent=4))
+    print(f"[BENCH] Results written to {argv.output}")
@@ -11,12 +11,14 @@ def generate_server(out_file: str = DEFAULT_SERVER) -> None:
     '''
     cfg_json = {"connection":
                 {
-                    "port": "7877"
+                    "port": "7877",
+                    "cell_mode": False
                 },
                 "files":
                 {
                     "private_key": "keys/server.priv",
                     "public_key": "keys/server.pub",
+                    "transfer_dir": "transfers",
                 }
                }
     with open(out_file, 'w') as server_cfg:
@@ -35,11 +37,25 @@ def generate_client(out_file: str = DEFAULT_CLIENT) -> None:
                 {
                     "reroute_min": 30,
                     "reroute_max": 180,
+                    "prebuilt_circuits": 2,
+                    "route_depth": 1,
+                    "cell_mode": False,
+                    "key_ttl": 86400,
+                    "distinct_subnets": True,
+                },
+                "pool":
+                {
+                    "max_per_peer": 4,
+                    "idle_timeout": 60,
+                    "keepalive": 15,
+                    "retries": 3,
+                    "backoff": 0.25,
                 },
                 "files":
                 {
                     "private_key": "keys/client.priv",
                     "public_key": "keys/client.pub",
+                    "key_cache": "keys/peers.db",
                 }
                }
     with open(out_file, 'w') as client_cfg: